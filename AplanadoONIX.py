@@ -0,0 +1,223 @@
+import hashlib
+import logging
+import sys
+import time
+import zlib
+import xml.etree.ElementTree as ET
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+import MetricasDILVE
+
+# Aplanado de las respuestas ONIX de getRecordsX: convierte el XML en filas
+# (tabla, columnas, valores) listas para insertar. No toca la base de datos,
+# así que DAPI_SQLite_v8.py puede ejecutarlo en un pool de procesos y dejar al
+# escritor solo las sentencias SQL.
+
+NS_ONIX = 'http://ns.editeur.org/onix/3.0/reference'
+NAMESPACE = {'onix': NS_ONIX}
+ERROR_DILVE = '{http://www.dilve.es/dilve/api/xsd/getRecordsXResponse}error'
+
+# Compresión de las fichas archivadas en onix_crudo: zstd si está instalado zstandard, si no zlib
+COMPRESION = 'zstd' if zstandard is not None else 'zlib'
+
+# Elementos que van a su propia tabla (una fila por cada aparición)
+ELEMENTOS_ESPECIFICOS = frozenset(['Measure', 'Contributor', 'TitleDetail', 'TextContent', 'PublishingDate', 'Language', 'Subject', 'SupportingResource', 'Audience', 'AudienceRange', 'Publisher', 'Extent', 'SupplyDetail', 'RelatedProduct'])
+
+# Plan de aplanado, compilado sobre la marcha: cada etiqueta con espacio de nombres
+# se traduce una sola vez a su nombre local y cada (columna del padre, etiqueta) a la
+# columna del hijo. Son cadenas internadas que comparten todas las fichas, así que el
+# recorrido no hace split ni f-strings por nodo. Las etiquetas ONIX son un conjunto
+# cerrado, de modo que las tablas no crecen más allá de unos pocos miles de entradas
+_nombres_locales = {}
+# columna del padre -> {etiqueta del hijo: (columna del hijo, nombre local)}
+_plan = {}
+
+# Función para el nombre local de una etiqueta ({espacio de nombres}Nombre -> Nombre)
+def nombre_local(tag):
+    nombre = _nombres_locales.get(tag)
+    if nombre is None:
+        nombre = _nombres_locales[tag] = sys.intern(tag.split('}')[1] if '}' in tag else tag)
+    return nombre
+
+# Función para los hijos ya compilados de una columna: {etiqueta: (columna, nombre local)}
+def plan_de(parent_tag):
+    hijos = _plan.get(parent_tag)
+    if hijos is None:
+        hijos = _plan[parent_tag] = {}
+    return hijos
+
+# Función para compilar el paso de una columna a un hijo con la etiqueta `tag`
+def compilar_paso(hijos, parent_tag, tag):
+    local = nombre_local(tag)
+    paso = hijos[tag] = (sys.intern(f"{parent_tag}_{local}".strip('_')), local)
+    return paso
+
+# Función para obtener el ISBN de un Product a partir de sus ProductIdentifier
+def isbn_de_producto(product_info, isbns):
+    identificadores = {}
+    for identifier in product_info.findall('onix:ProductIdentifier', NAMESPACE):
+        id_type = identifier.findtext('onix:ProductIDType', default='', namespaces=NAMESPACE).strip()
+        id_value = identifier.findtext('onix:IDValue', default='', namespaces=NAMESPACE).strip()
+        if id_value:
+            # Se prefiere el identificador que coincida con uno de los solicitados
+            if id_value in isbns:
+                return id_value
+            identificadores.setdefault(id_type, id_value)
+    # 15 = ISBN-13, 03 = GTIN-13
+    return identificadores.get('15') or identificadores.get('03')
+
+# Función para aplanar todos los niveles de anidación de un elemento en una fila.
+# Con separar=True los elementos específicos van a sus propias filas (sin volver
+# a separar lo que contienen), que se añaden a `filas` antes que la del padre
+def filas_anidadas(table_name, element, filas, parent_tag='', separar=True):
+    nested_data = {}
+
+    def process_element(element, parent_tag):
+        hijos = _plan.get(parent_tag) or plan_de(parent_tag)
+        for child in element:
+            child_tag, tag = hijos.get(child.tag) or compilar_paso(hijos, parent_tag, child.tag)
+            if len(child):
+                if separar and tag in ELEMENTOS_ESPECIFICOS:
+                    filas_anidadas(tag, child, filas, tag, separar=False)
+                else:
+                    process_element(child, child_tag)
+            else:
+                text = child.text
+                valores = nested_data.get(child_tag)
+                if valores is None:
+                    nested_data[child_tag] = [text.strip() if text else '']
+                else:
+                    valores.append(text.strip() if text else '')
+
+    process_element(element, parent_tag)
+
+    if nested_data:
+        filas.append((table_name, tuple(nested_data), tuple(' ; '.join(v) for v in nested_data.values())))
+
+# Función para las filas normalizadas de un Product: cada aparición de un elemento
+# compuesto es una fila de {etiqueta}_normalizado con sus hojas directas como columnas,
+# su número de aparición en el ISBN (secuencia) y el elemento que la contiene (padre,
+# secuencia_padre). Así Contributor, Subject, Price, etc. no se juntan con ' ; '.
+# `contadores` lleva las secuencias por tabla de un mismo ISBN
+def filas_normalizadas(product_info, filas, contadores):
+    def recorrer(element, padre, secuencia_padre):
+        for child in element:
+            if len(child) == 0:
+                continue
+            tag = nombre_local(child.tag)
+            table_name = f'{tag}_normalizado'
+            secuencia = contadores[table_name] = contadores.get(table_name, 0) + 1
+            hojas = {}
+            for hoja in child:
+                if len(hoja) == 0:
+                    # Las hojas repetidas dentro de una misma aparición se siguen juntando
+                    hojas.setdefault(nombre_local(hoja.tag), []).append(hoja.text.strip() if hoja.text else '')
+            filas.append((table_name,
+                          ('secuencia', 'padre', 'secuencia_padre') + tuple(hojas.keys()),
+                          (secuencia, padre, secuencia_padre) + tuple(' ; '.join(v) for v in hojas.values())))
+            recorrer(child, tag, secuencia)
+
+    recorrer(product_info, 'Product', None)
+
+# Función para las filas de un Product en una sola pasada por sus hijos: libros con
+# el texto de los hijos directos y una tabla por cada bloque compuesto
+# (DescriptiveDetail, PublishingDetail, ...), en ese orden
+def filas_de_producto(product_info):
+    columns = {}
+    anidadas = []
+    for child in product_info:
+        tag = _nombres_locales.get(child.tag) or nombre_local(child.tag)
+        if child.text is not None:
+            columns[tag] = child.text.strip()
+        if len(child):
+            filas_anidadas(tag, child, anidadas)
+    if not columns:
+        return anidadas
+    return [('libros', tuple(columns), tuple(columns.values()))] + anidadas
+
+# Función para comprimir una ficha
+def comprimir(datos):
+    if COMPRESION == 'zstd':
+        return zstandard.ZstdCompressor(level=9).compress(datos)
+    return zlib.compress(datos, 6)
+
+# Función para descomprimir una ficha archivada con la compresión indicada
+def descomprimir(compresion, blob):
+    if compresion == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("La ficha está comprimida con zstd: instale zstandard (pip install zstandard).")
+        return zstandard.ZstdDecompressor().decompress(blob)
+    return zlib.decompress(blob)
+
+# Función para preparar el archivo de los Product de un ISBN: (hash, compresion, xml comprimido).
+# El hash es del XML sin comprimir, así que no depende de la compresión
+def archivar_productos(productos):
+    datos = ''.join(ET.tostring(product_info, encoding='unicode') for product_info in productos).encode('utf-8')
+    return (hashlib.blake2b(datos, digest_size=16).hexdigest(), COMPRESION, comprimir(datos))
+
+# Función para aplanar una ficha de onix_crudo; devuelve sus filas
+def aplanar_archivo(isbn, compresion, blob, normalizar=False):
+    mensaje = b'<ONIXMessage>' + descomprimir(compresion, blob) + b'</ONIXMessage>'
+    filas, _ = aplanar_respuesta(mensaje, isbn, normalizar=normalizar).get(isbn, ([], None))
+    return filas
+
+# Función para aplanar una respuesta de getRecordsX.
+# Devuelve None si DILVE responde con un error, o un diccionario
+# {isbn: (filas, crudo)} con los Product encontrados, donde filas es
+# [(tabla, columnas, valores), ...] (con las de filas_normalizadas si normalizar es True)
+# y crudo lo que devuelve archivar_productos (None si archivar es False).
+# Si se pasa la lista `tiempos` se le añaden los segundos de parseo y de aplanado.
+# Lanza ET.ParseError si el XML está mal formado
+def aplanar_respuesta(xml_content, isbns, archivar=False, normalizar=False, tiempos=None):
+    if isinstance(isbns, str):
+        isbns = [isbns]
+    inicio = time.perf_counter()
+    root = ET.fromstring(xml_content)
+    product_infos = root.findall('.//onix:Product', NAMESPACE)
+    parseado = time.perf_counter()
+    if tiempos is not None:
+        tiempos.append(parseado - inicio)
+    if not product_infos and root.find(f'.//{ERROR_DILVE}') is not None:
+        return None  # Devolver None si hay un error
+
+    productos = {}
+    for product_info in product_infos:
+        if len(isbns) == 1:
+            # Con un único ISBN pedido la respuesta es suya aunque venga con otro identificador
+            isbn = isbns[0]
+        else:
+            isbn = isbn_de_producto(product_info, isbns)
+            if isbn is None:
+                logging.warning("Product sin ISBN identificable en la respuesta, se descarta.")
+                continue
+        productos.setdefault(isbn, []).append(product_info)
+
+    result = {}
+    for isbn, lista in productos.items():
+        filas = [fila for product_info in lista for fila in filas_de_producto(product_info)]
+        if normalizar:
+            contadores = {}
+            for product_info in lista:
+                filas_normalizadas(product_info, filas, contadores)
+        result[isbn] = (filas, archivar_productos(lista) if archivar else None)
+    if tiempos is not None:
+        tiempos.append(time.perf_counter() - parseado)
+    return result
+
+# Función para aplanar una respuesta midiendo sus etapas, para ejecutarla en el pool de
+# procesos (las métricas de ese proceso no llegan al principal): devuelve
+# (resultado de aplanar_respuesta, segundos de parseo, segundos de aplanado)
+def aplanar_medido(xml_content, isbns, archivar=False, normalizar=False):
+    tiempos = []
+    result = aplanar_respuesta(xml_content, isbns, archivar, normalizar, tiempos)
+    return (result, tiempos[0], tiempos[1] if len(tiempos) > 1 else 0.0)
+
+# Función para anotar en MetricasDILVE los tiempos de aplanar_medido (en el proceso que
+# recoge el resultado) y devolver el resultado
+def resultado_medido(medido):
+    result, parseo, aplanado = medido
+    MetricasDILVE.observar('parseo_segundos', parseo)
+    MetricasDILVE.observar('aplanado_segundos', aplanado)
+    return result
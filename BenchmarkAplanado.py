@@ -0,0 +1,94 @@
+import argparse
+import time
+import xml.etree.ElementTree as ET
+import AplanadoONIX
+import MockDILVE
+
+# Micro-benchmark del aplanado de AplanadoONIX: fichas por segundo del plan
+# compilado frente al aplanado anterior (split de la etiqueta y f-string de la
+# columna en cada nodo), sobre el mismo corpus y comprobando que las filas
+# son idénticas. Sin red ni base de datos.
+
+# Aplanado anterior, de referencia
+
+def etiqueta_referencia(element):
+    return element.tag.split('}')[1] if '}' in element.tag else element.tag
+
+def fila_directa_referencia(table_name, element):
+    columns = {etiqueta_referencia(child): child.text.strip() for child in element if child.text is not None}
+
+    if not columns:
+        return None
+
+    return (table_name, tuple(columns.keys()), tuple(columns.values()))
+
+def filas_anidadas_referencia(table_name, element, filas, parent_tag='', separar=True):
+    nested_data = {}
+
+    def process_element(element, parent_tag):
+        for child in element:
+            tag = etiqueta_referencia(child)
+            child_tag = f"{parent_tag}_{tag}".strip('_')
+            if len(child) > 0:
+                if separar and tag in ['Measure', 'Contributor', 'TitleDetail', 'TextContent', 'PublishingDate', 'Language', 'Subject', 'SupportingResource', 'Audience', 'AudienceRange', 'Publisher', 'Extent', 'SupplyDetail', 'RelatedProduct']:
+                    filas_anidadas_referencia(tag, child, filas, tag, separar=False)
+                else:
+                    process_element(child, child_tag)
+            else:
+                if child_tag not in nested_data:
+                    nested_data[child_tag] = []
+                nested_data[child_tag].append(child.text.strip() if child.text else '')
+
+    process_element(element, parent_tag)
+
+    if nested_data:
+        filas.append((table_name, tuple(nested_data.keys()), tuple(' ; '.join(v) for v in nested_data.values())))
+
+def filas_de_producto_referencia(product_info):
+    filas = []
+    fila = fila_directa_referencia('libros', product_info)
+    if fila is not None:
+        filas.append(fila)
+    for child in product_info:
+        if len(child) > 0:
+            filas_anidadas_referencia(etiqueta_referencia(child), child, filas)
+    return filas
+
+# Función para medir fichas por segundo de una función de aplanado (el mejor de `repeticiones`)
+def fichas_por_segundo(funcion, productos, repeticiones):
+    mejor = None
+    for _ in range(repeticiones):
+        inicio = time.perf_counter()
+        for product_info in productos:
+            funcion(product_info)
+        segundos = time.perf_counter() - inicio
+        mejor = segundos if mejor is None else min(mejor, segundos)
+    return len(productos) / mejor
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Micro-benchmark del aplanado ONIX de AplanadoONIX.py.')
+    parser.add_argument('--corpus', help='carpeta con fichas ONIX 3.0 reales (por defecto fichas sintéticas de MockDILVE.py)')
+    parser.add_argument('--fichas', type=int, default=2000, help='fichas sintéticas (sin --corpus)')
+    parser.add_argument('--filas-extra', type=int, default=0, help='Contributor y Subject extra en las fichas sintéticas')
+    parser.add_argument('--repeticiones', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.corpus:
+        fichas = [xml for _, xml in MockDILVE.cargar_corpus(args.corpus)]
+    else:
+        fichas = [MockDILVE.producto_sintetico(str(MockDILVE.ISBN_BASE + i), filas_extra=args.filas_extra)
+                  for i in range(args.fichas)]
+    mensaje = MockDILVE.respuesta_records(fichas)
+
+    inicio = time.perf_counter()
+    productos = ET.fromstring(mensaje).findall('.//onix:Product', AplanadoONIX.NAMESPACE)
+    parseo = len(productos) / (time.perf_counter() - inicio)
+
+    iguales = all(filas_de_producto_referencia(p) == AplanadoONIX.filas_de_producto(p) for p in productos)
+    referencia = fichas_por_segundo(filas_de_producto_referencia, productos, args.repeticiones)
+    compilado = fichas_por_segundo(AplanadoONIX.filas_de_producto, productos, args.repeticiones)
+
+    print(f"{len(productos)} fichas, filas idénticas: {'sí' if iguales else 'NO'}")
+    print(f"{'parseo (ET.fromstring)':<26} {parseo:10.0f} fichas/s")
+    print(f"{'aplanado anterior':<26} {referencia:10.0f} fichas/s")
+    print(f"{'aplanado compilado':<26} {compilado:10.0f} fichas/s  (x{compilado / referencia:.2f})")
@@ -0,0 +1,213 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import MockDILVE
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Benchmark de DAPI_SQLite_v8.py y ListadoISBNsToSQLite.py contra MockDILVE.py,
+# sin credenciales ni llamadas a la API real. Cada escenario se ejecuta en un
+# proceso nuevo sobre una base de datos temporal y se mide: ISBNs por segundo,
+# latencia p50/p99 de las peticiones a getRecordsX, memoria (RSS) pico y tamaño
+# final de la base de datos. Con --json se guardan los resultados para comparar
+# entre versiones.
+
+# Escenarios: ajustes del mock y opciones de DAPI_SQLite_v8 de cada uno
+ESCENARIOS = {
+    # Limitado por la red: latencia alta, un ISBN por llamada
+    'descarga': {'mock': {'latencia_ms': 100, 'lentas': 0.01}, 'por_llamada': 1},
+    # Limitado por el parseo: fichas con descripciones muy largas, sin archivo
+    'parseo': {'mock': {'relleno_texto': 30}, 'por_llamada': 50, 'archivo': False},
+    # Limitado por la escritura: muchas filas pequeñas por ficha
+    'escritura': {'mock': {'filas_extra': 15}, 'por_llamada': 50},
+    # Escritor atascado (2 ms más por ISBN) con fichas grandes: la cola de resultados se
+    # llena y tiene que frenar la descarga sin que crezca la memoria
+    'atasco': {'mock': {'relleno_texto': 30}, 'por_llamada': 50, 'escritor_lento_ms': 2},
+    # Tablas *_normalizado además de las clásicas (filas con secuencias enteras)
+    'normalizado': {'mock': {'filas_extra': 5}, 'por_llamada': 50, 'normalizado': True},
+    # Errores: 503, ISBNs que no existen y respuestas lentas
+    'errores': {'mock': {'latencia_ms': 20, 'errores_http': 0.05, 'faltan': 0.02, 'lentas': 0.02}, 'por_llamada': 50},
+    # Importación del listado de getRecordListX (ListadoISBNsToSQLite.py)
+    'listado': {'mock': {}, 'listado': True},
+}
+
+# Función para crear una base de datos con isbns_libros y n ISBNs pendientes
+def sembrar_bd(ruta, n):
+    conn = sqlite3.connect(ruta)
+    conn.execute('''
+        CREATE TABLE isbns_libros (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            isbn TEXT UNIQUE,
+            fecha_extraccion_dilve TEXT,
+            es_editorial BOOLEAN,
+            fecha_importacion TEXT,
+            procesado INTEGER,
+            fecha_procesado TEXT,
+            modificado INTEGER
+        )
+    ''')
+    conn.execute('CREATE INDEX idx_isbn ON isbns_libros (isbn)')
+    conn.executemany('INSERT INTO isbns_libros (isbn) VALUES (?)', ((str(MockDILVE.ISBN_BASE + i),) for i in range(n)))
+    conn.commit()
+    conn.close()
+
+# Función para el percentil p (0-100) de una lista de valores
+def percentil(valores, p):
+    if not valores:
+        return None
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p / 100))]
+
+# Función para la memoria pico en MB de este proceso y de sus hijos (pool de procesos)
+def rss_pico():
+    if resource is None:
+        try:
+            import psutil
+        except ImportError:
+            return None, None
+        return psutil.Process().memory_info().peak_wset / 2**20, None  # Windows
+    # ru_maxrss está en KB en Linux y en bytes en macOS
+    escala = 2**20 if sys.platform == 'darwin' else 2**10
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / escala,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / escala)
+
+# Función para el tamaño en MB de la base de datos (con su WAL si queda)
+def tamano_bd(ruta):
+    return sum(os.path.getsize(f) for f in (ruta, ruta + '-wal') if os.path.exists(f)) / 2**20
+
+# Función que ejecuta un escenario dentro del proceso hijo y deja el resultado en `salida`
+def medir(carpeta, url_base, n, opciones, salida):
+    os.chdir(carpeta)
+    import ClienteDILVE
+    ClienteDILVE.URL_BASE = url_base
+    latencias = []
+    ClienteDILVE.observador = lambda latencia, fallo: latencias.append(latencia)
+
+    inicio = time.perf_counter()
+    if opciones.get('listado'):
+        import ListadoISBNsToSQLite
+        conn = ListadoISBNsToSQLite.abrir_bd()
+        ListadoISBNsToSQLite.fetch_isbns(conn, 'usuario', 'contraseña', 'getRecordListX_L_ONIX_E')
+        conn.close()
+    else:
+        import DAPI_SQLite_v8
+        DAPI_SQLite_v8.iniciar_logs()
+        if opciones.get('escritor_lento_ms'):
+            guardar_resultado = DAPI_SQLite_v8.guardar_resultado
+
+            def guardar_lento(*argumentos):
+                time.sleep(opciones['escritor_lento_ms'] / 1000)
+                return guardar_resultado(*argumentos)
+            DAPI_SQLite_v8.guardar_resultado = guardar_lento
+        DAPI_SQLite_v8.ISBNS_POR_LLAMADA = opciones.get('por_llamada', DAPI_SQLite_v8.ISBNS_POR_LLAMADA)
+        if opciones.get('fragmentos', 0) > 1:
+            DAPI_SQLite_v8.process_isbn_fragmentos('usuario', 'contraseña', opciones['fragmentos'],
+                                                   opciones.get('hilos', DAPI_SQLite_v8.HILOS), opciones.get('motor', 'hilos'),
+                                                   opciones.get('concurrencia'), None, procesos=opciones.get('procesos', 0),
+                                                   archivo=opciones.get('archivo', True), normalizado=opciones.get('normalizado', False))
+        else:
+            DAPI_SQLite_v8.process_isbn_batches('usuario', 'contraseña', opciones.get('hilos', DAPI_SQLite_v8.HILOS),
+                                                opciones.get('motor', 'hilos'), opciones.get('concurrencia'), None,
+                                                vacuum=False, procesos=opciones.get('procesos', DAPI_SQLite_v8.PROCESOS),
+                                                archivo=opciones.get('archivo', True), normalizado=opciones.get('normalizado', False))
+    segundos = time.perf_counter() - inicio
+
+    conn = sqlite3.connect('book_all_fields.db')
+    if opciones.get('listado'):
+        # El listado solo da de alta ISBNs pendientes: todos los importados cuentan como correctos
+        isbns = conn.execute('SELECT COUNT(*) FROM isbns_libros').fetchone()[0]
+        correctos = isbns
+    else:
+        isbns = conn.execute('SELECT COUNT(*) FROM isbns_libros WHERE procesado IS NOT NULL').fetchone()[0]
+        correctos = conn.execute('SELECT COUNT(*) FROM isbns_libros WHERE procesado = 1').fetchone()[0]
+    conn.close()
+    rss, rss_hijos = rss_pico()
+    # p50/p99 por etapa (peticion, parseo, aplanado, escritura, commit) de MetricasDILVE
+    import MetricasDILVE
+    datos = MetricasDILVE.instantanea()
+    etapas = {nombre: [h['p50'], h['p99']] for nombre, h in datos['histogramas'].items()}
+    cola_bytes = datos['medidores'].get('cola_resultados_bytes_pico')
+    salida.put({
+        'segundos': segundos,
+        'isbns': isbns,
+        'correctos': correctos,
+        'isbns_s': isbns / segundos,
+        'p50_ms': percentil(latencias, 50) * 1000 if latencias else None,
+        'p99_ms': percentil(latencias, 99) * 1000 if latencias else None,
+        'rss_mb': rss,
+        'rss_hijos_mb': rss_hijos,
+        'bd_mb': tamano_bd('book_all_fields.db'),
+        'cola_mb': cola_bytes / 2**20 if cola_bytes is not None else None,
+        'etapas': etapas,
+    })
+
+# Función para ejecutar un escenario en un proceso nuevo (para que el RSS pico sea solo suyo)
+def ejecutar(url_base, n, opciones):
+    contexto = multiprocessing.get_context('spawn')
+    salida = contexto.Queue()
+    with tempfile.TemporaryDirectory() as carpeta:
+        if not opciones.get('listado'):
+            sembrar_bd(os.path.join(carpeta, 'book_all_fields.db'), n)
+        proceso = contexto.Process(target=medir, args=(carpeta, url_base, n, opciones, salida))
+        proceso.start()
+        resultado = salida.get()
+        proceso.join()
+    return resultado
+
+# Función para dar formato a un valor que puede faltar
+def valor(numero, formato='.1f'):
+    return '-' if numero is None else format(numero, formato)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark de DAPI_SQLite_v8.py y ListadoISBNsToSQLite.py contra MockDILVE.py.')
+    parser.add_argument('--escenarios', nargs='+', choices=list(ESCENARIOS), default=list(ESCENARIOS))
+    parser.add_argument('--isbns', type=int, default=5000, help='ISBNs pendientes en la base de datos de prueba (o del listado)')
+    parser.add_argument('--motores', nargs='+', choices=['hilos', 'async'], default=['hilos', 'async'])
+    parser.add_argument('--hilos', type=int, default=10, help='hilos del motor de hilos')
+    parser.add_argument('--concurrencia', type=int, default=200, help='peticiones en vuelo del motor async')
+    parser.add_argument('--procesos', type=int, default=None, help='procesos del aplanado (por defecto uno por núcleo)')
+    parser.add_argument('--fragmentos', type=int, default=0, help='ejecutar DAPI_SQLite_v8 en modo fragmentado con N procesos')
+    parser.add_argument('--latencia-ms', type=float, default=None, help='sustituye la latencia del mock de cada escenario')
+    parser.add_argument('--corpus', help='carpeta con fichas ONIX 3.0 reales que servir en lugar de las sintéticas')
+    parser.add_argument('--json', help='archivo donde guardar los resultados')
+    args = parser.parse_args()
+
+    print(f"{args.isbns} ISBNs por escenario")
+    print(f"{'escenario':<10} {'motor':<6} {'s':>8} {'ISBNs/s':>10} {'correctos':>9} {'p50 ms':>8} {'p99 ms':>8} "
+          f"{'RSS MB':>8} {'hijos MB':>9} {'cola MB':>8} {'BD MB':>8} {'peticiones':>10}")
+    resultados = []
+    for escenario in args.escenarios:
+        ajustes = ESCENARIOS[escenario]
+        mock = dict(ajustes['mock'], corpus=args.corpus, listado=args.isbns)
+        if args.latencia_ms is not None:
+            mock['latencia_ms'] = args.latencia_ms
+        servidor = MockDILVE.iniciar(**mock)
+        url_base = f'http://127.0.0.1:{servidor.server_port}/dilve/dilve'
+
+        for motor in (['-'] if ajustes.get('listado') else args.motores):
+            opciones = dict(ajustes, motor=motor, hilos=args.hilos, concurrencia=args.concurrencia)
+            del opciones['mock']
+            if args.procesos is not None:
+                opciones['procesos'] = args.procesos
+            if args.fragmentos and not ajustes.get('listado'):
+                opciones['fragmentos'] = args.fragmentos
+            peticiones_antes = servidor.peticiones
+            resultado = ejecutar(url_base, args.isbns, opciones)
+            resultado.update(escenario=escenario, motor=motor, peticiones=servidor.peticiones - peticiones_antes)
+            resultados.append(resultado)
+            print(f"{escenario:<10} {motor:<6} {resultado['segundos']:8.2f} {resultado['isbns_s']:10.1f} {resultado['correctos']:>9} "
+                  f"{valor(resultado['p50_ms']):>8} {valor(resultado['p99_ms']):>8} "
+                  f"{valor(resultado['rss_mb']):>8} {valor(resultado['rss_hijos_mb']):>9} {valor(resultado['cola_mb']):>8} "
+                  f"{resultado['bd_mb']:8.1f} {resultado['peticiones']:>10}")
+        servidor.shutdown()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as archivo:
+            json.dump(resultados, archivo, indent=2)
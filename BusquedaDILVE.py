@@ -0,0 +1,165 @@
+import argparse
+import sqlite3
+import time
+import EsquemaSQLite
+
+# Búsqueda de texto completo en book_all_fields.db con el índice FTS5 busqueda
+# (EsquemaSQLite.asegurar_busqueda): título, subtítulo, autores, descripciones y
+# materias de cada ISBN, ordenados por relevancia (bm25).
+# El escritor de DAPI_SQLite_v8.py y ConsultaDILVE.py actualizan el índice con las
+# filas que acaban de guardar (indexar); tras cambios en bloque (fusión de fragmentos,
+# ReconstruirONIX.py) se vuelve a llenar desde las tablas de datos (reindexar).
+
+# Columnas del índice y columnas de las tablas de datos de las que salen: (campo, tabla, columnas)
+CAMPOS_BUSQUEDA = [
+    ('titulo', 'TitleDetail', ('TitleDetail_TitleElement_TitleText', 'TitleDetail_TitleElement_TitlePrefix',
+                               'TitleDetail_TitleElement_TitleWithoutPrefix')),
+    ('subtitulo', 'TitleDetail', ('TitleDetail_TitleElement_Subtitle',)),
+    ('autores', 'Contributor', ('Contributor_PersonName', 'Contributor_PersonNameInverted', 'Contributor_CorporateName',
+                                'Contributor_NamesBeforeKey', 'Contributor_KeyNames')),
+    ('descripcion', 'TextContent', ('TextContent_Text',)),
+    ('materias', 'Subject', ('Subject_SubjectHeadingText',)),
+]
+# Peso de cada columna del índice en bm25 (isbn, titulo, subtitulo, autores, descripcion, materias)
+PESOS = (0, 10, 5, 5, 1, 3)
+LIMITE = 20
+
+# tabla (en minúsculas) -> [(posición del campo, columna)], para sacar el documento de las filas aplanadas
+_columnas_por_tabla = {}
+for _posicion, (_campo, _tabla, _columnas) in enumerate(CAMPOS_BUSQUEDA):
+    for _columna in _columnas:
+        _columnas_por_tabla.setdefault(_tabla.lower(), []).append((_posicion, _columna))
+
+# Función para el documento de un libro a partir de sus filas aplanadas [(tabla, columnas, valores), ...]:
+# tupla con el texto de cada campo de CAMPOS_BUSQUEDA, o None si no tiene ninguno.
+# Columna a columna y, en cada una, fila a fila: el mismo orden que reindexar
+def documento(filas):
+    por_tabla = {}
+    for table_name, columns, values in filas:
+        if table_name.lower() in _columnas_por_tabla:
+            por_tabla.setdefault(table_name.lower(), []).append((columns, values))
+    textos = [[] for _ in CAMPOS_BUSQUEDA]
+    for tabla, filas_tabla in por_tabla.items():
+        for posicion, columna in _columnas_por_tabla[tabla]:
+            for columns, values in filas_tabla:
+                if columna in columns:
+                    valor = values[columns.index(columna)]
+                    if valor:
+                        textos[posicion].append(valor)
+    if not any(textos):
+        return None
+    return tuple(' '.join(texto) if texto else None for texto in textos)
+
+# Función para actualizar en el índice el libro que se acaba de guardar (dentro de la
+# transacción del escritor). id_libro es su id en isbns_libros
+def indexar(cursor, id_libro, isbn, filas):
+    cursor.execute('DELETE FROM busqueda WHERE rowid = ?', (id_libro,))
+    texto = documento(filas)
+    if texto is not None:
+        cursor.execute('''
+            INSERT INTO busqueda (rowid, isbn, titulo, subtitulo, autores, descripcion, materias)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', (id_libro, isbn, *texto))
+
+# Función para la expresión SQL de un campo: sus columnas de las filas del libro, juntas y en orden
+def sql_campo(esquema, table_name, columnas):
+    existentes = esquema.tablas.get(table_name.lower(), set())
+    partes = [f'SELECT {k} AS k, id, {columna} AS v FROM {table_name} WHERE isbn = l.isbn'
+              for k, columna in enumerate(columnas) if columna.lower() in existentes]
+    if not partes:
+        return 'NULL'
+    return f"(SELECT group_concat(v, ' ') FROM ({' UNION ALL '.join(partes)} ORDER BY k, id) WHERE v <> '')"
+
+# Función para volver a llenar el índice desde las tablas de datos, para todos los ISBNs o
+# solo para los de la consulta `isbns` (p. ej. 'SELECT isbn FROM temp.fusion_isbns').
+# No abre ni confirma la transacción; devuelve los ISBNs indexados
+def reindexar(cursor, esquema, isbns=None):
+    if isbns is None:
+        cursor.execute('DELETE FROM busqueda')
+        donde = ''
+    else:
+        cursor.execute(f'DELETE FROM busqueda WHERE rowid IN (SELECT id FROM isbns_libros WHERE isbn IN ({isbns}))')
+        donde = f'WHERE l.isbn IN ({isbns})'
+    campos = ', '.join(f'{sql_campo(esquema, tabla, columnas)} AS {campo}' for campo, tabla, columnas in CAMPOS_BUSQUEDA)
+    nombres = ', '.join(campo for campo, _, _ in CAMPOS_BUSQUEDA)
+    return cursor.execute(f'''
+        INSERT INTO busqueda (rowid, isbn, {nombres})
+        SELECT id, isbn, {nombres}
+        FROM (SELECT l.id, l.isbn, {campos} FROM isbns_libros l {donde} ORDER BY l.id)
+        WHERE COALESCE({nombres}) IS NOT NULL
+    ''').rowcount
+
+# Función para crear (si hace falta) y volver a llenar todo el índice en una transacción
+def reconstruir(conn):
+    EsquemaSQLite.asegurar_busqueda(conn)
+    cursor = conn.cursor()
+    cursor.execute('BEGIN IMMEDIATE')
+    total = reindexar(cursor, EsquemaSQLite.RegistroEsquema(conn))
+    cursor.execute('COMMIT')
+    return total
+
+# Función para pasar un texto libre a una consulta FTS5: cada palabra entre comillas (sin
+# operadores) y todas obligatorias; una palabra acabada en * busca por prefijo
+def consulta_fts(texto):
+    terminos = []
+    for palabra in texto.split():
+        prefijo = palabra.endswith('*') and len(palabra) > 1
+        palabra = palabra.rstrip('*')
+        if palabra:
+            terminos.append('"' + palabra.replace('"', '""') + '"' + ('*' if prefijo else ''))
+    return ' '.join(terminos)
+
+# Función para buscar: devuelve [(isbn, título, puntuación)] de más a menos relevante.
+# Con fts=True el texto se usa tal cual como consulta FTS5 (AND, OR, NOT, "frase", titulo: ...)
+def buscar(conn, texto, limite=LIMITE, fts=False):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'busqueda'").fetchone():
+        raise RuntimeError("La base de datos no tiene índice de búsqueda: ejecute python BusquedaDILVE.py --reconstruir.")
+    consulta = texto if fts else consulta_fts(texto)
+    if not consulta:
+        return []
+    pesos = ', '.join(str(peso) for peso in PESOS)
+    try:
+        return conn.execute(f'''
+            SELECT isbn, titulo, round(-bm25(busqueda, {pesos}), 3)
+            FROM busqueda
+            WHERE busqueda MATCH ?
+            ORDER BY bm25(busqueda, {pesos})
+            LIMIT ?
+        ''', (consulta, limite)).fetchall()
+    except sqlite3.OperationalError as e:
+        raise RuntimeError(f"Consulta de búsqueda no válida ({consulta}): {e}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Busca libros en book_all_fields.db por título, autor, descripción o materia.')
+    parser.add_argument('texto', nargs='?', help='palabras a buscar (todas obligatorias; palabra* busca por prefijo)')
+    parser.add_argument('--db', default='book_all_fields.db', help='base de datos (por defecto book_all_fields.db)')
+    parser.add_argument('--limite', type=int, default=LIMITE, help=f'número máximo de resultados (por defecto {LIMITE})')
+    parser.add_argument('--fts', action='store_true', help='usar el texto como consulta FTS5 tal cual')
+    parser.add_argument('--reconstruir', action='store_true', help='crear o volver a llenar el índice desde las tablas de datos')
+    args = parser.parse_args()
+    if not args.texto and not args.reconstruir:
+        parser.error("Indique el texto a buscar o --reconstruir.")
+
+    if args.reconstruir:
+        conn = sqlite3.connect(args.db, isolation_level=None, timeout=60)
+    else:
+        # Solo lectura: no crea la base de datos si la ruta no existe
+        try:
+            conn = EsquemaSQLite.abrir_lectura(args.db)
+        except sqlite3.OperationalError as e:
+            parser.exit(1, f"No se puede abrir {args.db}: {e}\n")
+    if args.reconstruir:
+        inicio = time.perf_counter()
+        total = reconstruir(conn)
+        print(f"Índice de búsqueda reconstruido: {total} ISBNs en {time.perf_counter() - inicio:.1f} s.")
+    if args.texto:
+        inicio = time.perf_counter()
+        try:
+            resultados = buscar(conn, args.texto, args.limite, args.fts)
+        except RuntimeError as e:
+            parser.exit(1, f"{e}\n")
+        milisegundos = (time.perf_counter() - inicio) * 1000
+        for isbn, titulo, puntuacion in resultados:
+            print(f"{isbn}\t{puntuacion}\t{titulo or ''}")
+        print(f"{len(resultados)} resultados en {milisegundos:.1f} ms.")
+    conn.close()
@@ -0,0 +1,243 @@
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+import MetricasDILVE
+
+# URL base de la API de DILVE
+URL_BASE = 'https://www.dilve.es/dilve/dilve'
+# Separador de identificadores en el parámetro identifier de getRecordsX
+SEPARADOR_IDENTIFICADORES = ','
+
+# Configuración por defecto del cliente HTTP
+TAMANO_POOL = 10
+TIMEOUT_CONEXION = 10
+TIMEOUT_LECTURA = 120
+
+# Reintentos ante errores transitorios (5xx, 429, timeouts, conexión) con espera exponencial y jitter
+INTENTOS = 4
+ESPERA_BASE = 0.5
+ESPERA_MAXIMA = 30
+
+_sesion = None
+_bloqueo = threading.Lock()
+
+# Control de concurrencia compartido por los hilos de descarga (None = sin límite adaptativo)
+control = None
+# Función opcional que recibe (latencia en segundos, fallo) de cada petición a getRecordsX (p. ej. BenchmarkDILVE)
+observador = None
+
+# Error de una llamada a DILVE. Los permanentes (ISBN no encontrado, petición
+# rechazada) no se reintentan; los transitorios sí.
+class ErrorDILVE(Exception):
+    def __init__(self, mensaje, permanente=False):
+        super().__init__(mensaje)
+        self.permanente = permanente
+
+# Función para saber si un código HTTP indica un fallo transitorio
+def es_transitorio(status_code):
+    return status_code >= 500 or status_code in (408, 429)
+
+# Función para anotar el final de cada intento de getRecordsX (hilos y asyncio):
+# latencia y resultado en MetricasDILVE, fallos transitorios por causa y el observador
+def anotar_peticion(latencia, fallo, causa=None):
+    MetricasDILVE.observar('peticion_segundos', latencia)
+    MetricasDILVE.contar('peticiones_total', resultado='fallo' if fallo else 'ok')
+    if causa is not None:
+        MetricasDILVE.contar('fallos_transitorios_total', causa=causa)
+    if observador is not None:
+        observador(latencia, fallo)
+
+# Función para la espera antes de repetir tras el intento n (0, 1, ...): exponencial con jitter completo
+def espera_reintento(intento):
+    return random.uniform(0, min(ESPERA_MAXIMA, ESPERA_BASE * 2 ** intento))
+
+# Control de concurrencia AIMD (aumento aditivo, recorte multiplicativo).
+# El límite de peticiones en vuelo sube en 1 por cada "ronda" de respuestas
+# buenas y se divide por 2 cuando hay errores transitorios o la latencia se
+# dispara respecto a la mínima observada; así se sigue el máximo sostenible
+# de DILVE en lugar de saturarlo durante una degradación.
+class ControlConcurrencia:
+    def __init__(self, inicial, maximo, minimo=1):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.limite = float(max(minimo, min(inicial, maximo)))
+        self.en_vuelo = 0
+        self.latencia_base = {}
+        self.ultimo_recorte = 0.0
+        self._cond = threading.Condition()
+
+    def _puede_entrar(self):
+        return self.en_vuelo < int(self.limite)
+
+    # Función para esperar turno (hilos)
+    def entrar(self):
+        with self._cond:
+            while not self._puede_entrar():
+                self._cond.wait()
+            self.en_vuelo += 1
+
+    # Función para entrar sin esperar; devuelve False si no hay hueco (motor asyncio)
+    def intentar_entrar(self):
+        with self._cond:
+            if self._puede_entrar():
+                self.en_vuelo += 1
+                return True
+            return False
+
+    # Función para registrar el final de una petición; `clase` separa latencias de lotes y de ISBNs sueltos
+    def salir(self, latencia, fallo, clase=None):
+        with self._cond:
+            self.en_vuelo -= 1
+            self._ajustar(latencia, fallo, clase)
+            self._cond.notify_all()
+
+    def _ajustar(self, latencia, fallo, clase):
+        base = self.latencia_base.get(clase)
+        if base is None or latencia < base:
+            self.latencia_base[clase] = latencia
+        elif not fallo:
+            # La base sube despacio si DILVE se vuelve más lento de forma sostenida
+            self.latencia_base[clase] = base + (latencia - base) * 0.01
+        base = self.latencia_base[clase]
+
+        if fallo or latencia > 2 * base + 0.1:
+            # Como mucho un recorte por cada latencia observada, para no hundir el límite en una ráfaga
+            ahora = time.monotonic()
+            if ahora - self.ultimo_recorte > latencia:
+                self.limite = max(self.minimo, self.limite / 2)
+                self.ultimo_recorte = ahora
+                logging.info(f"Concurrencia con DILVE reducida a {int(self.limite)}.")
+        else:
+            self.limite = min(self.maximo, self.limite + 1 / self.limite)
+
+# Función para ajustar el cliente (tamaño del pool y timeouts); descarta la sesión actual
+def configurar(tamano_pool=None, timeout_conexion=None, timeout_lectura=None):
+    global TAMANO_POOL, TIMEOUT_CONEXION, TIMEOUT_LECTURA, _sesion
+    with _bloqueo:
+        if tamano_pool is not None:
+            TAMANO_POOL = tamano_pool
+        if timeout_conexion is not None:
+            TIMEOUT_CONEXION = timeout_conexion
+        if timeout_lectura is not None:
+            TIMEOUT_LECTURA = timeout_lectura
+        if _sesion is not None:
+            _sesion.close()
+            _sesion = None
+
+# Función para obtener la sesión compartida por todos los hilos (se crea la primera vez)
+def obtener_sesion():
+    global _sesion
+    with _bloqueo:
+        if _sesion is None:
+            sesion = requests.Session()
+            # Un único pool de conexiones keep-alive con tantas conexiones como hilos
+            adaptador = HTTPAdapter(pool_connections=1, pool_maxsize=TAMANO_POOL, pool_block=True)
+            sesion.mount('https://', adaptador)
+            sesion.mount('http://', adaptador)
+            sesion.headers['Accept-Encoding'] = 'gzip, deflate'
+            _sesion = sesion
+        return _sesion
+
+# Función para cerrar las conexiones abiertas
+def cerrar():
+    global _sesion
+    with _bloqueo:
+        if _sesion is not None:
+            _sesion.close()
+            _sesion = None
+
+# Función para hacer una llamada GET a una operación de la API
+def get(operacion, params, stream=False):
+    return obtener_sesion().get(url(operacion), params=params, stream=stream,
+                                timeout=(TIMEOUT_CONEXION, TIMEOUT_LECTURA))
+
+# Función para construir la URL de una operación de la API
+def url(operacion):
+    return f'{URL_BASE}/{operacion}.do'
+
+# Función para los parámetros de getRecordsX
+def params_records(user, password, identifiers):
+    return {
+        'user': user,
+        'password': password,
+        'identifier': identifiers,
+        'metadataformat': 'ONIX',
+        'version': '3.0',
+    }
+
+# Función para pedir las fichas ONIX de uno o varios identificadores
+def get_records(user, password, identifiers):
+    return get('getRecordsX', params_records(user, password, identifiers))
+
+# Función para el parámetro identifier de getRecordsX con varios ISBNs
+def identificadores(isbns):
+    return SEPARADOR_IDENTIFICADORES.join(isbns)
+
+# Función para repartir la respuesta de una llamada con varios ISBNs (la de AplanadoONIX.aplanar_respuesta):
+# devuelve ({isbn: resultado} de los que vienen, [ISBNs que faltan]). Los motores de descarga y
+# ConsultaDILVE.py piden después los que faltan de uno en uno
+def repartir_productos(isbns, result):
+    result = result or {}
+    encontrados = {isbn: result[isbn] for isbn in isbns if isbn in result}
+    pendientes = [isbn for isbn in isbns if isbn not in encontrados]
+    if pendientes:
+        logging.info(f"{len(pendientes)} ISBNS sin respuesta en el lote, se piden individualmente.")
+    return encontrados, pendientes
+
+# Función para pedir las fichas ONIX con reintentos de los fallos transitorios.
+# Devuelve el contenido de la respuesta o lanza ErrorDILVE.
+def pedir_records(user, password, identifiers):
+    clase = 'lote' if SEPARADOR_IDENTIFICADORES in identifiers else 'isbn'
+    for intento in range(INTENTOS):
+        if intento:
+            time.sleep(espera_reintento(intento - 1))
+        if control is not None:
+            control.entrar()
+        inicio = time.monotonic()
+        fallo = True
+        causa = None
+        try:
+            response = get_records(user, password, identifiers)
+            if es_transitorio(response.status_code):
+                error = ErrorDILVE(f"Error HTTP {response.status_code} de DILVE")
+                causa = f'http_{response.status_code}'
+            elif response.status_code >= 400:
+                fallo = False
+                raise ErrorDILVE(f"Petición rechazada por DILVE (HTTP {response.status_code})", permanente=True)
+            else:
+                content = response.content
+                fallo = False
+                return content
+        except requests.RequestException as e:
+            error = ErrorDILVE(f"Error en la llamada a DILVE: {e}")
+            causa = 'timeout' if isinstance(e, requests.Timeout) else 'conexion'
+        finally:
+            latencia = time.monotonic() - inicio
+            if control is not None:
+                control.salir(latencia, fallo, clase)
+            anotar_peticion(latencia, fallo, causa)
+        logging.warning(f"{error}. Intento {intento + 1} de {INTENTOS}.")
+    raise error
+
+# Función para pedir el listado de ISBNs de un programa
+def get_record_list(user, password, program, stream=False):
+    return get('getRecordListX', {
+        'user': user,
+        'password': password,
+        'type': 'L',
+        'program': program,
+    }, stream=stream)
+
+# Función para pedir el listado de registros dados de alta, modificados o de baja desde una fecha
+def get_record_list_desde(user, password, from_date, to_date=None, stream=False):
+    params = {
+        'user': user,
+        'password': password,
+        'fromDate': from_date,
+    }
+    if to_date:
+        params['toDate'] = to_date
+    return get('getRecordListX', params, stream=stream)
@@ -0,0 +1,34 @@
+import json
+import sys
+import urllib.error
+import urllib.request
+
+# Cliente del servicio residente de ConsultaDILVE.py (ConsultaDILVE.py usuario contraseña --servidor).
+# Solo usa la biblioteca estándar para arrancar rápido desde ConsultaDilve.bat.
+# Códigos de salida: 0 procesado, 1 error en el procesamiento, 2 servicio no disponible
+# (ConsultaDilve.bat hace entonces la consulta directa).
+# Uso: python ConsultaCliente.py <isbn> [puerto] [--forzar]
+
+PUERTO = 8766
+
+if __name__ == '__main__':
+    argumentos = [a for a in sys.argv[1:] if a != '--forzar']
+    if not argumentos:
+        print("Uso: python ConsultaCliente.py <isbn> [puerto] [--forzar]")
+        sys.exit(1)
+    isbn = argumentos[0].strip().replace('"', '')
+    puerto = int(argumentos[1]) if len(argumentos) > 1 and argumentos[1] else PUERTO
+    forzar = '&forzar=1' if '--forzar' in sys.argv else ''
+
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{puerto}/consulta?isbn={isbn}{forzar}', timeout=300) as respuesta:
+            datos = json.load(respuesta)
+    except (urllib.error.URLError, ConnectionError):
+        sys.exit(2)
+
+    if datos.get('correcto'):
+        origen = 'base de datos local' if datos.get('origen') == 'local' else 'DILVE'
+        print(f"Procesamiento completado ({origen}, {datos.get('ms')} ms).")
+        sys.exit(0)
+    print("Error en el procesamiento.")
+    sys.exit(1)
@@ -1,216 +1,418 @@
+import time
+# Instante de arranque del script, para --perfil
+INICIO = time.perf_counter()
 import sqlite3
-import requests
-import xml.etree.ElementTree as ET
 import logging
+import argparse
+import json
 import sys
+import threading
 import os
-from datetime import datetime
-
-# Verificación de credenciales y ISBN
-if len(sys.argv) != 4:
-    print("\nDebe proporcionar usuario, contraseña e ISBN como argumentos:")
-    print("python .\\DAPI_SQLite.py <usuario> <contraseña> <isbn>\n")
-    sys.exit(1)
-user = sys.argv[1]
-password = sys.argv[2]
-isbn = sys.argv[3]
-
-# Crear la carpeta de logs si no existe
-log_dir = 'logs'
-os.makedirs(log_dir, exist_ok=True)
-
-# Configurar el registro inicial
-log_filename = os.path.join(log_dir, 'logs_dapi_sqlite.txt')
-logging.basicConfig(filename=log_filename, level=logging.INFO, 
-                    format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
-# Conectar a la base de datos SQLite
-conn = sqlite3.connect('book_all_fields.db')
-cursor = conn.cursor()
-
-# Crear tabla isbns_libros si no existe
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS isbns_libros (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        isbn TEXT UNIQUE,
-        fecha_extraccion_dilve TEXT,
-        es_editorial BOOLEAN,
-        fecha_importacion TEXT,
-        procesado INTEGER,
-        fecha_procesado TEXT
-    )
-''')
-cursor.execute('CREATE INDEX IF NOT EXISTS idx_isbn ON isbns_libros (isbn)')
-conn.commit()
-
-# Función para parsear las fichas de los libros (xmls)
-def parse_book_info(xml_content, isbn):
-    root = ET.fromstring(xml_content)
-    if root.find('.//{http://www.dilve.es/dilve/api/xsd/getRecordsXResponse}error') is not None:
-        return None  # Devolver None si hay un error
-    namespace = {'onix': 'http://ns.editeur.org/onix/3.0/reference'}
-    product_infos = root.findall('.//onix:Product', namespace)
-
-    result = []
-    for product_info in product_infos:
-        result.append(('libros', isbn, product_info))
-        for child in product_info:
-            child_tag = child.tag.split('}')[1] if '}' in child.tag else child.tag
-            if len(child) > 0:
-                result.append((child_tag, isbn, child))
-    return result
-
-# Función para introducir datos en las tablas
-def insert_into_table(cursor, table_name, isbn, element):
-    columns = {f"{child.tag.split('}')[1] if '}' in child.tag else child.tag}": child.text.strip() for child in element if child.text is not None}
-    
-    if not columns:
-        return None
-
-    column_names = ', '.join(columns.keys())
-    placeholders = ', '.join(['?' for _ in columns])
-    
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table_name} (
-                        id INTEGER PRIMARY KEY,
-                        isbn TEXT,
-                        {column_names}
-                    )''')
-    for column in columns.keys():
-        try:
-            cursor.execute(f'''ALTER TABLE {table_name} ADD COLUMN {column} TEXT''')
-        except sqlite3.OperationalError:
-            pass
+from datetime import datetime, timedelta
+import BusquedaDILVE
+import EsquemaSQLite
+# ClienteDILVE (requests), AplanadoONIX (ElementTree) y http.server se importan solo
+# cuando hacen falta: un ISBN que ya está fresco en la base de datos no los necesita
 
-    cursor.execute(f'''INSERT OR IGNORE INTO {table_name} (isbn, {column_names})
-                       VALUES (?, {placeholders})''', [isbn] + list(columns.values()))
-    return cursor.lastrowid
-
-# Función para manejar los elementos específicos y agregar tablas adicionales
-def handle_specific_elements(cursor, isbn, element, element_tag):
-    nested_data = {}
-    
-    # Procesar todos los niveles de anidación del XML
-    def process_element(element, parent_tag):
-        for child in element:
-            child_tag = f"{parent_tag}_{child.tag.split('}')[1] if '}' in child.tag else child.tag}".strip('_')
-            if len(child) > 0:
-                process_element(child, child_tag)
-            else:
-                if child_tag not in nested_data:
-                    nested_data[child_tag] = []
-                nested_data[child_tag].append(child.text.strip() if child.text else '')
+# Horas durante las que un ISBN ya guardado se da por bueno sin volver a pedirlo a DILVE
+TTL_HORAS = 24
+# Puerto del servicio residente (solo escucha en 127.0.0.1)
+PUERTO = 8766
+# ISBNs por llamada a getRecordsX en el modo --lote (como DAPI_SQLite_v8.py)
+ISBNS_POR_LLAMADA = 50
 
-    process_element(element, element_tag)
+# URL base de la API indicada con --url-base (None = la de ClienteDILVE)
+url_base = None
 
-    if not nested_data:
-        return None
+# Segundos de cada etapa de la ejecución, en el orden en que aparecen (--perfil)
+tiempos = {}
+_ultima_marca = INICIO
 
-    column_names = ', '.join(nested_data.keys())
-    placeholders = ', '.join(['?' for _ in nested_data])
-    
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {element_tag} (
-                        id INTEGER PRIMARY KEY,
-                        isbn TEXT,
-                        {column_names}
-                    )''')
+# Función para anotar en `tiempos` lo transcurrido desde la marca anterior como parte de `etapa`
+def marcar(etapa):
+    global _ultima_marca
+    ahora = time.perf_counter()
+    tiempos[etapa] = tiempos.get(etapa, 0.0) + ahora - _ultima_marca
+    _ultima_marca = ahora
 
-    for column in nested_data.keys():
-        try:
-            cursor.execute(f'''ALTER TABLE {element_tag} ADD COLUMN {column} TEXT''')
-        except sqlite3.OperationalError:
-            pass
+# Función para escribir en stderr el desglose de tiempos de --perfil
+def informe_perfil():
+    total = time.perf_counter() - INICIO
+    for etapa, segundos in tiempos.items():
+        print(f"{etapa:<24} {segundos * 1000:8.1f} ms", file=sys.stderr)
+    print(f"{'total':<24} {total * 1000:8.1f} ms", file=sys.stderr)
 
-    nested_data = {k: ' ; '.join(v) for k, v in nested_data.items()}
-    cursor.execute(f'''INSERT OR IGNORE INTO {element_tag} (isbn, {column_names})
-                       VALUES (?, {placeholders})''', [isbn] + list(nested_data.values()))
-
-# Función para poner los datos de los hijos anidados en tablas
-def insert_nested_table(cursor, table_name, isbn, element, parent_tag=''):
-    nested_data = {}
-    
-    # Procesar todos los niveles de anidación del XML
-    def process_element(element, parent_tag):
-        for child in element:
-            child_tag = f"{parent_tag}_{child.tag.split('}')[1] if '}' in child.tag else child.tag}".strip('_')
-            if len(child) > 0:
-                # Verificar si el child_tag es uno de los específicos
-                if child.tag.split('}')[1] in ['Measure', 'Contributor', 'TitleDetail', 'TextContent', 'PublishingDate', 'Language', 'Subject', 'SupportingResource', 'Audience', 'AudienceRange','Publisher', 'Extent', 'SupplyDetail','RelatedProduct']:
-                    handle_specific_elements(cursor, isbn, child, child.tag.split('}')[1])
-                else:
-                    process_element(child, child_tag)
-            else:
-                if child_tag not in nested_data:
-                    nested_data[child_tag] = []
-                nested_data[child_tag].append(child.text.strip() if child.text else '')
+marcar('importaciones')
 
-    process_element(element, parent_tag)
+# Función para importar ClienteDILVE la primera vez que hay que llamar a DILVE
+def cliente_dilve():
+    import ClienteDILVE
+    if url_base:
+        ClienteDILVE.URL_BASE = url_base
+    return ClienteDILVE
 
-    if not nested_data:
-        return None
+# Función para configurar el registro
+def iniciar_logs():
+    # Crear la carpeta de logs si no existe
+    log_dir = 'logs'
+    os.makedirs(log_dir, exist_ok=True)
+    log_filename = os.path.join(log_dir, 'logs_dapi_sqlite.txt')
+    logging.basicConfig(filename=log_filename, level=logging.INFO,
+                        format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
-    column_names = ', '.join(nested_data.keys())
-    placeholders = ', '.join(['?' for _ in nested_data])
-    
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table_name} (
-                        id INTEGER PRIMARY KEY,
-                        isbn TEXT,
-                        {column_names}
-                    )''')
+# Función para conectar a la base de datos SQLite y crear isbns_libros y onix_crudo si no existen.
+# Si el esquema no ha cambiado desde la última vez se toma de la caché (EsquemaSQLite.SUFIJO_CACHE)
+# y no se lanza ningún DDL
+def abrir_bd(ruta='book_all_fields.db', check_same_thread=True):
+    conn = sqlite3.connect(ruta, check_same_thread=check_same_thread)
+    esquema = EsquemaSQLite.RegistroEsquema.desde_cache(conn, ruta)
+    completo = esquema is not None and esquema.existe('onix_crudo') and all(
+        columna in esquema.tablas.get('isbns_libros', ()) for columna, _ in EsquemaSQLite.COLUMNAS_ISBNS_LIBROS)
+    if not completo:
+        EsquemaSQLite.asegurar_isbns_libros(conn)
+        EsquemaSQLite.asegurar_onix_crudo(conn)
+        esquema = EsquemaSQLite.RegistroEsquema(conn)
+        esquema.guardar_cache(conn, ruta)
+    return conn, esquema
 
-    for column in nested_data.keys():
+# Función para saber si un ISBN está guardado y se descargó hace menos de ttl_horas.
+# fecha_procesado (la del último cambio) la escriben este script ('%Y-%m-%d %H:%M:%S') y
+# DAPI_SQLite_v8.py (sin espacio); si la ficha se volvió a descargar sin cambios, la fecha
+# de esa descarga es la de onix_crudo
+def esta_fresco(cursor, isbn, ttl_horas):
+    fila = cursor.execute('''
+        SELECT l.fecha_procesado, c.fecha_descarga
+        FROM isbns_libros l LEFT JOIN onix_crudo c ON c.isbn = l.isbn
+        WHERE l.isbn = ? AND l.procesado = 1
+    ''', (isbn,)).fetchone()
+    if fila is None:
+        return False
+    fechas = []
+    for valor in fila:
         try:
-            cursor.execute(f'''ALTER TABLE {table_name} ADD COLUMN {column} TEXT''')
-        except sqlite3.OperationalError:
+            fechas.append(datetime.strptime(valor.replace(' ', ''), '%Y-%m-%d%H:%M:%S'))
+        except (AttributeError, ValueError):
             pass
+    return bool(fechas) and datetime.now() - max(fechas) < timedelta(hours=ttl_horas)
 
-    nested_data = {k: ' ; '.join(v) for k, v in nested_data.items()}
-    cursor.execute(f'''INSERT OR IGNORE INTO {table_name} (isbn, {column_names})
-                       VALUES (?, {placeholders})''', [isbn] + list(nested_data.values()))
+# Función para la comprobación local previa a cualquier llamada a DILVE: los ISBNs de `isbns`
+# que están frescos, con una conexión de solo lectura que no crea ni modifica nada
+def isbns_frescos(ruta, isbns, ttl_horas):
+    try:
+        conn = EsquemaSQLite.abrir_lectura(ruta)
+        try:
+            cursor = conn.cursor()
+            return {isbn for isbn in isbns if esta_fresco(cursor, isbn, ttl_horas)}
+        finally:
+            conn.close()
+    except sqlite3.OperationalError:
+        # Base de datos que no existe todavía o sin isbns_libros
+        return set()
 
-# Función para procesar un ISBN
-def process_isbn(isbn):
-    url_book_info = f"https://www.dilve.es/dilve/dilve/getRecordsX.do?user={user}&password={password}&identifier={isbn}&metadataformat=ONIX&version=3.0"
-    
+# Función para procesar un ISBN: lo pide a DILVE y lo guarda, sustituyendo lo que hubiera
+def process_isbn(conn, esquema, user, password, isbn, bloqueo=None):
+    import AplanadoONIX
+    ClienteDILVE = cliente_dilve()
+    marcar('importaciones_dilve')
     logging.info(f"Procesando ISBN: {isbn}")
-    response = requests.get(url_book_info)
-    if response.status_code == 200:
+    # Los fallos transitorios se reintentan dentro de pedir_records
+    try:
+        content = ClienteDILVE.pedir_records(user, password, isbn)
+    except ClienteDILVE.ErrorDILVE as e:
+        marcar('dilve')
+        logging.error(f"No se pudo obtener información para ISBN {isbn}: {e}")
+        return False
+    marcar('dilve')
+    # La escritura va bajo el bloqueo del servicio, que comparte la conexión entre hilos
+    with bloqueo or threading.Lock():
         try:
-            result = parse_book_info(response.content, isbn)
-            if result is None:  # Manejar el caso donde hay un error en el XML
-                logging.error(f"Error en el XML para ISBN {isbn}")
-                return False
-            else:
-                # Insertar ISBN en la tabla isbns_libros
-                fecha_extraccion_dilve = datetime.now().strftime('%d%m%Y')
-                es_editorial = 1
-                fecha_importacion = datetime.now().strftime('%d%m%Y')
-                procesado = 1
-                fecha_procesado = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                cursor.execute('''
-                    INSERT OR IGNORE INTO isbns_libros (isbn, fecha_extraccion_dilve, es_editorial, fecha_importacion, procesado, fecha_procesado)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (isbn, fecha_extraccion_dilve, es_editorial, fecha_importacion, procesado, fecha_procesado))
-                
-                for table_name, isbn, element in result:
-                    if table_name == 'libros':
-                        insert_into_table(cursor, table_name, isbn, element)
-                    else:
-                        insert_nested_table(cursor, table_name, isbn, element)
-                conn.commit()
-                logging.info(f"ISBN {isbn} procesado correctamente.")
-                return True
+            # El mismo aplanado que DAPI_SQLite_v8.py (AplanadoONIX)
+            result = AplanadoONIX.aplanar_respuesta(content, isbn, archivar=True)
+            marcar('aplanado')
         except Exception as e:
             logging.error(f"Error procesando ISBN {isbn}: {e}")
             return False
-    else:
-        logging.error(f"No se pudo obtener información para ISBN: {isbn}")
+        if result is None:  # Manejar el caso donde hay un error en el XML
+            logging.error(f"Error en el XML para ISBN {isbn}")
+            return False
+        filas, crudo = result.get(isbn, ([], None))
+        return guardar_aplanado(conn, esquema, isbn, filas, crudo)
+
+# Función para guardar un libro ya aplanado; si falla deshace la transacción y devuelve False
+def guardar_aplanado(conn, esquema, isbn, filas, crudo):
+    try:
+        guardar_libro(conn, esquema, isbn, filas, crudo)
+        marcar('escritura')
+        logging.info(f"ISBN {isbn} procesado correctamente.")
+        return True
+    except Exception as e:
+        conn.rollback()
+        esquema.recargar(conn)
+        logging.error(f"Error procesando ISBN {isbn}: {e}")
         return False
 
-# Ejecutar el procesamiento del ISBN
-if process_isbn(isbn):
-    print("Procesamiento completado.")
-else:
-    print("Error en el procesamiento.")
+# Función para procesar varios ISBNs con una llamada a getRecordsX por cada ISBNS_POR_LLAMADA.
+# Los que no vuelven en la respuesta del lote se piden de uno en uno (ClienteDILVE.repartir_productos,
+# como en los motores de DAPI_SQLite_v8.py); si DILVE no responde
+# (tras los reintentos de ClienteDILVE) se dan por fallidos todos los del lote.
+# Devuelve {isbn: correcto}
+def procesar_lote(conn, esquema, user, password, isbns):
+    import xml.etree.ElementTree as ET
+    import AplanadoONIX
+    ClienteDILVE = cliente_dilve()
+    marcar('importaciones_dilve')
+    correctos = {}
+    for primero in range(0, len(isbns), ISBNS_POR_LLAMADA):
+        lote = isbns[primero:primero + ISBNS_POR_LLAMADA]
+        if len(lote) == 1:
+            correctos[lote[0]] = process_isbn(conn, esquema, user, password, lote[0])
+            continue
+        logging.info(f"Procesando {len(lote)} ISBNs en una llamada.")
+        result = None
+        try:
+            content = ClienteDILVE.pedir_records(user, password, ClienteDILVE.identificadores(lote))
+            marcar('dilve')
+            result = AplanadoONIX.aplanar_respuesta(content, lote, archivar=True)
+            marcar('aplanado')
+        except ET.ParseError as e:
+            marcar('aplanado')
+            logging.warning(f"Error parseando el XML del lote de {len(lote)} ISBNs: {e}")
+        except ClienteDILVE.ErrorDILVE as e:
+            marcar('dilve')
+            if not e.permanente:
+                logging.error(f"Lote de {len(lote)} ISBNs sin respuesta de DILVE: {e}")
+                correctos.update((isbn, False) for isbn in lote)
+                continue
+            logging.warning(f"Error en la llamada a DILVE para el lote de {len(lote)} ISBNs: {e}")
+        encontrados, pendientes = ClienteDILVE.repartir_productos(lote, result)
+        for isbn, (filas, crudo) in encontrados.items():
+            correctos[isbn] = guardar_aplanado(conn, esquema, isbn, filas, crudo)
+        for isbn in pendientes:
+            correctos[isbn] = process_isbn(conn, esquema, user, password, isbn)
+    return correctos
+
+# Función para guardar un libro en una transacción; si ya estaba se reescribe como en
+# DAPI_SQLite_v8.py (RegistroEsquema.reescribir: solo se tocan las tablas donde tiene filas).
+# La ficha se archiva en onix_crudo como en DAPI_SQLite_v8.py, para que ReconstruirONIX.py
+# y la comparación de hashes partan de la última versión descargada; si su hash es el de la
+# archivada no se reescribe nada y fecha_procesado (la que exporta ExportarFileMaker.py) no cambia
+def guardar_libro(conn, esquema, isbn, filas, crudo):
+    cursor = conn.cursor()
+    # El registro del servicio dura lo que el proceso: si DAPI_SQLite_v8.py u otro script ha
+    # creado tablas o columnas desde entonces, se vuelve a leer antes de escribir
+    esquema.refrescar(conn)
+    fecha_extraccion_dilve = datetime.now().strftime('%d%m%Y')
+    es_editorial = 1
+    fecha_importacion = datetime.now().strftime('%d%m%Y')
+    procesado = 1
+    fecha_procesado = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    previo = cursor.execute('''
+        SELECT l.procesado, c.hash FROM isbns_libros l JOIN onix_crudo c ON c.isbn = l.isbn WHERE l.isbn = ?
+    ''', (isbn,)).fetchone()
+    sin_cambios = crudo is not None and previo == (1, crudo[0])
+    cursor.execute('''
+        INSERT INTO isbns_libros (isbn, fecha_extraccion_dilve, es_editorial, fecha_importacion, procesado, fecha_procesado)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (isbn) DO UPDATE SET procesado = 1, modificado = 0, intentos = 0, reintentar_desde = NULL,
+                                         fecha_procesado = CASE WHEN ? THEN COALESCE(fecha_procesado, excluded.fecha_procesado)
+                                                                ELSE excluded.fecha_procesado END
+    ''', (isbn, fecha_extraccion_dilve, es_editorial, fecha_importacion, procesado, fecha_procesado, sin_cambios))
+    if sin_cambios:
+        cursor.execute('UPDATE onix_crudo SET fecha_descarga = ? WHERE isbn = ?', (fecha_procesado, isbn))
+        conn.commit()
+        return
+
+    esquema.reescribir(cursor, isbn, filas)
+    if esquema.existe('busqueda'):
+        id_libro = cursor.execute('SELECT id FROM isbns_libros WHERE isbn = ?', (isbn,)).fetchone()[0]
+        BusquedaDILVE.indexar(cursor, id_libro, isbn, filas)
+    if crudo is not None:
+        cursor.execute('''
+            INSERT OR REPLACE INTO onix_crudo (isbn, hash, compresion, xml, fecha_descarga)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (isbn, *crudo, fecha_procesado))
+    conn.commit()
+
+# Función para consultar un ISBN: de la base de datos si está fresco, si no de DILVE.
+# Devuelve (correcto, origen) con origen 'local' o 'dilve'
+def consultar(conn, esquema, user, password, isbn, ttl_horas=TTL_HORAS, forzar=False, bloqueo=None):
+    if not forzar:
+        with bloqueo or threading.Lock():
+            fresco = esta_fresco(conn.cursor(), isbn, ttl_horas)
+        if fresco:
+            logging.info(f"ISBN {isbn} servido desde la base de datos.")
+            return True, 'local'
+    return process_isbn(conn, esquema, user, password, isbn, bloqueo), 'dilve'
+
+# Función para consultar uno o varios ISBNs en un solo proceso: primero la comprobación local
+# de solo lectura y después, solo si queda alguno por pedir, la base de datos para escribir
+# y DILVE. Devuelve {isbn: (correcto, origen)} en el orden de `isbns`
+def consultar_isbns(user, password, isbns, ttl_horas=TTL_HORAS, forzar=False, ruta='book_all_fields.db'):
+    frescos = set() if forzar else isbns_frescos(ruta, isbns, ttl_horas)
+    marcar('comprobacion_local')
+    for isbn in frescos:
+        logging.info(f"ISBN {isbn} servido desde la base de datos.")
+    pendientes = [isbn for isbn in isbns if isbn not in frescos]
+    correctos = {}
+    if pendientes:
+        conn, esquema = abrir_bd(ruta)
+        marcar('apertura_bd')
+        correctos = procesar_lote(conn, esquema, user, password, pendientes)
+        # Las tablas o columnas nuevas de estas fichas quedan en la caché para la próxima vez
+        esquema.guardar_cache(conn, ruta)
+        conn.close()
+        marcar('cierre_bd')
+    return {isbn: (True, 'local') if isbn in frescos else (correctos[isbn], 'dilve') for isbn in isbns}
+
+# Función para leer los ISBNs del modo --lote: uno por línea de `origen` (una ruta, o '-' para
+# la entrada estándar), sin comillas ni líneas vacías y sin repetir
+def leer_lote(origen):
+    if origen == '-':
+        lineas = sys.stdin.read().splitlines()
+    else:
+        with open(origen, encoding='utf-8-sig') as archivo:
+            lineas = archivo.read().splitlines()
+    return list(dict.fromkeys(isbn for isbn in (linea.strip().replace('"', '') for linea in lineas) if isbn))
+
+# Función para la clase del manejador del servicio residente (http.server solo se importa con --servidor).
+# El servicio mantiene abiertas la base de datos y la sesión HTTP con DILVE.
+# GET /consulta?isbn=...[&forzar=1] devuelve {"isbn", "correcto", "origen", "ms"}
+# GET /buscar?q=...[&limite=20] devuelve {"resultados": [{"isbn", "titulo", "puntuacion"}, ...], "ms"}
+def manejador_consultas():
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import urlparse, parse_qs
+
+    class ManejadorConsultas(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            servidor = self.server
+            if url.path == '/consulta' and params.get('isbn'):
+                inicio = datetime.now()
+                isbn = params['isbn'][0].strip().replace('"', '')
+                correcto, origen = consultar(servidor.conn, servidor.esquema, servidor.user, servidor.password, isbn,
+                                             servidor.ttl_horas, params.get('forzar', ['0'])[0] == '1', servidor.bloqueo)
+                self.responder(200, {'isbn': isbn, 'correcto': correcto, 'origen': origen,
+                                     'ms': round((datetime.now() - inicio).total_seconds() * 1000, 1)})
+            elif url.path == '/buscar' and params.get('q'):
+                inicio = datetime.now()
+                try:
+                    with servidor.bloqueo:
+                        resultados = BusquedaDILVE.buscar(servidor.conn, params['q'][0],
+                                                          int(params.get('limite', [BusquedaDILVE.LIMITE])[0]))
+                except (RuntimeError, ValueError, sqlite3.Error) as e:
+                    self.responder(400, {'correcto': False, 'error': str(e)})
+                    return
+                self.responder(200, {'resultados': [{'isbn': isbn, 'titulo': titulo, 'puntuacion': puntuacion}
+                                                    for isbn, titulo, puntuacion in resultados],
+                                     'ms': round((datetime.now() - inicio).total_seconds() * 1000, 1)})
+            elif url.path == '/salud':
+                self.responder(200, {'correcto': True})
+            else:
+                self.responder(404, {'correcto': False})
+
+        def responder(self, estado, datos):
+            cuerpo = json.dumps(datos).encode('utf-8')
+            self.send_response(estado)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ManejadorConsultas
+
+# Función para arrancar el servicio residente (bloquea hasta Ctrl+C)
+def servir(user, password, puerto=PUERTO, ttl_horas=TTL_HORAS):
+    from http.server import ThreadingHTTPServer
+    ClienteDILVE = cliente_dilve()
+    conn, esquema = abrir_bd(check_same_thread=False)
+    esquema.migrar_indices(conn)
+    servidor = ThreadingHTTPServer(('127.0.0.1', puerto), manejador_consultas())
+    servidor.daemon_threads = True
+    servidor.conn = conn
+    servidor.esquema = esquema
+    servidor.bloqueo = threading.Lock()
+    servidor.user = user
+    servidor.password = password
+    servidor.ttl_horas = ttl_horas
+    # La sesión de ClienteDILVE se crea ya para que la primera consulta no pague la conexión
+    ClienteDILVE.obtener_sesion()
+    logging.info(f"Servicio de consultas escuchando en 127.0.0.1:{puerto} (TTL {ttl_horas} h).")
+    print(f"Servicio de consultas escuchando en http://127.0.0.1:{puerto}/consulta?isbn=... (Ctrl+C para salir)")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    servidor.server_close()
+    ClienteDILVE.cerrar()
+    conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Consulta un ISBN en DILVE y lo guarda en book_all_fields.db.')
+    parser.add_argument('usuario', nargs='?', help='usuario de DILVE (no hace falta con --buscar)')
+    parser.add_argument('password', nargs='?', metavar='contraseña', help='contraseña de DILVE')
+    parser.add_argument('isbn', nargs='?', help='ISBN a consultar (no se indica con --servidor ni con --lote)')
+    parser.add_argument('--lote', metavar='ARCHIVO',
+                        help="consultar los ISBNs de un archivo, uno por línea ('-' para la entrada estándar), en un solo proceso")
+    parser.add_argument('--servidor', action='store_true',
+                        help='quedarse en marcha como servicio local para ConsultaCliente.py')
+    parser.add_argument('--puerto', type=int, default=PUERTO, help=f'puerto del servicio (por defecto {PUERTO})')
+    parser.add_argument('--ttl-horas', type=float, default=TTL_HORAS,
+                        help=f'horas que un ISBN guardado se sirve sin volver a DILVE (por defecto {TTL_HORAS})')
+    parser.add_argument('--forzar', action='store_true', help='pedir el ISBN a DILVE aunque esté guardado')
+    parser.add_argument('--buscar', metavar='TEXTO',
+                        help='buscar en la base de datos por título, autor, descripción o materia (sin llamar a DILVE)')
+    parser.add_argument('--limite', type=int, default=BusquedaDILVE.LIMITE, help='resultados de --buscar')
+    parser.add_argument('--perfil', '--profile', action='store_true',
+                        help='escribir en la salida de errores el tiempo de cada etapa del arranque y de la consulta')
+    parser.add_argument('--url-base', help='URL base de la API (para pruebas contra MockDILVE.py)')
+    args = parser.parse_args()
+    if args.buscar is None and (not args.password or (not args.servidor and not args.isbn and not args.lote)):
+        parser.error("Debe proporcionar usuario, contraseña e ISBN (o --lote, --servidor o --buscar).")
+
+    iniciar_logs()
+    url_base = args.url_base
+    marcar('argumentos')
+
+    codigo = 0
+    if args.buscar is not None:
+        # Solo lectura: no hace falta crear nada en la base de datos
+        try:
+            conn = EsquemaSQLite.abrir_lectura()
+            resultados = BusquedaDILVE.buscar(conn, args.buscar, args.limite)
+        except (RuntimeError, sqlite3.OperationalError) as e:
+            parser.exit(1, f"{e}\n")
+        for isbn, titulo, puntuacion in resultados:
+            print(f"{isbn}\t{puntuacion}\t{titulo or ''}")
+        conn.close()
+    elif args.servidor:
+        servir(args.usuario, args.password, args.puerto, args.ttl_horas)
+    elif args.lote:
+        # Una línea por ISBN, en el orden del archivo: isbn, ok/error y origen (local o dilve)
+        try:
+            isbns = leer_lote(args.lote)
+        except OSError as e:
+            parser.exit(1, f"No se puede leer {args.lote}: {e}\n")
+        resultados = consultar_isbns(args.usuario, args.password, isbns, args.ttl_horas, args.forzar)
+        for isbn, (correcto, origen) in resultados.items():
+            print(f"{isbn}\t{'ok' if correcto else 'error'}\t{origen}")
+        errores = sum(1 for correcto, _ in resultados.values() if not correcto)
+        print(f"{len(resultados)} ISBNs consultados, {errores} con error.", file=sys.stderr)
+        codigo = 1 if errores else 0
+    else:
+        # Ejecutar el procesamiento del ISBN
+        isbn = args.isbn.strip().replace('"', '')
+        correcto, _ = consultar_isbns(args.usuario, args.password, [isbn], args.ttl_horas, args.forzar)[isbn]
+        if correcto:
+            print("Procesamiento completado.")
+        else:
+            print("Error en el procesamiento.")
 
-# Cerrar la conexión
-conn.close()
+    if args.perfil:
+        informe_perfil()
+    sys.exit(codigo)
@@ -14,6 +14,11 @@ REM Agregar una línea de depuración para ver el comando exacto que se está ej
 echo Ejecutando la consulta, espere por favor...
 
 
-REM Ejecutar el script de Python con los parámetros leídos y el ISBN
-%PYTHON_PATH_ConsultaDilve% %SCRIPT_PATH_ConsultaDilve% %USER% %PASSWORD% %isbn%
+REM Preguntar primero al servicio residente (ConsultaDilveServidor.bat)
+%PYTHON_PATH_ConsultaDilve% %CLIENTE_PATH_ConsultaDilve% %isbn% %PUERTO_ConsultaDilve%
+
+REM Si el servicio no está en marcha, ejecutar el script de Python con los parámetros leídos y el ISBN
+if errorlevel 2 (
+    %PYTHON_PATH_ConsultaDilve% %SCRIPT_PATH_ConsultaDilve% %USER% %PASSWORD% %isbn%
+)
 pause
@@ -0,0 +1,14 @@
+@echo off
+
+REM Leer las variables de configuración desde config.txt
+for /F "tokens=1,2 delims==" %%A in (config.txt) do (
+    set %%A=%%B
+)
+
+REM Consultar en un solo proceso los ISBNs del archivo indicado (uno por línea) y dejar
+REM el resultado de cada uno (isbn, ok/error, local/dilve) en el segundo archivo
+set "lote=%~1"
+set "resultados=%~2"
+if "%resultados%"=="" set "resultados=resultados_lote.txt"
+
+%PYTHON_PATH_ConsultaDilve% %SCRIPT_PATH_ConsultaDilve% %USER% %PASSWORD% --lote "%lote%" > "%resultados%"
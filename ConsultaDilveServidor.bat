@@ -0,0 +1,10 @@
+@echo off
+
+REM Leer las variables de configuración desde config.txt
+for /F "tokens=1,2 delims==" %%A in (config.txt) do (
+    set %%A=%%B
+)
+
+REM Dejar en marcha el servicio de consultas (cerrar la ventana o Ctrl+C para pararlo)
+%PYTHON_PATH_ConsultaDilve% %SCRIPT_PATH_ConsultaDilve% %USER% %PASSWORD% --servidor --puerto %PUERTO_ConsultaDilve%
+pause
@@ -1,316 +1,772 @@
-import requests
 import xml.etree.ElementTree as ET
 import sqlite3
 import logging
-import sys
-from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from queue import Queue
-from threading import Thread
+import argparse
+from datetime import datetime, timedelta
+from queue import Queue, Empty, Full
+from threading import Thread, Lock
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+import multiprocessing
 import os
-
-# Verificación de credenciales
-if len(sys.argv) != 3:
-    print("\nDebe proporcionar usuario y contraseña como argumentos:")
-    print("python DAPI_SQLite_v7.py <usuario> <contraseña>\n")
-    sys.exit(1)
-
-user = sys.argv[1]
-password = sys.argv[2]
-
-# Crear la carpeta de logs si no existe
+import socket
+import time
+import AplanadoONIX
+import ClienteDILVE
+import EsquemaSQLite
+import BusquedaDILVE
+import FragmentosSQLite
+import MetricasDILVE
+
+# Carpeta y archivo de logs (cada fragmento escribe en su propio archivo)
 log_dir = 'logs'
-os.makedirs(log_dir, exist_ok=True)
-
-# Configuración del registro inicial
+log_base = 'logs_dapi_sqlite'
 log_sequence = 1
-log_filename = os.path.join(log_dir, f'logs_dapi_sqlite_{log_sequence}.txt')
-logging.basicConfig(filename=log_filename, level=logging.INFO, 
-                    format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+log_filename = os.path.join(log_dir, f'{log_base}_{log_sequence}.txt')
+
+# Función para la configuración del registro inicial. Con INFO cada ISBN solo deja línea si
+# falla (el resumen periódico está en las métricas); con DEBUG también los correctos
+def iniciar_logs(nivel=logging.INFO):
+    # Crear la carpeta de logs si no existe
+    os.makedirs(log_dir, exist_ok=True)
+    logging.basicConfig(filename=log_filename, level=nivel, 
+                        format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
 # Función para rotar el archivo de registro
 def rotate_log_file():
     global log_sequence, log_filename
     log_sequence += 1
-    log_filename = os.path.join(log_dir, f'logs_dapi_sqlite_{log_sequence}.txt')
-    logging.getLogger().handlers[0].stream.close()
-    logging.getLogger().handlers = []
-    logging.basicConfig(filename=log_filename, level=logging.INFO, 
-                        format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
-# Función para parsear las fichas de los libros (xmls)
-def parse_book_info(xml_content, isbn):
-    root = ET.fromstring(xml_content)
-    if root.find('.//{http://www.dilve.es/dilve/api/xsd/getRecordsXResponse}error') is not None:
-        return None  # Devolver None si hay un error
-    namespace = {'onix': 'http://ns.editeur.org/onix/3.0/reference'}
-    product_infos = root.findall('.//onix:Product', namespace)
-
-    result = []
-    for product_info in product_infos:
-        result.append(('libros', isbn, product_info))
-        for child in product_info:
-            child_tag = child.tag.split('}')[1] if '}' in child.tag else child.tag
-            if len(child) > 0:
-                result.append((child_tag, isbn, child))
-    return result
-
-# Función para introducir datos en las tablas
-def insert_into_table(cursor, table_name, isbn, element):
-    columns = {f"{child.tag.split('}')[1] if '}' in child.tag else child.tag}": child.text.strip() for child in element if child.text is not None}
-    
-    if not columns:
-        return None
-
-    column_names = ', '.join(columns.keys())
-    placeholders = ', '.join(['?' for _ in columns])
-    
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table_name} (
-                        id INTEGER PRIMARY KEY,
-                        isbn TEXT,
-                        {column_names}
-                    )''')
-    for column in columns.keys():
+    log_filename = os.path.join(log_dir, f'{log_base}_{log_sequence}.txt')
+    # Se cambia el archivo bajo el bloqueo del handler para no cerrar el stream mientras otro hilo escribe
+    handler = logging.getLogger().handlers[0]
+    handler.acquire()
+    try:
+        handler.stream.close()
+        handler.baseFilename = os.path.abspath(log_filename)
+        handler.stream = handler._open()
+    finally:
+        handler.release()
+
+# Número de ISBNs que se piden en cada llamada a getRecordsX
+ISBNS_POR_LLAMADA = 50
+
+# Procesos que parsean y aplanan las respuestas de DILVE (0 = en los propios hilos de descarga)
+PROCESOS = os.cpu_count() or 1
+# Pool de procesos del aplanado que se vuelve a crear si muere uno de sus procesos.
+# ProcessPoolExecutor queda roto para siempre (BrokenProcessPool) en cuanto pierde un
+# proceso: las tareas que tenía en marcha fallan y sus ISBNs quedan pendientes, y las
+# siguientes van a un pool nuevo en vez de fallar todas hasta el final de la ejecución
+class PoolAplanado(Executor):
+    def __init__(self, procesos):
+        self.procesos = procesos
+        self.pool = ProcessPoolExecutor(max_workers=procesos)
+        self.bloqueo = Lock()
+
+    def submit(self, fn, /, *args, **kwargs):
+        pool = self.pool
         try:
-            cursor.execute(f'''ALTER TABLE {table_name} ADD COLUMN {column} TEXT''')
-        except sqlite3.OperationalError:
-            pass
-
-    cursor.execute(f'''INSERT OR IGNORE INTO {table_name} (isbn, {column_names})
-                       VALUES (?, {placeholders})''', [isbn] + list(columns.values()))
-    return cursor.lastrowid
-
-# Función para manejar los elementos específicos y agregar tablas adicionales
-def handle_specific_elements(cursor, isbn, element, element_tag):
-    nested_data = {}
-    
-    # Procesar todos los niveles de anidación del XML
-    def process_element(element, parent_tag):
-        for child in element:
-            child_tag = f"{parent_tag}_{child.tag.split('}')[1] if '}' in child.tag else child.tag}".strip('_')
-            if len(child) > 0:
-                process_element(child, child_tag)
-            else:
-                if child_tag not in nested_data:
-                    nested_data[child_tag] = []
-                nested_data[child_tag].append(child.text.strip() if child.text else '')
-
-    process_element(element, element_tag)
-
-    if not nested_data:
-        return None
+            futuro = pool.submit(fn, *args, **kwargs)
+        except BrokenProcessPool:
+            # La tarea no llegó a empezar: va al pool nuevo
+            futuro = self.reponer(pool).submit(fn, *args, **kwargs)
+            pool = self.pool
+        futuro.add_done_callback(lambda f: self.reponer(pool) if not f.cancelled() and isinstance(f.exception(), BrokenProcessPool) else None)
+        return futuro
+
+    # Función para sustituir el pool roto por uno nuevo (solo la primera vez que se avisa de él)
+    def reponer(self, roto):
+        with self.bloqueo:
+            if self.pool is roto:
+                logging.error(f"Un proceso del aplanado ha muerto: se crea un pool nuevo de {self.procesos} procesos.")
+                MetricasDILVE.contar('pool_aplanado_reinicios_total')
+                self.pool = ProcessPoolExecutor(max_workers=self.procesos)
+            return self.pool
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        self.pool.shutdown(wait=wait, cancel_futures=cancel_futures)
+
+# Pool de procesos del aplanado (PoolAplanado); lo crea process_isbn_batches
+aplanador = None
+# Función de aplanado con las opciones de la ejecución (archivo en onix_crudo, tablas normalizadas)
+aplanado = partial(AplanadoONIX.aplanar_medido, archivar=True)
+
+# Función para convertir una respuesta de getRecordsX en filas por ISBN (ver AplanadoONIX.aplanar_respuesta).
+# Con el pool el trabajo de CPU sale del proceso principal y de su GIL; el hilo de descarga solo espera
+def aplanar(content, isbns):
+    if aplanador is None:
+        return AplanadoONIX.resultado_medido(aplanado(content, isbns))
+    return AplanadoONIX.resultado_medido(aplanador.submit(aplanado, content, isbns).result())
 
-    column_names = ', '.join(nested_data.keys())
-    placeholders = ', '.join(['?' for _ in nested_data])
-    
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {element_tag} (
-                        id INTEGER PRIMARY KEY,
-                        isbn TEXT,
-                        {column_names}
-                    )''')
+# Función para procesar un ISBN
+def process_isbn(isbn, queue, user, password):
+    logging.debug(f"Procesando ISBN: {isbn}")
 
-    for column in nested_data.keys():
+    # Los fallos transitorios ya se reintentan dentro de pedir_records;
+    # un error de DILVE en el XML o un XML mal formado no se reintentan
+    try:
+        content = ClienteDILVE.pedir_records(user, password, isbn)
         try:
-            cursor.execute(f'''ALTER TABLE {element_tag} ADD COLUMN {column} TEXT''')
-        except sqlite3.OperationalError:
-            pass
-
-    nested_data = {k: ' ; '.join(v) for k, v in nested_data.items()}
-    cursor.execute(f'''INSERT OR IGNORE INTO {element_tag} (isbn, {column_names})
-                       VALUES (?, {placeholders})''', [isbn] + list(nested_data.values()))
-
-# Función para poner los datos de los hijos anidados en tablas
-def insert_nested_table(cursor, table_name, isbn, element, parent_tag=''):
-    nested_data = {}
-    
-    # Procesar todos los niveles de anidación del XML
-    def process_element(element, parent_tag):
-        for child in element:
-            child_tag = f"{parent_tag}_{child.tag.split('}')[1] if '}' in child.tag else child.tag}".strip('_')
-            if len(child) > 0:
-                # Verificar si el child_tag es uno de los específicos
-                if child.tag.split('}')[1] in ['Measure', 'Contributor', 'TitleDetail', 'TextContent', 'PublishingDate', 'Language', 'Subject', 'SupportingResource', 'Audience', 'AudienceRange', 'Publisher', 'Extent', 'SupplyDetail', 'RelatedProduct']:
-                    handle_specific_elements(cursor, isbn, child, child.tag.split('}')[1])
-                else:
-                    process_element(child, child_tag)
+            result = aplanar(content, isbn)
+            if result is None:
+                error = ClienteDILVE.ErrorDILVE(f"Error en el contenido XML para ISBN {isbn}", permanente=True)
             else:
-                if child_tag not in nested_data:
-                    nested_data[child_tag] = []
-                nested_data[child_tag].append(child.text.strip() if child.text else '')
-
-    process_element(element, parent_tag)
+                queue.put((isbn, result.get(isbn, ([], None)), None))
+                return
+        except ET.ParseError as e:
+            error = ClienteDILVE.ErrorDILVE(f"Error parseando el XML para ISBN {isbn}: {e}", permanente=True)
+    except ClienteDILVE.ErrorDILVE as e:
+        error = e
 
-    if not nested_data:
-        return None
-
-    column_names = ', '.join(nested_data.keys())
-    placeholders = ', '.join(['?' for _ in nested_data])
-    
-    cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table_name} (
-                        id INTEGER PRIMARY KEY,
-                        isbn TEXT,
-                        {column_names}
-                    )''')
-
-    for column in nested_data.keys():
-        try:
-            cursor.execute(f'''ALTER TABLE {table_name} ADD COLUMN {column} TEXT''')
-        except sqlite3.OperationalError:
-            pass
-
-    nested_data = {k: ' ; '.join(v) for k, v in nested_data.items()}
-    cursor.execute(f'''INSERT OR IGNORE INTO {table_name} (isbn, {column_names})
-                       VALUES (?, {placeholders})''', [isbn] + list(nested_data.values()))
-
-# Función para actualizar registros existentes
-def update_existing_record(cursor, table_name, isbn, element):
-    columns = {f"{child.tag.split('}')[1] if '}' in child.tag else child.tag}": child.text.strip() for child in element if child.text is not None}
-
-    if not columns:
-        return None
-
-    for column, value in columns.items():
-        cursor.execute(f'''
-            UPDATE OR IGNORE {table_name}
-            SET {column} = ?
-            WHERE isbn = ?
-        ''', (value, isbn))
-
-# Función para procesar un ISBN
-def process_isbn(isbn, queue, user, password):
-    logging.info(f"Procesando ISBN: {isbn}")
-    url_book_info = f"https://www.dilve.es/dilve/dilve/getRecordsX.do?user={user}&password={password}&identifier={isbn}&metadataformat=ONIX&version=3.0"
-    
-    for attempt in range(3):
-        try:
-            response = requests.get(url_book_info)
-            response.raise_for_status()
-            try:
-                result = parse_book_info(response.content, isbn)
-                if result is None:
-                    error = f"Error en el contenido XML para ISBN {isbn}"
-                else:
-                    queue.put((isbn, result, None))
-                    return
-            except ET.ParseError as e:
-                error = f"Error parseando el XML para ISBN {isbn}: {e}"
-        except requests.RequestException as e:
-            error = f"Error en la llamada a DILVE para ISBN {isbn}: {e}"
-
-        logging.warning(f"{error}. Intento {attempt + 1} de 3.")
-    
     queue.put((isbn, None, error))
 
-# Función para actualizar la base de datos
-def db_updater(queue):
-    conn = sqlite3.connect('book_all_fields.db')
+# Función para procesar varios ISBNs con una sola llamada a getRecordsX
+def process_isbns(isbns, queue, user, password):
+    if len(isbns) == 1:
+        return process_isbn(isbns[0], queue, user, password)
+
+    logging.debug(f"Procesando {len(isbns)} ISBNS en una llamada.")
+    identifiers = ClienteDILVE.identificadores(isbns)
+
+    result = None
+    try:
+        content = ClienteDILVE.pedir_records(user, password, identifiers)
+        result = aplanar(content, isbns)
+    except ET.ParseError as e:
+        logging.warning(f"Error parseando el XML del lote de {len(isbns)} ISBNS: {e}")
+    except ClienteDILVE.ErrorDILVE as e:
+        if not e.permanente:
+            # DILVE no responde: pedir los ISBNs de uno en uno solo gastaría más peticiones
+            logging.warning(f"Lote de {len(isbns)} ISBNS sin respuesta: {e}")
+            for isbn in isbns:
+                queue.put((isbn, None, e))
+            return
+        logging.warning(f"Error en la llamada a DILVE para el lote de {len(isbns)} ISBNS: {e}")
+
+    encontrados, pendientes = ClienteDILVE.repartir_productos(isbns, result)
+    for isbn, isbn_result in encontrados.items():
+        queue.put((isbn, isbn_result, None))
+
+    # Los ISBNs que faltan en la respuesta o que fallaron se vuelven a pedir de uno en uno
+    for isbn in pendientes:
+        process_isbn(isbn, queue, user, password)
+
+# Confirmar la transacción del escritor cada COMMIT_CADA_ISBNS ISBNs o cada COMMIT_CADA_MS milisegundos
+COMMIT_CADA_ISBNS = 500
+COMMIT_CADA_MS = 2000
+
+# Función para abrir la base de datos con los ajustes de escritura
+def abrir_bd(ruta='book_all_fields.db'):
+    # isolation_level=None: las transacciones se abren y confirman explícitamente.
+    # Con varios procesos sobre la misma base de datos se espera al bloqueo de escritura del otro
+    conn = sqlite3.connect(ruta, isolation_level=None, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-262144')  # 256 MB
+    conn.execute('PRAGMA mmap_size=1073741824')  # 1 GB
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+# Función para marcar un ISBN como procesado (y liberar su reserva)
+def marcar_procesado(cursor, isbn):
+    cursor.execute('''
+        UPDATE isbns_libros 
+        SET procesado = 1, fecha_procesado = ?, modificado = 0,
+            propietario = NULL, concesion_expira = NULL, intentos = 0, reintentar_desde = NULL
+        WHERE isbn = ?
+    ''', (datetime.now().strftime('%Y-%m-%d%H:%M:%S'), isbn))
+
+# Función para marcar como procesado un ISBN cuya ficha no ha cambiado. fecha_procesado es la
+# del último cambio guardado (ExportarFileMaker.py exporta por ella), así que se deja como estaba
+def marcar_sin_cambios(cursor, isbn):
+    cursor.execute('''
+        UPDATE isbns_libros
+        SET procesado = 1, fecha_procesado = COALESCE(fecha_procesado, ?), modificado = 0,
+            propietario = NULL, concesion_expira = NULL, intentos = 0, reintentar_desde = NULL
+        WHERE isbn = ?
+    ''', (datetime.now().strftime('%Y-%m-%d%H:%M:%S'), isbn))
+
+# Función para guardar el resultado de un ISBN: `result` es (filas, crudo) tal como lo
+# devuelve AplanadoONIX, con las filas (tabla, columnas, valores) ya preparadas, así que aquí
+# solo se ejecuta SQL. Si el hash de la ficha coincide con el archivado no se reescribe nada
+def guardar_resultado(cursor, esquema, isbn, result, error, normalizado=False):
+    if error is None:
+        filas, crudo = result
+        # El estado del ISBN (marca de modificado y hash archivado) se consulta una sola vez
+        estado = cursor.execute('''
+            SELECT l.id, l.procesado, l.modificado, c.hash
+            FROM isbns_libros l LEFT JOIN onix_crudo c ON c.isbn = l.isbn
+            WHERE l.isbn = ?
+        ''', (isbn,)).fetchone()
+        id_libro, procesado, modificado, hash_previo = estado or (None, None, None, None)
+        if crudo is not None and hash_previo == crudo[0]:
+            cursor.execute('UPDATE onix_crudo SET fecha_descarga = ? WHERE isbn = ?',
+                           (datetime.now().strftime('%Y-%m-%d %H:%M:%S'), isbn))
+            marcar_sin_cambios(cursor, isbn)
+            MetricasDILVE.contar('isbns_total', resultado='sin_cambios')
+            logging.debug(f"ISBN {isbn} sin cambios.")
+            return
+
+        # Si ya había ficha archivada los datos anteriores están en las tablas aunque no se marcara modificado.
+        # procesado = 1 aquí es que otro proceso lo guardó después de que caducara nuestra reserva
+        if modificado == 1 or hash_previo is not None or procesado == 1:
+            esquema.reescribir(cursor, isbn, filas, normalizado)
+        else:
+            for table_name, columns, values in filas:
+                esquema.insertar(cursor, table_name, isbn, columns, values)
+        # El índice de búsqueda (si la base de datos lo tiene) sale de las mismas filas
+        if id_libro is not None and esquema.existe('busqueda'):
+            BusquedaDILVE.indexar(cursor, id_libro, isbn, filas)
+        if crudo is not None:
+            cursor.execute('''
+                INSERT OR REPLACE INTO onix_crudo (isbn, hash, compresion, xml, fecha_descarga)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (isbn, *crudo, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        elif hash_previo is not None:
+            # Sin archivo (--sin-archivo) la ficha anterior ya no corresponde a las filas nuevas
+            cursor.execute('DELETE FROM onix_crudo WHERE isbn = ?', (isbn,))
+        marcar_procesado(cursor, isbn)
+        MetricasDILVE.contar('isbns_total', resultado='procesado')
+        logging.debug(f"ISBN {isbn} procesado correctamente.")
+    elif getattr(error, 'permanente', True):
+        marcar_error(cursor, isbn)
+        MetricasDILVE.contar('isbns_total', resultado='error')
+        logging.error(f"Error procesando ISBN {isbn}: {error}")
+    else:
+        # Error transitorio: el ISBN se deja pendiente (procesado IS NULL) para la próxima ejecución
+        marcar_pendiente(cursor, isbn)
+        MetricasDILVE.contar('isbns_total', resultado='pendiente')
+        logging.warning(f"ISBN {isbn} pendiente tras error transitorio: {error}")
+
+# Veces que se vuelve a pedir un ISBN con error de DILVE (procesado = 0) antes de darlo por perdido
+MAX_INTENTOS = 5
+# Espera antes de reintentar un ISBN fallido: se multiplica por 4 en cada intento hasta la máxima
+ESPERA_REINTENTO_MINUTOS = 15
+ESPERA_REINTENTO_MAXIMA_MINUTOS = 24 * 60
+
+# Función para la fecha en el formato de las columnas de reserva y reintento (comparable como texto)
+def fecha(minutos=0):
+    return (datetime.now() + timedelta(minutes=minutos)).strftime('%Y-%m-%d %H:%M:%S')
+
+# Función para anotar un intento fallido de un ISBN: suma el intento, calcula cuándo
+# se puede volver a pedir y libera su reserva
+def anotar_intento(cursor, isbn, procesado, fecha_procesado):
+    fila = cursor.execute('SELECT intentos FROM isbns_libros WHERE isbn = ?', (isbn,)).fetchone()
+    intentos = ((fila and fila[0]) or 0) + 1
+    espera = min(ESPERA_REINTENTO_MINUTOS * 4 ** (intentos - 1), ESPERA_REINTENTO_MAXIMA_MINUTOS)
+    cursor.execute('''
+        UPDATE isbns_libros 
+        SET procesado = ?, fecha_procesado = ?, intentos = ?, reintentar_desde = ?,
+            propietario = NULL, concesion_expira = NULL
+        WHERE isbn = ?
+    ''', (procesado, fecha_procesado, intentos, fecha(espera), isbn))
+
+# Función para marcar un ISBN como no procesado; se reintenta hasta MAX_INTENTOS veces
+def marcar_error(cursor, isbn):
+    anotar_intento(cursor, isbn, 0, datetime.now().strftime('%Y-%m-%d%H:%M:%S'))
+
+# Función para dejar un ISBN pendiente tras un error transitorio (sin límite de intentos)
+def marcar_pendiente(cursor, isbn):
+    anotar_intento(cursor, isbn, None, None)
+
+# Función para actualizar la base de datos.
+# Los ISBNs se agrupan en una transacción que se confirma cada COMMIT_CADA_ISBNS
+# ISBNs o COMMIT_CADA_MS milisegundos. Los datos de cada ISBN y su marca en
+# isbns_libros van en el mismo SAVEPOINT, así que si el proceso se cae a mitad de
+# un grupo se pierden ambos y esos ISBNs siguen pendientes (procesado IS NULL,
+# reservados hasta que el mismo propietario vuelva a arrancar o caduque la reserva).
+def db_updater(queue, ruta='book_all_fields.db', normalizado=False):
+    conn = abrir_bd(ruta)
     cursor = conn.cursor()
+    esquema = EsquemaSQLite.RegistroEsquema(conn)
     line_count = 0
+    pendientes = 0
+    inicio_grupo = time.monotonic()
+
+    def confirmar():
+        nonlocal pendientes
+        if pendientes:
+            with MetricasDILVE.cronometro('commit_segundos'):
+                cursor.execute('COMMIT')
+            pendientes = 0
 
     while True:
-        isbn, result, error = queue.get()
+        if pendientes:
+            restante = COMMIT_CADA_MS / 1000 - (time.monotonic() - inicio_grupo)
+            try:
+                isbn, result, error = queue.get(timeout=max(restante, 0))
+            except Empty:
+                confirmar()
+                continue
+        else:
+            isbn, result, error = queue.get()
         if isbn is None:
             break
-        if error is None:
-            for table_name, isbn, element in result:
-                if table_name == 'libros':
-                    if cursor.execute('SELECT 1 FROM isbns_libros WHERE isbn = ? AND modificado = 1', (isbn,)).fetchone():
-                        update_existing_record(cursor, table_name, isbn, element)
-                    else:
-                        insert_into_table(cursor, table_name, isbn, element)
-                else:
-                    if cursor.execute('SELECT 1 FROM isbns_libros WHERE isbn = ? AND modificado = 1', (isbn,)).fetchone():
-                        cursor.execute(f'DELETE FROM {table_name} WHERE isbn = ?', (isbn,))
-                    insert_nested_table(cursor, table_name, isbn, element)
-            cursor.execute('''
-                UPDATE isbns_libros 
-                SET procesado = 1, fecha_procesado = ?, modificado = 0
-                WHERE isbn = ?
-            ''', (datetime.now().strftime('%Y-%m-%d%H:%M:%S'), isbn))
-            logging.info(f"ISBN {isbn} procesado correctamente.")
-        else:
-            cursor.execute('''
-                UPDATE isbns_libros 
-                SET procesado = 0, fecha_procesado = ? 
-                WHERE isbn = ?
-            ''', (datetime.now().strftime('%Y-%m-%d%H:%M:%S'), isbn))
-            logging.error(f"Error procesando ISBN {isbn}: {error}")
-        conn.commit()
-        
+
+        if not pendientes:
+            # IMMEDIATE: con otro proceso escribiendo, esperar al bloqueo aquí y no fallar a mitad del grupo
+            cursor.execute('BEGIN IMMEDIATE')
+            inicio_grupo = time.monotonic()
+        cursor.execute('SAVEPOINT isbn')
+        try:
+            with MetricasDILVE.cronometro('escritura_segundos'):
+                guardar_resultado(cursor, esquema, isbn, result, error, normalizado)
+        except Exception as e:
+            # Se deshace solo este ISBN; el DDL deshecho obliga a releer el esquema. Cualquier
+            # excepción acaba aquí: si el escritor muriese, los hilos de descarga se quedarían
+            # esperando para siempre en la cola acotada
+            cursor.execute('ROLLBACK TO isbn')
+            esquema.recargar(conn)
+            marcar_error(cursor, isbn)
+            MetricasDILVE.contar('isbns_total', resultado='error_escritura')
+            logging.error(f"Error guardando ISBN {isbn}: {e!r}")
+        cursor.execute('RELEASE isbn')
+        pendientes += 1
+
+        if pendientes >= COMMIT_CADA_ISBNS or time.monotonic() - inicio_grupo >= COMMIT_CADA_MS / 1000:
+            confirmar()
+
         line_count += 1
-        if line_count >= 100000:
+        if line_count >= 100000 or (line_count % 500 == 0 and os.path.getsize(log_filename) >= 100000):
             rotate_log_file()
             line_count = 0
-    
+
+    confirmar()
     conn.close()
 
-# Función para procesar los ISBNs en lotes
-def process_batch(isbns, queue, user, password):
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        futures = [executor.submit(process_isbn, isbn, queue, user, password) for isbn in isbns]
-        for future in as_completed(futures):
+# Número máximo de hilos que llaman a DILVE; la concurrencia real la ajusta
+# ClienteDILVE.ControlConcurrencia entre 1 y este valor, empezando por la mitad
+HILOS = 20
+# Número de ISBNs que se reservan de isbns_libros en cada consulta
+ISBNS_POR_PAGINA = 2000
+# Identificador del proceso en las reservas: máquina y pid, distinto en cada ejecución aunque
+# haya varias en la misma máquina. Con un --propietario fijo, una ejecución interrumpida sigue al
+# volver a arrancar por los ISBNs que tenía reservados (liberar_reservas) sin esperar a que caduquen
+PROPIETARIO = f'{socket.gethostname()}:{os.getpid()}'
+# Minutos que dura una reserva; si el proceso se cae, pasado este tiempo otro puede tomar sus ISBNs
+CONCESION_MINUTOS = 30
+# Minutos entre renovaciones de las reservas que siguen en marcha (renovar_reservas)
+RENOVAR_RESERVAS_MINUTOS = CONCESION_MINUTOS / 3
+# Resultados que pueden esperar al escritor antes de frenar a los hilos de descarga
+TAMANO_COLA_RESULTADOS = 2000
+# Memoria (MB) que pueden ocupar esos resultados; con fichas grandes el límite es este y no el número
+MEMORIA_COLA_RESULTADOS_MB = 64
+
+# Función para estimar lo que ocupa en memoria un resultado (isbn, (filas, crudo), error):
+# el texto de los valores, la ficha archivada comprimida y una cantidad fija por columna
+# (tuplas y cabeceras de los objetos; los nombres de columna son compartidos). Las filas de
+# las tablas *_normalizado llevan también enteros (secuencia, secuencia_padre)
+def tamano_resultado(item):
+    _, result, _ = item
+    if result is None:
+        return 256
+    filas, crudo = result
+    tamano = 256 + (len(crudo[2]) if crudo is not None else 0)
+    for _, columns, values in filas:
+        tamano += 64 * len(columns) + sum(len(valor) if isinstance(valor, (str, bytes)) else 8 for valor in values if valor)
+    return tamano
+
+# Cola de resultados para db_updater acotada por número de resultados y por memoria estimada.
+# Cuando el escritor se atasca (un checkpoint, otro proceso con el bloqueo de escritura) los hilos
+# de descarga esperan en put() y la memoria del proceso no crece; un resultado más grande que
+# el límite entra si la cola está vacía, para no bloquearse
+class ColaResultados(Queue):
+    def __init__(self, maxsize=TAMANO_COLA_RESULTADOS, memoria_mb=MEMORIA_COLA_RESULTADOS_MB):
+        super().__init__(maxsize)
+        self.max_bytes = int(memoria_mb * 2**20)
+        self.bytes = 0
+        self.pico_bytes = 0
+
+    def llena(self, tamano):
+        return (self.maxsize > 0 and self._qsize() >= self.maxsize) or (self.bytes and self.bytes + tamano > self.max_bytes)
+
+    def put(self, item, block=True, timeout=None):
+        tamano = tamano_resultado(item)
+        espera = None
+        with self.not_full:
+            if self.llena(tamano):
+                if not block:
+                    raise Full
+                espera = time.monotonic()
+                while self.llena(tamano):
+                    restante = None if timeout is None else espera + timeout - time.monotonic()
+                    if restante is not None and restante <= 0:
+                        raise Full
+                    self.not_full.wait(restante)
+            self._put((tamano, item))
+            self.bytes += tamano
+            self.pico_bytes = max(self.pico_bytes, self.bytes)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+        if espera is not None:
+            MetricasDILVE.observar('espera_cola_segundos', time.monotonic() - espera)
+
+    def _get(self):
+        tamano, item = self.queue.popleft()
+        self.bytes -= tamano
+        return item
+
+# ISBNs pendientes: los que no se han procesado y los fallidos con intentos por agotar,
+# siempre que haya pasado su reintentar_desde y no los tenga reservados otro proceso
+# (o su reserva haya caducado). Parámetros: MAX_INTENTOS y la fecha actual dos veces
+CONDICION_PENDIENTE = '''
+    (procesado IS NULL OR (procesado = 0 AND COALESCE(intentos, 0) < ?))
+    AND (reintentar_desde IS NULL OR reintentar_desde <= ?)
+    AND (propietario IS NULL OR concesion_expira <= ?)
+'''
+
+# Función para reservar hasta `limite` ISBNs pendientes con id mayor que `ultimo_id`.
+# La reserva es un único UPDATE, así que dos procesos no pueden tomar el mismo ISBN.
+# Devuelve [(id, isbn), ...] ordenado por id
+def reservar_isbns(conn, propietario, ultimo_id, limite):
+    ahora = fecha()
+    rows = conn.execute(f'''
+        UPDATE isbns_libros
+        SET propietario = ?, concesion_expira = ?
+        WHERE id IN (
+            SELECT id
+            FROM isbns_libros
+            WHERE id > ? AND {CONDICION_PENDIENTE}
+            ORDER BY id
+            LIMIT ?
+        )
+        RETURNING id, isbn
+    ''', (propietario, fecha(CONCESION_MINUTOS), ultimo_id, MAX_INTENTOS, ahora, ahora, limite)).fetchall()
+    return sorted(rows)
+
+# Función para liberar las reservas de un propietario: al arrancar, las que dejó
+# una ejecución interrumpida (para seguir por ellas sin esperar a que caduquen)
+def liberar_reservas(conn, propietario):
+    liberados = conn.execute('''
+        UPDATE isbns_libros
+        SET propietario = NULL, concesion_expira = NULL
+        WHERE propietario = ?
+    ''', (propietario,)).rowcount
+    if liberados:
+        logging.info(f"{liberados} ISBNS reservados por {propietario} en una ejecución anterior vuelven a estar pendientes.")
+
+# Función para renovar las reservas que siguen a nombre de `propietario`: las de los ISBNs
+# encolados o en descarga que el escritor todavía no ha guardado (al guardarlos se liberan)
+def renovar_reservas(conn, propietario):
+    renovados = conn.execute('''
+        UPDATE isbns_libros
+        SET concesion_expira = ?
+        WHERE propietario = ?
+    ''', (fecha(CONCESION_MINUTOS), propietario)).rowcount
+    logging.debug(f"{renovados} reservas de {propietario} renovadas.")
+
+# Función para reservar los ISBNs pendientes y repartirlos a los hilos de descarga.
+# La cola de ISBNs está acotada: mientras espera para encolar, el productor renueva cada
+# RENOVAR_RESERVAS_MINUTOS las reservas, para que no caduquen (y otro proceso pida los mismos
+# ISBNs) cuando una página tarda en descargarse más que CONCESION_MINUTOS
+def productor_isbns(cola_isbns, hilos, propietario=PROPIETARIO, ruta='book_all_fields.db'):
+    conn = sqlite3.connect(ruta, isolation_level=None, timeout=60)
+    ultimo_id = 0
+    total = 0
+    renovadas = time.monotonic()
+
+    def encolar(elemento):
+        nonlocal renovadas
+        while True:
+            if time.monotonic() - renovadas >= RENOVAR_RESERVAS_MINUTOS * 60:
+                renovar_reservas(conn, propietario)
+                renovadas = time.monotonic()
             try:
-                future.result()
-            except Exception as e:
-                logging.error(f"Error procesando un futuro: {e}")
-
-def process_isbn_batches(user, password):
-    conn_main = sqlite3.connect('book_all_fields.db')
-    cursor_main = conn_main.cursor()
+                cola_isbns.put(elemento, timeout=5)
+                return
+            except Full:
+                pass
 
     while True:
-        logging.info("Consultando ISBNS no procesados.")
-        cursor_main.execute('''
-            SELECT isbn 
-            FROM isbns_libros 
-            WHERE procesado IS NULL 
-            ORDER BY id 
-            LIMIT 20000
-        ''')
-        isbns = [row[0] for row in cursor_main.fetchall()]
-        
-        if not isbns:
-            logging.info("No se encontraron ISBNS no procesados. Finalizando.")
-            conn_main.close()
-            break
+        logging.info("Reservando ISBNS no procesados.")
+        # Se pagina por id para pasar una sola vez por la tabla: los ISBNs que fallen
+        # en esta ejecución no se vuelven a pedir hasta la siguiente
+        rows = reservar_isbns(conn, propietario, ultimo_id, ISBNS_POR_PAGINA)
 
-        isbns = [isbn for isbn in isbns if isbn is not None]  # eliminar valores None si existen
-
-        if not isbns:
-            logging.info("No se encontraron ISBNS válidos para procesar. Finalizando.")
-            conn_main.close()
+        if not rows:
+            logging.info(f"No quedan ISBNS no procesados ({total} encolados). Finalizando.")
             break
 
-        # Procesar en lotes de 50 ISBNS
-        for i in range(0, len(isbns), 50):
-            batch = isbns[i:i+50]
-            logging.info(f"Procesando un lote de {len(batch)} ISBNS.")
-
-            # Crear una cola para la comunicación entre hilos
-            queue = Queue()
-
-            # Iniciar el hilo para las actualizaciones en la base de datos
-            db_thread = Thread(target=db_updater, args=(queue,))
-            db_thread.start()
-
-            # Procesar el lote
-            process_batch(batch, queue)
-            logging.info(f"Lote de {len(batch)} ISBNS procesado.")
+        ultimo_id = rows[-1][0]
+        for _, isbn in rows:
+            if isbn is not None:  # eliminar valores None si existen
+                encolar(isbn)
+                total += 1
 
-            # Señalizar el final del hilo de actualización de la base de datos
-            queue.put((None, None, None))
-            db_thread.join()
+    # Una señal de fin por cada hilo de descarga
+    for _ in range(hilos):
+        encolar(None)
+    conn.close()
 
-            # Rotar el archivo de registro si es necesario
-            if os.path.getsize(log_filename) >= 100000:
-                rotate_log_file()
+# Función de cada hilo de descarga: toma ISBNs de la cola en lotes de ISBNS_POR_LLAMADA
+def trabajador_dilve(cola_isbns, queue, user, password):
+    terminado = False
+    while not terminado:
+        isbn = cola_isbns.get()
+        if isbn is None:
+            break
+        lote = [isbn]
+        while len(lote) < ISBNS_POR_LLAMADA:
+            try:
+                isbn = cola_isbns.get_nowait()
+            except Empty:
+                break
+            if isbn is None:
+                terminado = True
+                break
+            lote.append(isbn)
 
-    # Optimizar la base de datos
-    cursor_main.execute('VACUUM')
+        try:
+            process_isbns(lote, queue, user, password)
+        except Exception as e:
+            # Fallos ajenos a DILVE y al ISBN (un proceso del aplanado muerto, ...): el lote queda pendiente
+            logging.error(f"Error procesando un lote de {len(lote)} ISBNS: {e!r}")
+            error = ClienteDILVE.ErrorDILVE(f"Error procesando el lote: {e!r}", permanente=False)
+            for isbn in lote:
+                queue.put((isbn, None, error))
+
+# Segundos entre instantáneas de las métricas (logs/<log>_metricas.jsonl y resumen en el log)
+METRICAS_CADA = 60
+
+# Función para procesar todos los ISBNs pendientes.
+# Un productor reserva ISBNs de isbns_libros a nombre de `propietario`, HILOS hilos (o el motor asyncio) descargan de
+# DILVE, un pool de `procesos` procesos convierte el XML en filas y un único
+# escritor (db_updater) las guarda. Las colas están acotadas para que ninguna
+# etapa se adelante demasiado a las demás. Varios procesos con distinto propietario
+# pueden trabajar a la vez sobre la misma base de datos sin pedir dos veces un ISBN.
+def process_isbn_batches(user, password, hilos=HILOS, motor='hilos', concurrencia=None, rps=None, vacuum=False, procesos=PROCESOS,
+                         archivo=True, normalizado=False, propietario=PROPIETARIO, ruta='book_all_fields.db',
+                         metricas_puerto=None, busqueda=True, memoria_cola=MEMORIA_COLA_RESULTADOS_MB):
+    global aplanador, aplanado
+    aplanado = partial(AplanadoONIX.aplanar_medido, archivar=archivo, normalizar=normalizado)
+    preparar_bd(ruta, propietario, busqueda)
+    MetricasDILVE.reiniciar()
+
+    if procesos:
+        aplanador = PoolAplanado(procesos)
+
+    queue = ColaResultados(TAMANO_COLA_RESULTADOS, memoria_cola)
+
+    # Iniciar el hilo para las actualizaciones en la base de datos
+    db_thread = Thread(target=db_updater, args=(queue, ruta, normalizado))
+    db_thread.start()
+
+    if motor == 'async':
+        import MotorAsyncDILVE
+        concurrencia = concurrencia or MotorAsyncDILVE.CONCURRENCIA
+        cola_isbns = Queue(maxsize=concurrencia * ISBNS_POR_LLAMADA * 2)
+        workers = [Thread(target=MotorAsyncDILVE.ejecutar,
+                          args=(cola_isbns, queue, user, password, ISBNS_POR_LLAMADA, concurrencia, rps, aplanador, aplanado))]
+    else:
+        # Iniciar los hilos de descarga
+        ClienteDILVE.configurar(tamano_pool=hilos)
+        ClienteDILVE.control = ClienteDILVE.ControlConcurrencia(max(1, hilos // 2), hilos)
+        cola_isbns = Queue(maxsize=hilos * ISBNS_POR_LLAMADA * 2)
+        workers = [Thread(target=trabajador_dilve, args=(cola_isbns, queue, user, password)) for _ in range(hilos)]
+    MetricasDILVE.medidor('cola_isbns', cola_isbns.qsize)
+    MetricasDILVE.medidor('cola_resultados', queue.qsize)
+    MetricasDILVE.medidor('cola_resultados_bytes', lambda: queue.bytes)
+    MetricasDILVE.medidor('cola_resultados_bytes_pico', lambda: queue.pico_bytes)
+    control = ClienteDILVE.control
+    if motor != 'async' and control is not None:
+        MetricasDILVE.medidor('peticiones_en_vuelo', lambda: control.en_vuelo)
+        MetricasDILVE.medidor('concurrencia_limite', lambda: int(control.limite))
+    volcado = MetricasDILVE.Volcado(os.path.join(log_dir, f'{log_base}_metricas.jsonl'), METRICAS_CADA, metricas_puerto)
+    for worker in workers:
+        worker.start()
+
+    productor_isbns(cola_isbns, len(workers), propietario, ruta)
+    for worker in workers:
+        worker.join()
+
+    # Señalizar el final del hilo de actualización de la base de datos
+    queue.put((None, None, None))
+    db_thread.join()
+    volcado.detener()
+    ClienteDILVE.cerrar()
+    if aplanador is not None:
+        aplanador.shutdown()
+        aplanador = None
+
+    compactar(ruta, vacuum)
+
+# Función para preparar la base de datos antes de una ejecución
+def preparar_bd(ruta, propietario, busqueda=True):
+    conn_main = sqlite3.connect(ruta, timeout=60)
+    EsquemaSQLite.asegurar_isbns_libros(conn_main)
+    EsquemaSQLite.asegurar_onix_crudo(conn_main)
+    # El índice de búsqueda se crea (y se llena con lo ya descargado) la primera vez; db_updater lo mantiene
+    if busqueda and EsquemaSQLite.asegurar_busqueda(conn_main):
+        total = BusquedaDILVE.reconstruir(conn_main)
+        logging.info(f"Índice de búsqueda creado con {total} ISBNs.")
+    # Índices por isbn en las tablas creadas antes de que se crearan con ellas (solo la primera vez)
+    EsquemaSQLite.RegistroEsquema(conn_main).migrar_indices(conn_main)
+    liberar_reservas(conn_main, propietario)
+    conn_main.commit()
     conn_main.close()
 
-# Ejecutar el procesamiento de lotes
-process_isbn_batches()
+# Función para devolver al disco el espacio libre de la base de datos.
+# Por defecto solo PRAGMA incremental_vacuum, que suelta las páginas libres sin reescribir
+# el archivo (si la base de datos tiene auto_vacuum incremental). Con vacuum=True, VACUUM
+# completo: reescribe todo el archivo con la base de datos bloqueada, así que se hace
+# solo a petición (--vacuum), y deja la base de datos en auto_vacuum incremental
+def compactar(ruta, vacuum=False):
+    conn_main = sqlite3.connect(ruta, isolation_level=None, timeout=60)
+    if vacuum:
+        conn_main.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn_main.execute('VACUUM')
+    else:
+        conn_main.execute('PRAGMA incremental_vacuum')
+    conn_main.close()
 
-logging.info("Procesamiento completado.")
-print("Procesamiento completado.")
\ No newline at end of file
+# Minutos que duran las reservas de los ISBNs copiados a los fragmentos (toda la ejecución)
+CONCESION_FRAGMENTOS_MINUTOS = 7 * 24 * 60
+
+# Función para repartir los ISBNs pendientes de la base de datos entre n fragmentos.
+# Los ISBNs se reservan en la principal a nombre de `propietario` y se copian a cada
+# fragmento sin reserva; con archivo se copia también el hash de su ficha (sin el xml)
+# para que el fragmento sepa qué fichas no han cambiado. Devuelve las rutas de los fragmentos
+def preparar_fragmentos(ruta, n, propietario, archivo=True):
+    conn = abrir_bd(ruta)
+    conn.create_function('fragmento', 1, lambda isbn: FragmentosSQLite.fragmento_de(isbn, n), deterministic=True)
+    ahora = fecha()
+    conn.execute('BEGIN IMMEDIATE')
+    reservados = conn.execute(f'''
+        UPDATE isbns_libros
+        SET propietario = ?, concesion_expira = ?
+        WHERE {CONDICION_PENDIENTE}
+    ''', (propietario, fecha(CONCESION_FRAGMENTOS_MINUTOS), MAX_INTENTOS, ahora, ahora)).rowcount
+    conn.execute('COMMIT')
+    logging.info(f"{reservados} ISBNS reservados para repartir entre {n} fragmentos.")
+
+    columnas = ', '.join(['id', 'isbn'] + [columna for columna, _ in EsquemaSQLite.COLUMNAS_ISBNS_LIBROS
+                                           if columna not in ('propietario', 'concesion_expira')])
+    rutas = []
+    for k in range(n):
+        ruta_f = FragmentosSQLite.ruta_fragmento(ruta, k)
+        FragmentosSQLite.crear_fragmento(ruta_f)
+        conn.execute('ATTACH DATABASE ? AS fragmento', (ruta_f,))
+        conn.execute('BEGIN')
+        conn.execute(f'''
+            INSERT INTO fragmento.isbns_libros ({columnas})
+            SELECT {columnas} FROM main.isbns_libros
+            WHERE propietario = ? AND fragmento(isbn) = ?
+            ORDER BY id
+        ''', (propietario, k))
+        if archivo:
+            conn.execute('''
+                INSERT INTO fragmento.onix_crudo (isbn, hash, compresion, xml, fecha_descarga)
+                SELECT c.isbn, c.hash, c.compresion, NULL, c.fecha_descarga
+                FROM main.onix_crudo c JOIN fragmento.isbns_libros l ON l.isbn = c.isbn
+            ''')
+        conn.execute('COMMIT')
+        conn.execute('DETACH DATABASE fragmento')
+        rutas.append(ruta_f)
+    conn.close()
+    return rutas
+
+# Función de cada proceso del modo fragmentado: procesa los ISBNs de su fragmento como
+# una ejecución normal sobre esa base de datos (con spawn hay que volver a fijar la configuración)
+def trabajar_fragmento(k, ruta_f, user, password, url_base, por_llamada, opciones):
+    global ISBNS_POR_LLAMADA, log_base, log_filename
+    log_base = f'logs_dapi_sqlite_fragmento_{k}'
+    log_filename = os.path.join(log_dir, f'{log_base}_{log_sequence}.txt')
+    iniciar_logs()
+    ISBNS_POR_LLAMADA = por_llamada
+    ClienteDILVE.URL_BASE = url_base
+    process_isbn_batches(user, password, ruta=ruta_f, **opciones)
+
+# Función para procesar los ISBNs pendientes en modo fragmentado: `fragmentos` procesos,
+# cada uno con sus hilos de descarga y su escritor sobre su propio fragmento, y al final
+# la fusión en la base de datos principal. Los fragmentos de una ejecución interrumpida
+# se fusionan antes de repartir de nuevo, así que no se pierde lo que ya se descargó
+def process_isbn_fragmentos(user, password, fragmentos, hilos=HILOS, motor='hilos', concurrencia=None, rps=None, vacuum=False,
+                            procesos=0, archivo=True, normalizado=False, propietario=PROPIETARIO, ruta='book_all_fields.db',
+                            memoria_cola=MEMORIA_COLA_RESULTADOS_MB):
+    preparar_bd(ruta, propietario)
+    conn = abrir_bd(ruta)
+    FragmentosSQLite.fusionar(conn, ruta, normalizado)
+    conn.close()
+    rutas = preparar_fragmentos(ruta, fragmentos, propietario, archivo)
+
+    # El límite de peticiones por segundo y la memoria de la cola de resultados son globales: se reparten
+    # entre los fragmentos. Los fragmentos no llevan índice de búsqueda: se pone al día en la principal al fusionarlos
+    opciones = dict(hilos=hilos, motor=motor, concurrencia=concurrencia, rps=rps / fragmentos if rps else None,
+                    procesos=procesos, archivo=archivo, normalizado=normalizado, busqueda=False,
+                    memoria_cola=memoria_cola / fragmentos)
+    contexto = multiprocessing.get_context('spawn')
+    trabajadores = [contexto.Process(target=trabajar_fragmento,
+                                     args=(k, os.path.abspath(ruta_f), user, password, ClienteDILVE.URL_BASE, ISBNS_POR_LLAMADA,
+                                           dict(opciones, propietario=f'{propietario}-{k}')))
+                    for k, ruta_f in enumerate(rutas)]
+    for trabajador in trabajadores:
+        trabajador.start()
+    for trabajador in trabajadores:
+        trabajador.join()
+        if trabajador.exitcode:
+            logging.error(f"El proceso de un fragmento terminó con código {trabajador.exitcode}.")
+
+    inicio = time.perf_counter()
+    conn = abrir_bd(ruta)
+    FragmentosSQLite.fusionar(conn, ruta, normalizado)
+    conn.close()
+    logging.info(f"Fragmentos fusionados en {time.perf_counter() - inicio:.1f} s.")
+    compactar(ruta, vacuum)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Procesa los ISBNs pendientes de isbns_libros con getRecordsX de DILVE.')
+    parser.add_argument('usuario', help='usuario de DILVE')
+    parser.add_argument('password', metavar='contraseña', help='contraseña de DILVE')
+    parser.add_argument('--hilos', type=int, default=HILOS,
+                        help=f'máximo de hilos de descarga; la concurrencia se adapta sola (por defecto {HILOS})')
+    parser.add_argument('--por-llamada', type=int, default=ISBNS_POR_LLAMADA,
+                        help=f'ISBNs pedidos en cada llamada a getRecordsX (por defecto {ISBNS_POR_LLAMADA})')
+    parser.add_argument('--motor', choices=['hilos', 'async'], default='hilos',
+                        help='motor de descarga: hilos (por defecto) o async (asyncio + aiohttp)')
+    parser.add_argument('--concurrencia', type=int, default=None,
+                        help='máximo de peticiones en vuelo con --motor async (por defecto 200)')
+    parser.add_argument('--rps', type=float, default=None,
+                        help='límite global de peticiones por segundo a DILVE con --motor async')
+    parser.add_argument('--procesos', type=int, default=None,
+                        help=f'procesos que parsean el XML de DILVE; 0 para hacerlo en los hilos de descarga '
+                             f'(por defecto {PROCESOS}, o 0 con --fragmentos)')
+    parser.add_argument('--sin-archivo', action='store_true',
+                        help='no guardar las fichas ONIX comprimidas en onix_crudo')
+    parser.add_argument('--normalizado', action='store_true',
+                        help='guardar también cada Contributor, Subject, Price, etc. como fila propia en las tablas *_normalizado')
+    parser.add_argument('--propietario', default=PROPIETARIO,
+                        help='nombre con el que este proceso reserva ISBNs; distinto en cada proceso que comparta la base de datos '
+                             '(por defecto máquina:pid, distinto en cada ejecución; con uno fijo, una ejecución interrumpida '
+                             'sigue al volver a arrancar por los ISBNs que tenía reservados)')
+    parser.add_argument('--db', default='book_all_fields.db', help='base de datos (por defecto book_all_fields.db)')
+    parser.add_argument('--fragmentos', type=int, default=0,
+                        help='repartir los ISBNs entre N procesos, cada uno con su propia base de datos, y fusionarlas al final')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='VACUUM completo al terminar (reescribe toda la base de datos; por defecto solo incremental)')
+    parser.add_argument('--metricas-puerto', type=int, default=None,
+                        help='servir las métricas en formato Prometheus en http://127.0.0.1:PUERTO/metrics')
+    parser.add_argument('--memoria-cola', type=float, default=MEMORIA_COLA_RESULTADOS_MB,
+                        help=f'MB de resultados que pueden esperar al escritor antes de frenar la descarga (por defecto {MEMORIA_COLA_RESULTADOS_MB})')
+    parser.add_argument('--debug', action='store_true', help='anotar en el log cada ISBN procesado, no solo los errores')
+    parser.add_argument('--url-base', default=ClienteDILVE.URL_BASE,
+                        help='URL base de la API (para pruebas contra MockDILVE.py)')
+    args = parser.parse_args()
+
+    iniciar_logs(logging.DEBUG if args.debug else logging.INFO)
+    ISBNS_POR_LLAMADA = args.por_llamada
+    ClienteDILVE.URL_BASE = args.url_base
+
+    # Ejecutar el procesamiento de lotes
+    if args.fragmentos > 1:
+        # Los fragmentos ya reparten el trabajo entre procesos: sin --procesos el aplanado va en sus hilos
+        process_isbn_fragmentos(args.usuario, args.password, args.fragmentos, args.hilos, args.motor, args.concurrencia,
+                                args.rps, args.vacuum, args.procesos or 0, not args.sin_archivo, args.normalizado,
+                                args.propietario, args.db, args.memoria_cola)
+    else:
+        process_isbn_batches(args.usuario, args.password, args.hilos, args.motor, args.concurrencia, args.rps,
+                             args.vacuum, PROCESOS if args.procesos is None else args.procesos,
+                             not args.sin_archivo, args.normalizado, args.propietario, args.db, args.metricas_puerto,
+                             memoria_cola=args.memoria_cola)
+
+    logging.info("Procesamiento completado.")
+    print("Procesamiento completado.")
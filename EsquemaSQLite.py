@@ -0,0 +1,321 @@
+import json
+import logging
+import os
+import sqlite3
+if os.name == 'nt':
+    from nturl2path import pathname2url
+else:
+    # Lo mismo que urllib.request.pathname2url, sin cargar urllib.request
+    from urllib.parse import quote as pathname2url
+
+# Columnas de isbns_libros además de id e isbn (las bases creadas por
+# ListadoISBNsToSQLite.py antiguas no tienen las de estado). propietario y
+# concesion_expira son la reserva de DAPI_SQLite_v8.py sobre los ISBNs que está
+# descargando; intentos y reintentar_desde, los reintentos de los que fallaron
+COLUMNAS_ISBNS_LIBROS = [
+    ('fecha_extraccion_dilve', 'TEXT'),
+    ('es_editorial', 'BOOLEAN'),
+    ('fecha_importacion', 'TEXT'),
+    ('procesado', 'INTEGER'),
+    ('fecha_procesado', 'TEXT'),
+    ('modificado', 'INTEGER'),
+    ('propietario', 'TEXT'),
+    ('concesion_expira', 'TEXT'),
+    ('intentos', 'INTEGER'),
+    ('reintentar_desde', 'TEXT'),
+]
+
+# Tablas con columna isbn que no son datos de los libros (busqueda es el índice FTS5 de BusquedaDILVE.py)
+TABLAS_CONTROL = ('isbns_libros', 'isbns_eliminados', 'onix_crudo', 'busqueda')
+
+# Tablas con una sola fila por libro: llevan un índice único por isbn
+TABLAS_UNA_FILA = ('libros', 'descriptivedetail', 'collateraldetail', 'publishingdetail', 'contentdetail')
+
+# Archivo con el registro del esquema guardado junto a la base de datos (RegistroEsquema.desde_cache)
+SUFIJO_CACHE = '.esquema.json'
+
+# Índices por campos clave de las tablas normalizadas (todas llevan además uno por isbn)
+INDICES_NORMALIZADOS = {
+    'contributor_normalizado': [('ContributorRole',)],
+    'subject_normalizado': [('SubjectSchemeIdentifier', 'SubjectCode')],
+    'productidentifier_normalizado': [('ProductIDType', 'IDValue')],
+    'price_normalizado': [('PriceType', 'CurrencyCode')],
+}
+
+# Función para crear isbns_libros o añadirle las columnas que le falten
+def asegurar_isbns_libros(conn):
+    # En una base de datos nueva deja auto_vacuum incremental (en las existentes solo tiene
+    # efecto tras un VACUUM completo, ver DAPI_SQLite_v8.py --vacuum)
+    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    columnas = ',\n            '.join(f'{columna} {tipo}' for columna, tipo in COLUMNAS_ISBNS_LIBROS)
+    conn.execute(f'''
+        CREATE TABLE IF NOT EXISTS isbns_libros (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            isbn TEXT UNIQUE,
+            {columnas}
+        )
+    ''')
+    existentes = {columna[1].lower() for columna in conn.execute('PRAGMA table_info(isbns_libros)')}
+    for columna, tipo in COLUMNAS_ISBNS_LIBROS:
+        if columna not in existentes:
+            conn.execute(f'ALTER TABLE isbns_libros ADD COLUMN {columna} {tipo}')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_isbn ON isbns_libros (isbn)')
+    conn.commit()
+
+# Función para crear onix_crudo, el archivo de las fichas ONIX tal como llegan de
+# DILVE (comprimidas), con el hash de su contenido y la fecha de descarga
+def asegurar_onix_crudo(conn):
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS onix_crudo (
+            isbn TEXT PRIMARY KEY,
+            hash TEXT,
+            compresion TEXT,
+            xml BLOB,
+            fecha_descarga TEXT
+        )
+    ''')
+    conn.commit()
+
+# Función para crear busqueda, el índice de texto completo (FTS5) de títulos, autores,
+# descripciones y materias. Su rowid es el id del ISBN en isbns_libros.
+# Devuelve True si la tabla no existía (y hay que llenarla con BusquedaDILVE.reconstruir)
+def asegurar_busqueda(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'busqueda'").fetchone():
+        return False
+    conn.execute('''
+        CREATE VIRTUAL TABLE busqueda USING fts5(
+            isbn UNINDEXED, titulo, subtitulo, autores, descripcion, materias,
+            tokenize = 'unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.commit()
+    return True
+
+# Función para abrir la base de datos solo para leer (sin crearla ni bloquear a los escritores)
+def abrir_lectura(ruta='book_all_fields.db'):
+    return sqlite3.connect(f'file:{pathname2url(os.path.abspath(ruta))}?mode=ro', uri=True)
+
+# Función para la firma del esquema actual: schema_version cambia con cada DDL y el número
+# y tamaño de las sentencias de sqlite_master distinguen otra base de datos recreada en la misma ruta
+def firma_esquema(conn):
+    version = conn.execute('PRAGMA schema_version').fetchone()[0]
+    objetos, tamano = conn.execute('SELECT COUNT(*), TOTAL(LENGTH(sql)) FROM sqlite_master').fetchone()
+    return f'{version}:{objetos}:{int(tamano)}'
+
+# Registro en memoria de las tablas y columnas de la base de datos.
+# Se carga una vez desde sqlite_master / PRAGMA table_info y solo lanza DDL
+# cuando aparece una tabla o una columna que todavía no existe.
+class RegistroEsquema:
+    def __init__(self, conn):
+        self.tablas = {}
+        self.nombres = {}
+        self.indices = set()
+        self.sql_insert = {}
+        self.firma = None
+        self.firma_cache = None
+        if conn is not None:
+            self.recargar(conn)
+
+    # Función para (re)leer el esquema real; hay que llamarla tras un ROLLBACK que deshaga DDL
+    def recargar(self, conn):
+        # La firma se lee antes: si otra conexión cambia el esquema mientras tanto, la
+        # firma guardada queda atrasada y la caché se descarta en lugar de quedar incompleta
+        self.firma = firma_esquema(conn)
+        self.tablas = {}
+        self.nombres = {}
+        for (nombre,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+            columnas = conn.execute(f'PRAGMA table_info("{nombre}")').fetchall()
+            self.tablas[nombre.lower()] = {columna[1].lower() for columna in columnas}
+            self.nombres[nombre.lower()] = nombre
+        self.indices = {nombre.lower() for (nombre,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+
+    # Función para releer el esquema solo si ha cambiado desde la última lectura (DDL de otra
+    # conexión, o de esta misma); para registros que viven mucho, como el del servicio de ConsultaDILVE.py
+    def refrescar(self, conn):
+        if firma_esquema(conn) != self.firma:
+            self.recargar(conn)
+
+    # Función para cargar el registro desde la caché de la base de datos `ruta` sin leer cada
+    # tabla con PRAGMA table_info; devuelve None si no hay caché o el esquema ha cambiado
+    @classmethod
+    def desde_cache(cls, conn, ruta):
+        try:
+            with open(ruta + SUFIJO_CACHE, encoding='utf-8') as archivo:
+                cache = json.load(archivo)
+        except (OSError, ValueError):
+            return None
+        if cache.get('firma') != firma_esquema(conn):
+            return None
+        registro = cls(None)
+        registro.firma = registro.firma_cache = cache['firma']
+        registro.tablas = {clave: set(columnas) for clave, columnas in cache['tablas'].items()}
+        registro.nombres = cache['nombres']
+        registro.indices = set(cache['indices'])
+        return registro
+
+    # Función para guardar el registro en la caché de la base de datos `ruta` (archivo temporal +
+    # os.replace) si no está ya al día. Si el esquema ha cambiado desde que se leyó (DDL de esta
+    # conexión o de otra) se vuelve a leer antes, para no guardar un registro con la firma de otro esquema
+    def guardar_cache(self, conn, ruta):
+        firma = firma_esquema(conn)
+        if firma == self.firma_cache:
+            return
+        if firma != self.firma:
+            self.recargar(conn)
+        cache = {
+            'firma': self.firma,
+            'tablas': {clave: sorted(columnas) for clave, columnas in self.tablas.items()},
+            'nombres': self.nombres,
+            'indices': sorted(self.indices),
+        }
+        temporal = ruta + SUFIJO_CACHE + '.tmp'
+        try:
+            with open(temporal, 'w', encoding='utf-8') as archivo:
+                json.dump(cache, archivo)
+            os.replace(temporal, ruta + SUFIJO_CACHE)
+            self.firma_cache = self.firma
+        except OSError as e:
+            logging.warning(f"No se pudo guardar la caché del esquema de {ruta}: {e}")
+
+    # Función para saber si una tabla existe
+    def existe(self, table_name):
+        return table_name.lower() in self.tablas
+
+    # Función para listar las tablas de datos de los libros (las que tienen isbn, salvo TABLAS_CONTROL)
+    def tablas_de_datos(self):
+        return [self.nombres[clave] for clave, columnas in self.tablas.items()
+                if clave not in TABLAS_CONTROL and 'isbn' in columnas]
+
+    # Función para las tablas de datos en las que un ISBN tiene filas, con una sola consulta
+    # (un EXISTS por el índice de isbn de cada tabla) en lugar de una sentencia por tabla.
+    # La consulta se cachea mientras no cambie la lista de tablas
+    def tablas_con_filas(self, cursor, isbn):
+        tablas = tuple(self.tablas_de_datos())
+        clave = ('CON_FILAS', tablas)
+        consultas = self.sql_insert.get(clave)
+        if consultas is None:
+            partes = [f"SELECT '{table_name}' WHERE EXISTS (SELECT 1 FROM {table_name} WHERE isbn = ?1)"
+                      for table_name in tablas]
+            # SQLite admite como mucho 500 SELECT en una consulta compuesta
+            consultas = [' UNION ALL '.join(partes[i:i + 400]) for i in range(0, len(partes), 400)]
+            self.sql_insert[clave] = consultas
+        return [table_name for sql in consultas for (table_name,) in cursor.execute(sql, (isbn,))]
+
+    # Función para los índices que debe tener una tabla de datos: lista de (columnas, único).
+    # Todas llevan uno por isbn (único en TABLAS_UNA_FILA) para los DELETE/UPDATE por ISBN
+    def indices_deseados(self, table_name):
+        clave = table_name.lower()
+        if clave in TABLAS_CONTROL:
+            return []
+        if clave in TABLAS_UNA_FILA:
+            return [(('isbn',), True)]
+        return [(('isbn',), False)] + [(columnas, False) for columnas in INDICES_NORMALIZADOS.get(clave, [])]
+
+    # Función para crear los índices de la tabla cuyas columnas ya existan.
+    # Antes de un índice único se quitan los duplicados, quedándose con la fila más reciente
+    def asegurar_indices(self, cursor, table_name):
+        existentes = self.tablas[table_name.lower()]
+        for columnas, unico in self.indices_deseados(table_name):
+            nombre = f"{'uq' if unico else 'idx'}_{table_name}_{'_'.join(columnas)}".lower()
+            if nombre in self.indices or not all(columna.lower() in existentes for columna in columnas):
+                continue
+            if unico:
+                cursor.execute(f'''
+                    DELETE FROM {table_name}
+                    WHERE id NOT IN (SELECT MAX(id) FROM {table_name} GROUP BY {', '.join(columnas)})
+                ''')
+                if cursor.rowcount > 0:
+                    logging.info(f"{cursor.rowcount} filas duplicadas eliminadas de {table_name}.")
+            cursor.execute(f"CREATE {'UNIQUE ' if unico else ''}INDEX IF NOT EXISTS {nombre} ON {table_name} ({', '.join(columnas)})")
+            self.indices.add(nombre)
+
+    # Función para crear los índices que falten en las tablas ya existentes (bases de datos antiguas)
+    def migrar_indices(self, conn):
+        cursor = conn.cursor()
+        for table_name in self.tablas_de_datos():
+            self.asegurar_indices(cursor, table_name)
+        conn.commit()
+
+    # Función para crear la tabla o las columnas que falten (y sus índices)
+    def asegurar_columnas(self, cursor, table_name, columns):
+        existentes = self.tablas.get(table_name.lower())
+        if existentes is None:
+            column_names = ', '.join(columns)
+            cursor.execute(f'''CREATE TABLE IF NOT EXISTS {table_name} (
+                                id INTEGER PRIMARY KEY,
+                                isbn TEXT,
+                                {column_names}
+                            )''')
+            self.tablas[table_name.lower()] = {'id', 'isbn'} | {column.lower() for column in columns}
+            self.nombres[table_name.lower()] = table_name
+            self.asegurar_indices(cursor, table_name)
+            return
+
+        nuevas = False
+        for column in columns:
+            if column.lower() not in existentes:
+                try:
+                    cursor.execute(f'''ALTER TABLE {table_name} ADD COLUMN {column} TEXT''')
+                except sqlite3.OperationalError:
+                    pass  # creada por otra conexión mientras tanto
+                existentes.add(column.lower())
+                nuevas = True
+        if nuevas:
+            self.asegurar_indices(cursor, table_name)
+
+    # Función para obtener (y cachear) el INSERT de una tabla y un conjunto de columnas
+    def sql_insercion(self, table_name, columns, verbo='INSERT OR IGNORE'):
+        clave = (verbo, table_name, tuple(columns))
+        sql = self.sql_insert.get(clave)
+        if sql is None:
+            column_names = ', '.join(columns)
+            placeholders = ', '.join(['?' for _ in columns])
+            sql = f'''{verbo} INTO {table_name} (isbn, {column_names})
+                       VALUES (?, {placeholders})'''
+            self.sql_insert[clave] = sql
+        return sql
+
+    # Función para insertar una fila creando antes lo que falte del esquema
+    def insertar(self, cursor, table_name, isbn, columns, values):
+        self.asegurar_columnas(cursor, table_name, columns)
+        cursor.execute(self.sql_insercion(table_name, columns), [isbn] + list(values))
+        return cursor.lastrowid
+
+    # Función para obtener (y cachear) el UPSERT de una tabla de TABLAS_UNA_FILA: inserta la
+    # fila o, si el isbn ya está, la sobrescribe entera (las columnas que no vienen quedan a NULL)
+    def sql_sustitucion(self, table_name, columns):
+        existentes = self.tablas[table_name.lower()]
+        # Las columnas solo crecen, así que su número identifica la versión de la tabla
+        clave = ('UPSERT', table_name, tuple(columns), len(existentes))
+        sql = self.sql_insert.get(clave)
+        if sql is None:
+            nuevas = {column.lower() for column in columns}
+            asignaciones = [f'{column} = excluded.{column}' for column in columns]
+            asignaciones += [f'{column} = NULL' for column in sorted(existentes - nuevas - {'id', 'isbn'})]
+            sql = f'''{self.sql_insercion(table_name, columns, 'INSERT')}
+                       ON CONFLICT (isbn) DO UPDATE SET {', '.join(asignaciones)}'''
+            self.sql_insert[clave] = sql
+        return sql
+
+    # Función para escribir la única fila de un libro en una tabla de TABLAS_UNA_FILA con un solo UPSERT
+    def sustituir(self, cursor, table_name, isbn, columns, values):
+        self.asegurar_columnas(cursor, table_name, columns)
+        cursor.execute(self.sql_sustitucion(table_name, columns), [isbn] + list(values))
+
+    # Función para reescribir un libro que puede estar ya en las tablas: un UPSERT por cada tabla
+    # de una sola fila (libros, DescriptiveDetail, ...) y, en las demás y en las de una fila
+    # que ya no vienen, borrado de sus filas anteriores antes de insertar las nuevas. Solo se
+    # borra en las tablas donde el libro tiene filas (tablas_con_filas).
+    # Las *_normalizado solo se reescriben con `normalizado`; sin él se dejan como están
+    def reescribir(self, cursor, isbn, filas, normalizado=False):
+        una_fila = {table_name.lower() for table_name, _, _ in filas} & set(TABLAS_UNA_FILA)
+        for table_name in self.tablas_con_filas(cursor, isbn):
+            if not normalizado and table_name.lower().endswith('_normalizado'):
+                continue
+            if table_name.lower() not in una_fila:
+                cursor.execute(f'DELETE FROM {table_name} WHERE isbn = ?', (isbn,))
+        for table_name, columns, values in filas:
+            if table_name.lower() in una_fila:
+                self.sustituir(cursor, table_name, isbn, columns, values)
+            else:
+                self.insertar(cursor, table_name, isbn, columns, values)
@@ -0,0 +1,9 @@
+@echo off
+
+REM Leer las variables de configuración desde config.txt
+for /F "tokens=1,2 delims==" %%A in (config.txt) do (
+    set %%A=%%B
+)
+
+REM Exportar a exportacion_filemaker\ los ISBNs procesados desde la última exportación
+%PYTHON_PATH_ConsultaDilve% %SCRIPT_PATH_ExportarFileMaker%
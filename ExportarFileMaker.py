@@ -0,0 +1,269 @@
+import argparse
+import csv
+import glob
+import logging
+import os
+import sqlite3
+import time
+from datetime import datetime
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+import EsquemaSQLite
+
+# Exportación de book_all_fields.db para DILVE.fmp12: una sola fila por ISBN con
+# todas las columnas de las tablas de datos, en archivos CSV (y/o Parquet) de
+# como mucho FILAS_POR_ARCHIVO filas, para que FileMaker importe un archivo
+# secuencial en lugar de hacer una consulta ODBC por tabla y registro.
+# Cada tabla se lee con una consulta agrupada por ISBN por cada lote de ISBNs; las
+# tablas con varias filas por libro (Contributor, Subject, ...) juntan sus valores
+# con SEPARADOR_FILAS, en el orden en que se guardaron.
+# Solo se exportan los ISBNs procesados desde la última exportación (ARCHIVO_MARCA), y en
+# archivos aparte (SUFIJO_ELIMINADOS) los dados de baja desde entonces por SincronizarDILVE.py.
+
+ARCHIVO_MARCA = 'ultimaExportacionFileMaker.txt'
+CARPETA_EXPORTACION = 'exportacion_filemaker'
+# Sufijo del prefijo de los archivos de bajas (dilve_AAAAMMDD_HHMMSS_eliminados_0001.csv, ...)
+SUFIJO_ELIMINADOS = 'eliminados'
+FORMATO_FECHA = '%Y-%m-%d %H:%M:%S'
+# ISBNs que se leen de cada tabla en una consulta
+ISBNS_POR_LOTE = 2000
+# Filas de cada archivo exportado
+FILAS_POR_ARCHIVO = 50000
+# Separador entre las filas de un mismo libro en las tablas con varias filas
+# (' ; ' ya separa los elementos repetidos dentro de una fila)
+SEPARADOR_FILAS = ' | '
+
+# Función para configurar el registro
+def iniciar_logs():
+    # Crear la carpeta de logs si no existe
+    log_dir = 'logs'
+    os.makedirs(log_dir, exist_ok=True)
+    log_filename = os.path.join(log_dir, 'logs_exportar_filemaker.txt')
+    logging.basicConfig(filename=log_filename, level=logging.INFO,
+                        format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+
+# Función para leer la marca de la última exportación
+def leer_marca():
+    if not os.path.exists(ARCHIVO_MARCA):
+        return None
+    with open(ARCHIVO_MARCA, encoding='utf-8') as archivo:
+        return archivo.read().strip() or None
+
+# Función para guardar la marca de forma atómica (archivo temporal + os.replace)
+def guardar_marca(marca):
+    temporal = ARCHIVO_MARCA + '.tmp'
+    with open(temporal, 'w', encoding='utf-8') as archivo:
+        archivo.write(marca)
+        archivo.flush()
+        os.fsync(archivo.fileno())
+    os.replace(temporal, ARCHIVO_MARCA)
+
+# Función para normalizar fecha_procesado: DAPI_SQLite_v8.py la guarda sin espacio entre
+# la fecha y la hora y ConsultaDILVE.py con espacio; sin espacios se pueden comparar como texto
+def fecha_comparable(fecha):
+    return fecha.replace(' ', '') if fecha else fecha
+
+# Función para las tablas que se exportan y sus columnas: lista de (tabla, [columnas]).
+# libros va primero; las *_normalizado repiten los datos de las clásicas y no se exportan
+def tablas_exportadas(conn):
+    esquema = EsquemaSQLite.RegistroEsquema(conn)
+    tablas = []
+    for table_name in esquema.tablas_de_datos():
+        if table_name.lower().endswith('_normalizado'):
+            continue
+        columnas = [columna[1] for columna in conn.execute(f'PRAGMA table_info("{table_name}")').fetchall()
+                    if columna[1].lower() not in ('id', 'isbn')]
+        if columnas:
+            tablas.append((table_name, columnas))
+    tablas.sort(key=lambda tabla: tabla[0].lower() != 'libros')
+    return tablas
+
+# Función para el nombre de una columna en la exportación: las de libros tal cual y las
+# demás con el nombre de su tabla delante (si no lo llevan ya, p. ej. ProductIdentifier_IDValue)
+def nombre_exportado(table_name, columna):
+    if table_name.lower() == 'libros' or columna.lower().startswith(table_name.lower() + '_'):
+        return columna
+    return f'{table_name}_{columna}'
+
+# Función para la consulta agrupada por ISBN de una tabla para un lote de temp.exportacion
+def sql_tabla(table_name, columnas):
+    if table_name.lower() in EsquemaSQLite.TABLAS_UNA_FILA:
+        valores = ', '.join(f't.{columna}' for columna in columnas)
+        return f'''
+            SELECT t.isbn, {valores}
+            FROM temp.exportacion e JOIN {table_name} t ON t.isbn = e.isbn
+            WHERE e.n BETWEEN ? AND ?
+        '''
+    # Los NULL cuentan como '' para que las posiciones de cada columna se correspondan entre sí
+    valores = ', '.join(
+        f"CASE WHEN COUNT({columna}) THEN group_concat(COALESCE({columna}, ''), '{SEPARADOR_FILAS}') END"
+        for columna in columnas)
+    return f'''
+        SELECT isbn, {valores}
+        FROM (SELECT t.isbn, t.id, {', '.join(f't.{columna}' for columna in columnas)}
+              FROM temp.exportacion e JOIN {table_name} t ON t.isbn = e.isbn
+              WHERE e.n BETWEEN ? AND ?
+              ORDER BY t.isbn, t.id)
+        GROUP BY isbn
+    '''
+
+# Función para leer las filas exportadas, lote a lote, de los ISBNs de temp.exportacion
+def filas_exportadas(conn, tablas, total):
+    consultas = [(sql_tabla(table_name, columnas), len(columnas)) for table_name, columnas in tablas]
+    for primero in range(1, total + 1, ISBNS_POR_LOTE):
+        ultimo = primero + ISBNS_POR_LOTE - 1
+        lote = conn.execute('SELECT isbn, fecha_procesado FROM temp.exportacion WHERE n BETWEEN ? AND ? ORDER BY n',
+                            (primero, ultimo)).fetchall()
+        partes = []
+        for sql, ancho in consultas:
+            por_isbn = {fila[0]: fila[1:] for fila in conn.execute(sql, (primero, ultimo))}
+            partes.append((por_isbn, (None,) * ancho))
+        for isbn, fecha_procesado in lote:
+            fila = [isbn, fecha_procesado]
+            for por_isbn, vacia in partes:
+                fila.extend(por_isbn.get(isbn, vacia))
+            yield fila
+
+# Función para escribir las bajas de isbns_eliminados (la tabla la crea SincronizarDILVE.py) desde
+# `desde` (todas si es None), salvo las de los ISBNs que se han vuelto a dar de alta.
+# Devuelve (bajas exportadas, archivos escritos, fecha de la última baja)
+def exportar_eliminados(conn, desde, carpeta, prefijo, formatos, filas_por_archivo):
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'isbns_eliminados'").fetchone():
+        return 0, [], None
+    filas = conn.execute('''
+        SELECT isbn, fecha_eliminacion FROM isbns_eliminados
+        WHERE (? IS NULL OR replace(fecha_eliminacion, ' ', '') >= ?)
+          AND isbn NOT IN (SELECT isbn FROM isbns_libros)
+        ORDER BY fecha_eliminacion, isbn
+    ''', (desde, fecha_comparable(desde))).fetchall()
+    salida = ArchivosExportacion(carpeta, f'{prefijo}_{SUFIJO_ELIMINADOS}', ['isbn', 'fecha_eliminacion'],
+                                 formatos, filas_por_archivo)
+    for fila in filas:
+        salida.escribir(list(fila))
+    salida.volcar()
+    return len(filas), salida.archivos, max((fecha for _, fecha in filas), default=None)
+
+# Función para el prefijo de los archivos de una exportación (dilve_AAAAMMDD_HHMMSS), sin
+# pisar los de otra exportación del mismo segundo que FileMaker no haya importado todavía
+def prefijo_libre(carpeta):
+    prefijo = f"dilve_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+    candidato = prefijo
+    n = 1
+    while glob.glob(os.path.join(glob.escape(carpeta), glob.escape(candidato) + '_*')):
+        n += 1
+        candidato = f'{prefijo}_{n}'
+    return candidato
+
+# Escritura de la exportación en archivos de como mucho filas_por_archivo filas. Cada
+# archivo se escribe con otro nombre y se renombra al cerrarlo, para que FileMaker no
+# lea nunca uno a medias
+class ArchivosExportacion:
+    def __init__(self, carpeta, prefijo, cabecera, formatos, filas_por_archivo):
+        os.makedirs(carpeta, exist_ok=True)
+        self.carpeta = carpeta
+        self.prefijo = prefijo
+        self.cabecera = cabecera
+        self.formatos = formatos
+        self.filas_por_archivo = filas_por_archivo
+        self.filas = []
+        self.archivos = []
+
+    def escribir(self, fila):
+        self.filas.append(fila)
+        if len(self.filas) >= self.filas_por_archivo:
+            self.volcar()
+
+    def volcar(self):
+        if not self.filas:
+            return
+        base = os.path.join(self.carpeta, f'{self.prefijo}_{len(self.archivos) // len(self.formatos) + 1:04d}')
+        if 'csv' in self.formatos:
+            with open(base + '.csv.tmp', 'w', encoding='utf-8', newline='') as archivo:
+                escritor = csv.writer(archivo)
+                escritor.writerow(self.cabecera)
+                escritor.writerows(self.filas)
+            os.replace(base + '.csv.tmp', base + '.csv')
+            self.archivos.append(base + '.csv')
+        if 'parquet' in self.formatos:
+            columnas = {nombre: [fila[i] for fila in self.filas] for i, nombre in enumerate(self.cabecera)}
+            tabla = pyarrow.table({nombre: pyarrow.array(valores, type=pyarrow.string()) for nombre, valores in columnas.items()})
+            pyarrow.parquet.write_table(tabla, base + '.parquet.tmp')
+            os.replace(base + '.parquet.tmp', base + '.parquet')
+            self.archivos.append(base + '.parquet')
+        self.filas = []
+
+# Función para exportar los ISBNs procesados y las bajas después de `desde` (todos si es None).
+# Devuelve (ISBNs exportados, bajas exportadas, archivos escritos, marca nueva)
+def exportar(ruta='book_all_fields.db', desde=None, carpeta=CARPETA_EXPORTACION, formatos=('csv',),
+             filas_por_archivo=FILAS_POR_ARCHIVO):
+    if 'parquet' in formatos and pyarrow is None:
+        raise RuntimeError("Para exportar a Parquet instale pyarrow (pip install pyarrow).")
+    conn = sqlite3.connect(ruta)
+    # Toda la exportación sale de la misma instantánea aunque DAPI_SQLite_v8.py esté escribiendo
+    conn.execute('BEGIN')
+    tablas = tablas_exportadas(conn)
+
+    conn.execute('DROP TABLE IF EXISTS temp.exportacion')
+    conn.execute('''
+        CREATE TEMP TABLE exportacion (
+            n INTEGER PRIMARY KEY,
+            isbn TEXT,
+            fecha_procesado TEXT
+        )
+    ''')
+    # >= y no >: los ISBNs del mismo segundo que la marca pueden haberse guardado después
+    # de la exportación anterior; repetirlos no cambia nada al importar por ISBN.
+    # fecha_procesado se exporta siempre como FORMATO_FECHA
+    total = conn.execute('''
+        INSERT INTO temp.exportacion (isbn, fecha_procesado)
+        SELECT isbn, substr(fecha, 1, 10) || ' ' || substr(fecha, 11)
+        FROM (SELECT id, isbn, replace(fecha_procesado, ' ', '') AS fecha FROM isbns_libros
+              WHERE procesado = 1 AND fecha_procesado IS NOT NULL)
+        WHERE ? IS NULL OR fecha >= ?
+        ORDER BY id
+    ''', (desde, fecha_comparable(desde))).rowcount
+    marca = conn.execute("SELECT MAX(fecha_procesado) FROM temp.exportacion").fetchone()[0]
+
+    cabecera = ['isbn', 'fecha_procesado'] + [nombre_exportado(table_name, columna)
+                                              for table_name, columnas in tablas for columna in columnas]
+    prefijo = prefijo_libre(carpeta)
+    salida = ArchivosExportacion(carpeta, prefijo, cabecera, formatos, filas_por_archivo)
+    for fila in filas_exportadas(conn, tablas, total):
+        salida.escribir(fila)
+    salida.volcar()
+    eliminados, archivos_eliminados, ultima_baja = exportar_eliminados(conn, desde, carpeta, prefijo, formatos,
+                                                                       filas_por_archivo)
+    conn.rollback()
+    conn.close()
+    # Las dos fechas están en FORMATO_FECHA, así que se comparan como texto
+    marca = max(filter(None, (marca, ultima_baja)), default=None)
+    return total, eliminados, salida.archivos + archivos_eliminados, marca or desde
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Exporta book_all_fields.db a CSV/Parquet con una fila por ISBN para FileMaker.')
+    parser.add_argument('--db', default='book_all_fields.db', help='base de datos (por defecto book_all_fields.db)')
+    parser.add_argument('--carpeta', default=CARPETA_EXPORTACION, help=f'carpeta de los archivos (por defecto {CARPETA_EXPORTACION})')
+    parser.add_argument('--formato', choices=['csv', 'parquet', 'ambos'], default='csv', help='formato de los archivos (por defecto csv)')
+    parser.add_argument('--filas-por-archivo', type=int, default=FILAS_POR_ARCHIVO,
+                        help=f'filas de cada archivo (por defecto {FILAS_POR_ARCHIVO})')
+    parser.add_argument('--desde', help=f'exportar los ISBNs procesados desde esta fecha ({FORMATO_FECHA}); por defecto la guardada en {ARCHIVO_MARCA}')
+    parser.add_argument('--todo', action='store_true', help='exportar todos los ISBNs procesados sin mirar la marca')
+    args = parser.parse_args()
+
+    iniciar_logs()
+    desde = None if args.todo else (args.desde or leer_marca())
+    formatos = ('csv', 'parquet') if args.formato == 'ambos' else (args.formato,)
+    inicio = time.perf_counter()
+    total, eliminados, archivos, marca = exportar(args.db, desde, args.carpeta, formatos, args.filas_por_archivo)
+    # La marca solo avanza cuando todos los archivos están escritos
+    if marca is not None:
+        guardar_marca(marca)
+    logging.info(f"Exportación para FileMaker: {total} ISBNs y {eliminados} bajas desde {desde or 'el principio'} "
+                 f"en {len(archivos)} archivos.")
+    print(f"Exportación completada: {total} ISBNs y {eliminados} bajas en {len(archivos)} archivos "
+          f"({time.perf_counter() - inicio:.1f} s).")
+    for archivo in archivos:
+        print(archivo)
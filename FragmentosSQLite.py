@@ -0,0 +1,126 @@
+import glob
+import logging
+import os
+import sqlite3
+import zlib
+import EsquemaSQLite
+import BusquedaDILVE
+
+# Modo fragmentado de DAPI_SQLite_v8.py (--fragmentos N): los ISBNs pendientes se
+# reparten por un hash del ISBN entre N bases de datos (book_all_fields_fragmento_K.db),
+# cada una con su propio proceso de descarga y su propio escritor, y al terminar se
+# fusionan en la base de datos principal con un INSERT ... SELECT por tabla.
+# La fusión se puede repetir sin duplicar filas, así que los fragmentos que queden de
+# una ejecución interrumpida se fusionan sin más al volver a arrancar.
+
+# Función para el fragmento (0..n-1) de un ISBN; crc32 para que no cambie entre ejecuciones
+def fragmento_de(isbn, n):
+    return zlib.crc32((isbn or '').encode('utf-8')) % n
+
+# Función para la ruta del fragmento k de una base de datos
+def ruta_fragmento(ruta, k):
+    base, extension = os.path.splitext(ruta)
+    return f'{base}_fragmento_{k}{extension}'
+
+# Función para las rutas de los fragmentos de una base de datos que hay en disco
+def fragmentos_existentes(ruta):
+    base, extension = os.path.splitext(ruta)
+    return sorted(glob.glob(f'{glob.escape(base)}_fragmento_*{extension}'))
+
+# Función para crear un fragmento vacío con las tablas de control
+def crear_fragmento(ruta_f):
+    for archivo in (ruta_f, ruta_f + '-wal', ruta_f + '-shm'):
+        if os.path.exists(archivo):
+            os.remove(archivo)
+    conn = sqlite3.connect(ruta_f)
+    EsquemaSQLite.asegurar_isbns_libros(conn)
+    EsquemaSQLite.asegurar_onix_crudo(conn)
+    conn.close()
+
+# Función para fusionar un fragmento en la base de datos abierta en `conn` (isolation_level=None).
+# En el fragmento, una ficha de onix_crudo sin xml es la copia del hash de la principal: si
+# sigue así el ISBN no cambió y sus filas de la principal se quedan como están. El resto de
+# ISBNs procesados se borran de la principal y se copian del fragmento, todo en una transacción.
+# Las *_normalizado de la principal solo se borran con `normalizado` o si el fragmento las tiene
+# (lo llenó una ejecución con --normalizado); si no, se dejan como están.
+# Devuelve (ISBNs reescritos, ISBNs en el fragmento)
+def fusionar_fragmento(conn, esquema, ruta_f, normalizado=False):
+    cursor = conn.cursor()
+    cursor.execute('ATTACH DATABASE ? AS fragmento', (ruta_f,))
+    try:
+        cursor.execute('BEGIN IMMEDIATE')
+        cursor.execute('DROP TABLE IF EXISTS temp.fusion_isbns')
+        cursor.execute('''
+            CREATE TEMP TABLE fusion_isbns AS
+            SELECT l.isbn
+            FROM fragmento.isbns_libros l LEFT JOIN fragmento.onix_crudo c ON c.isbn = l.isbn
+            WHERE l.procesado = 1 AND (c.isbn IS NULL OR c.xml IS NOT NULL)
+        ''')
+        reescritos = cursor.execute('SELECT COUNT(*) FROM fusion_isbns').fetchone()[0]
+
+        tablas = [nombre for (nombre,) in cursor.execute(
+            "SELECT name FROM fragmento.sqlite_master WHERE type = 'table' ORDER BY rowid").fetchall()]
+        en_fragmento = {nombre.lower() for nombre in tablas}
+        for table_name in esquema.tablas_de_datos():
+            if not normalizado and table_name.lower().endswith('_normalizado') and table_name.lower() not in en_fragmento:
+                continue
+            cursor.execute(f'DELETE FROM main.{table_name} WHERE isbn IN (SELECT isbn FROM fusion_isbns)')
+
+        for table_name in tablas:
+            if table_name.lower() in EsquemaSQLite.TABLAS_CONTROL or table_name.startswith('sqlite_'):
+                continue
+            columnas = [columna[1] for columna in cursor.execute(f'PRAGMA fragmento.table_info("{table_name}")').fetchall()]
+            if 'isbn' not in {columna.lower() for columna in columnas}:
+                continue
+            columns = [columna for columna in columnas if columna.lower() not in ('id', 'isbn')]
+            esquema.asegurar_columnas(cursor, table_name, columns)
+            column_names = ', '.join(['isbn'] + columns)
+            cursor.execute(f'''
+                INSERT OR IGNORE INTO main.{table_name} ({column_names})
+                SELECT {column_names} FROM fragmento.{table_name} ORDER BY id
+            ''')
+
+        # Los reescritos sin ficha nueva (--sin-archivo) pierden la anterior, que ya no corresponde a sus filas
+        cursor.execute('DELETE FROM main.onix_crudo WHERE isbn IN (SELECT isbn FROM fusion_isbns)')
+        cursor.execute('''
+            INSERT OR REPLACE INTO main.onix_crudo (isbn, hash, compresion, xml, fecha_descarga)
+            SELECT isbn, hash, compresion, xml, fecha_descarga FROM fragmento.onix_crudo WHERE xml IS NOT NULL
+        ''')
+        cursor.execute('''
+            UPDATE main.onix_crudo AS c
+            SET fecha_descarga = f.fecha_descarga
+            FROM fragmento.onix_crudo AS f
+            WHERE f.isbn = c.isbn AND f.xml IS NULL
+        ''')
+        # Estado de cada ISBN tal como quedó en el fragmento (los que no se llegaron a pedir vuelven a estar pendientes)
+        total = cursor.execute('''
+            UPDATE main.isbns_libros AS l
+            SET procesado = f.procesado, fecha_procesado = f.fecha_procesado, modificado = f.modificado,
+                intentos = f.intentos, reintentar_desde = f.reintentar_desde,
+                propietario = NULL, concesion_expira = NULL
+            FROM fragmento.isbns_libros AS f
+            WHERE f.isbn = l.isbn
+        ''').rowcount
+        # Los fragmentos no tienen índice de búsqueda: los ISBNs reescritos se indexan desde sus filas nuevas
+        if esquema.existe('busqueda'):
+            BusquedaDILVE.reindexar(cursor, esquema, 'SELECT isbn FROM temp.fusion_isbns')
+        cursor.execute('DROP TABLE temp.fusion_isbns')
+        cursor.execute('COMMIT')
+    except sqlite3.Error:
+        if conn.in_transaction:
+            cursor.execute('ROLLBACK')
+        esquema.recargar(conn)
+        raise
+    finally:
+        cursor.execute('DETACH DATABASE fragmento')
+    return reescritos, total
+
+# Función para fusionar y borrar todos los fragmentos de una base de datos que haya en disco
+def fusionar(conn, ruta, normalizado=False):
+    esquema = EsquemaSQLite.RegistroEsquema(conn)
+    for ruta_f in fragmentos_existentes(ruta):
+        reescritos, total = fusionar_fragmento(conn, esquema, ruta_f, normalizado)
+        logging.info(f"Fragmento {ruta_f} fusionado: {total} ISBNs, {reescritos} con filas nuevas.")
+        for archivo in (ruta_f, ruta_f + '-wal', ruta_f + '-shm'):
+            if os.path.exists(archivo):
+                os.remove(archivo)
@@ -3,56 +3,94 @@ import xml.etree.ElementTree as ET
 import os
 import shutil
 import re
-import requests
+import ClienteDILVE
+import EsquemaSQLite
 from datetime import datetime
 import logging
 import sys
 
-#verificar de credenciales y parámetros
-if len(sys.argv) != 4:
-    print("\nDebe proporcionar usuario, contraseña y nombre del programa como argumentos:")
-    print("python ListadoISBNsToSQLite.py <usuario> <contraseña> <nombre_programa>\n")
-    sys.exit(1)
-user = sys.argv[1]
-password = sys.argv[2]
-program_name = sys.argv[3]
-
-#crear la carpeta de logs si no existe
-log_dir = 'E:\\dilve_rutas\\logs_isbns'
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
-
-#configurar el registro en el archivo log.txt
-logging.basicConfig(filename='log.txt', level=logging.INFO,
-                    format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
-
-#conectar a la base de datos SQLite
-conn = sqlite3.connect('book_all_fields.db')
-cursor = conn.cursor()
-
-#crear tabla si no existe y agregar índice
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS isbns_libros (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        isbn TEXT UNIQUE,
-        fecha_extraccion_dilve TEXT,
-        es_editorial BOOLEAN,
-        fecha_importacion TEXT
-    )
-''')
-cursor.execute('CREATE INDEX IF NOT EXISTS idx_isbn ON isbns_libros (isbn)')
-
-conn.commit()
+#ISBNs que se envían a la base de datos en cada bloque
+ISBNS_POR_BLOQUE = 10000
+#tamaño de los trozos al descargar el listado a disco
+TAMANO_TROZO = 1 << 16
+
+NS_LISTADO = '{http://www.dilve.es/dilve/api/xsd/getRecordListXResponse}'
+#valores de status de un record que indican que se ha dado de baja en DILVE
+ESTADOS_BAJA = ('D', 'DELETED')
+
+#función para conectar a la base de datos SQLite
+def abrir_bd():
+    conn = sqlite3.connect('book_all_fields.db')
+
+    #crear tabla si no existe y agregar índice
+    EsquemaSQLite.asegurar_isbns_libros(conn)
+    return conn
+
+#función para leer los records del XML en streaming; devuelve (isbn, eliminado).
+#un record está dado de baja si su status lo indica o si va dentro de un
+#bloque deleted... (listados de cambios con fromDate).
+#cada record se suelta de su padre en cuanto se ha leído, así que la memoria
+#no crece con el tamaño del listado
+def leer_registros(filename):
+    padres = []
+    for event, elem in ET.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            padres.append(elem)
+            continue
+        padres.pop()
+        if elem.tag == NS_LISTADO + 'record':
+            isbn = elem.findtext(NS_LISTADO + 'id')
+            if isbn:
+                estado = (elem.findtext(NS_LISTADO + 'status') or elem.get('status') or '').strip().upper()
+                eliminado = estado in ESTADOS_BAJA or any(padre.tag.startswith(NS_LISTADO + 'deleted') for padre in padres)
+                yield isbn.strip(), eliminado
+            elem.clear()
+            if padres:
+                padres[-1].remove(elem)
+
+#función para leer los ISBNs del XML en streaming
+def leer_isbns(filename):
+    for isbn, _ in leer_registros(filename):
+        yield isbn
+
+#función para leer los ISBNs en bloques de tamaño fijo
+def bloques_isbns(filename, tamano=ISBNS_POR_BLOQUE):
+    bloque = []
+    for isbn in leer_isbns(filename):
+        bloque.append(isbn)
+        if len(bloque) >= tamano:
+            yield bloque
+            bloque = []
+    if bloque:
+        yield bloque
+
+#función para importar los ISBNs de una sola vez, asegurando que no haya duplicados.
+#los bloques se cargan con executemany en una tabla temporal y se pasan a
+#isbns_libros con un único INSERT OR IGNORE ... SELECT (isbn es UNIQUE).
+#devuelve (leídos, insertados, omitidos por existir ya, repetidos en el listado)
+def importar_isbns(cursor, bloques, fecha_extraccion_dilve, es_editorial, fecha_importacion):
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS isbns_staging (isbn TEXT)')
+    cursor.execute('DELETE FROM isbns_staging')
+
+    leidos = 0
+    for bloque in bloques:
+        cursor.executemany('INSERT INTO isbns_staging (isbn) VALUES (?)', ((isbn,) for isbn in bloque))
+        leidos += len(bloque)
+    distintos = cursor.execute('SELECT COUNT(DISTINCT isbn) FROM isbns_staging').fetchone()[0]
+
+    #se respeta el orden del listado para los id de isbns_libros
+    cursor.execute('''
+        INSERT OR IGNORE INTO isbns_libros (isbn, fecha_extraccion_dilve, es_editorial, fecha_importacion)
+        SELECT isbn, ?, ?, ? FROM isbns_staging ORDER BY rowid
+    ''', (fecha_extraccion_dilve, es_editorial, fecha_importacion))
+    insertados = cursor.rowcount
+    cursor.execute('DELETE FROM isbns_staging')
+
+    return leidos, insertados, distintos - insertados, leidos - distintos
 
 #función para procesar el XML
-def procesar_xml(filename, program):
-    # Parsear el archivo XML
-    tree = ET.parse(filename)
-    root = tree.getroot()
-    namespace = {'ns': 'http://www.dilve.es/dilve/api/xsd/getRecordListXResponse'}
-
-    #extraer los ISBNS y asegurar que son únicos utilizando un conjunto
-    isbns = set(record.find('ns:id', namespace).text for record in root.findall('.//ns:record', namespace))
+def procesar_xml(conn, filename, program):
+    cursor = conn.cursor()
 
     #extraer la fecha de extracción y el tipo de archivo desde el nombre del programa
     match = re.match(r'getRecordListX_(\w+)_(\w+)_(E|AE)', program)
@@ -67,48 +105,63 @@ def procesar_xml(filename, program):
     es_editorial = program_suffix == 'E'
     fecha_importacion = datetime.now().strftime('%d%m%Y')
 
-    #insertar cada ISBN en la base de datos, asegurando que no haya duplicados
+    #insertar los ISBNs en la base de datos
     cursor.execute('BEGIN TRANSACTION')
-    for isbn in isbns:
-        cursor.execute('SELECT COUNT(*) FROM isbns_libros WHERE isbn = ?', (isbn,))
-        count = cursor.fetchone()[0]
-        if count == 0:
-            cursor.execute('''
-                INSERT INTO isbns_libros (isbn, fecha_extraccion_dilve, es_editorial, fecha_importacion)
-                VALUES (?, ?, ?, ?)
-            ''', (isbn, fecha_extraccion_dilve, es_editorial, fecha_importacion))
-            logging.info(f'ISBN {isbn} insertado.')
-        else:
-            logging.info(f'ISBN {isbn} omitido (ya existente).')
+    leidos, insertados, omitidos, repetidos = importar_isbns(
+        cursor, bloques_isbns(filename), fecha_extraccion_dilve, es_editorial, fecha_importacion)
     conn.commit()
 
-    logging.info(f'{len(isbns)} ISBNS procesados de {filename}.')
+    logging.info(f'{leidos} ISBNS procesados de {filename}: {insertados} insertados, '
+                 f'{omitidos} omitidos (ya existentes), {repetidos} repetidos en el listado.')
 
     #mover el archivo a la carpeta correspondiente
     output_dir = os.path.join('listado_isbns_procesados_sqlite', program)
     os.makedirs(output_dir, exist_ok=True)
     shutil.move(filename, os.path.join(output_dir, os.path.basename(filename)))
+    return leidos, insertados, omitidos, repetidos
 
 #funnción para obtener el XML desde la API
-def fetch_isbns(user, password, program):
-    url = f"https://www.dilve.es/dilve/dilve/getRecordListX.do?user={user}&password={password}&type=L&program={program}"
-    response = requests.get(url)
+def fetch_isbns(conn, user, password, program):
+    response = ClienteDILVE.get_record_list(user, password, program, stream=True)
 
     if response.status_code == 200:
+        #la respuesta va directamente a disco, sin cargarla entera en memoria
         filename = f"{program}.xml"
         with open(filename, 'wb') as file:
-            file.write(response.content)
-        procesar_xml(filename, program)
+            for trozo in response.iter_content(chunk_size=TAMANO_TROZO):
+                file.write(trozo)
+        response.close()
+        procesar_xml(conn, filename, program)
     else:
+        response.close()
         logging.error(f"Error al obtener el listado de ISBNs: {response.status_code}")
 
-#Obtener los ISBNs y procesar y guardar el XML
-fetch_isbns(user, password, program_name)
+if __name__ == '__main__':
+    #verificar de credenciales y parámetros
+    if len(sys.argv) != 4:
+        print("\nDebe proporcionar usuario, contraseña y nombre del programa como argumentos:")
+        print("python ListadoISBNsToSQLite.py <usuario> <contraseña> <nombre_programa>\n")
+        sys.exit(1)
+    user = sys.argv[1]
+    password = sys.argv[2]
+    program_name = sys.argv[3]
+
+    #crear la carpeta de logs si no existe
+    log_dir = 'E:\\dilve_rutas\\logs_isbns'
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+
+    #configurar el registro en el archivo log.txt
+    logging.basicConfig(filename='log.txt', level=logging.INFO,
+                        format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
 
+    conn = abrir_bd()
 
+    #Obtener los ISBNs y procesar y guardar el XML
+    fetch_isbns(conn, user, password, program_name)
 
-#cerrar la conexión
-conn.close()
+    #cerrar la conexión
+    conn.close()
 
-logging.info("Procesamiento completado.")
-print("Proceso completado.")
+    logging.info("Procesamiento completado.")
+    print("Proceso completado.")
@@ -0,0 +1,202 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Métricas de DAPI_SQLite_v8.py: contadores, histogramas de tiempos por etapa
+# (petición a DILVE, parseo, aplanado, escritura, commit) y medidores que se leen
+# al hacer la instantánea (colas, peticiones en vuelo). Se vuelcan como instantáneas
+# JSON periódicas, una por línea, y con un puerto también en el formato de texto
+# de Prometheus en http://127.0.0.1:PUERTO/metrics.
+# Cada proceso tiene las suyas: los procesos del aplanado devuelven sus tiempos
+# con el resultado (AplanadoONIX.aplanar_medido) y se anotan en el principal.
+
+# Límites superiores (en segundos) de los cubos de los histogramas
+CUBOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Prefijo de las métricas en Prometheus
+PREFIJO = 'dilve_'
+
+_bloqueo = threading.Lock()
+# (nombre, etiquetas) -> valor; etiquetas es una tupla ordenada de (clave, valor)
+contadores = {}
+# nombre -> Histograma
+histogramas = {}
+# nombre -> función sin argumentos que devuelve el valor actual
+medidores = {}
+inicio = time.time()
+
+# Histograma de cubos fijos (CUBOS) con la suma y el número de observaciones
+class Histograma:
+    def __init__(self):
+        self.cubos = [0] * (len(CUBOS) + 1)
+        self.suma = 0.0
+        self.cuenta = 0
+
+    def observar(self, valor):
+        self.cubos[bisect.bisect_left(CUBOS, valor)] += 1
+        self.suma += valor
+        self.cuenta += 1
+
+    # Función para el percentil p (0-100) aproximado por el límite superior de su cubo
+    def percentil(self, p):
+        if not self.cuenta:
+            return None
+        objetivo = self.cuenta * p / 100
+        acumulado = 0
+        for limite, n in zip(CUBOS + (float('inf'),), self.cubos):
+            acumulado += n
+            if acumulado >= objetivo:
+                return limite
+        return float('inf')
+
+# Función para sumar n a un contador
+def contar(nombre, n=1, **etiquetas):
+    clave = (nombre, tuple(sorted(etiquetas.items())))
+    with _bloqueo:
+        contadores[clave] = contadores.get(clave, 0) + n
+
+# Función para anotar una duración (en segundos) en un histograma
+def observar(nombre, segundos):
+    with _bloqueo:
+        histograma = histogramas.get(nombre)
+        if histograma is None:
+            histograma = histogramas[nombre] = Histograma()
+        histograma.observar(segundos)
+
+# Función para medir la duración de un bloque: with cronometro('escritura_segundos'): ...
+@contextmanager
+def cronometro(nombre):
+    comienzo = time.perf_counter()
+    try:
+        yield
+    finally:
+        observar(nombre, time.perf_counter() - comienzo)
+
+# Función para registrar un medidor (p. ej. el tamaño de una cola)
+def medidor(nombre, funcion):
+    medidores[nombre] = funcion
+
+# Función para volver a empezar (una ejecución nueva en el mismo proceso)
+def reiniciar():
+    global inicio
+    with _bloqueo:
+        contadores.clear()
+        histogramas.clear()
+    medidores.clear()
+    inicio = time.time()
+
+# Función para el nombre de un contador con sus etiquetas: nombre{clave="valor",...}
+def nombre_con_etiquetas(nombre, etiquetas):
+    if not etiquetas:
+        return nombre
+    return nombre + '{' + ','.join(f'{clave}="{valor}"' for clave, valor in etiquetas) + '}'
+
+# Función para leer los medidores; uno que falle no impide la instantánea
+def leer_medidores():
+    valores = {}
+    for nombre, funcion in list(medidores.items()):
+        try:
+            valores[nombre] = funcion()
+        except Exception:
+            valores[nombre] = None
+    return valores
+
+# Función para la instantánea de todas las métricas como diccionario (serializable a JSON)
+def instantanea():
+    with _bloqueo:
+        valores_contadores = {nombre_con_etiquetas(nombre, etiquetas): valor
+                              for (nombre, etiquetas), valor in sorted(contadores.items())}
+        valores_histogramas = {nombre: {'cuenta': h.cuenta, 'suma': round(h.suma, 6),
+                                        'p50': h.percentil(50), 'p99': h.percentil(99)}
+                               for nombre, h in sorted(histogramas.items())}
+    return {
+        'fecha': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'segundos': round(time.time() - inicio, 1),
+        'contadores': valores_contadores,
+        'histogramas': valores_histogramas,
+        'medidores': leer_medidores(),
+    }
+
+# Función para las métricas en el formato de texto de Prometheus
+def texto_prometheus():
+    lineas = []
+    with _bloqueo:
+        tipos = set()
+        for (nombre, etiquetas), valor in sorted(contadores.items()):
+            if nombre not in tipos:
+                lineas.append(f'# TYPE {PREFIJO}{nombre} counter')
+                tipos.add(nombre)
+            lineas.append(f'{PREFIJO}{nombre_con_etiquetas(nombre, etiquetas)} {valor}')
+        for nombre, h in sorted(histogramas.items()):
+            lineas.append(f'# TYPE {PREFIJO}{nombre} histogram')
+            acumulado = 0
+            for limite, n in zip(CUBOS, h.cubos):
+                acumulado += n
+                lineas.append(f'{PREFIJO}{nombre}_bucket{{le="{limite}"}} {acumulado}')
+            lineas.append(f'{PREFIJO}{nombre}_bucket{{le="+Inf"}} {h.cuenta}')
+            lineas.append(f'{PREFIJO}{nombre}_sum {h.suma}')
+            lineas.append(f'{PREFIJO}{nombre}_count {h.cuenta}')
+    for nombre, valor in leer_medidores().items():
+        if valor is not None:
+            lineas.append(f'# TYPE {PREFIJO}{nombre} gauge')
+            lineas.append(f'{PREFIJO}{nombre} {valor}')
+    return '\n'.join(lineas) + '\n'
+
+# Servidor de /metrics para Prometheus
+class ManejadorMetricas(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        cuerpo = texto_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    def log_message(self, format, *args):
+        pass
+
+# Volcado periódico de instantáneas (y servidor de Prometheus) de una ejecución
+class Volcado:
+    def __init__(self, ruta_json=None, cada=60, puerto=None):
+        self.ruta_json = ruta_json
+        self.cada = cada
+        self.servidor = None
+        self._parar = threading.Event()
+        if puerto:
+            self.servidor = ThreadingHTTPServer(('127.0.0.1', puerto), ManejadorMetricas)
+            self.servidor.daemon_threads = True
+            threading.Thread(target=self.servidor.serve_forever, daemon=True).start()
+            logging.info(f"Métricas para Prometheus en http://127.0.0.1:{puerto}/metrics")
+        self._hilo = threading.Thread(target=self._bucle, daemon=True)
+        self._hilo.start()
+
+    def _bucle(self):
+        while not self._parar.wait(self.cada):
+            self.volcar()
+
+    # Función para escribir una instantánea en el archivo JSON y un resumen en el log
+    def volcar(self):
+        datos = instantanea()
+        if self.ruta_json:
+            os.makedirs(os.path.dirname(self.ruta_json) or '.', exist_ok=True)
+            with open(self.ruta_json, 'a', encoding='utf-8') as archivo:
+                archivo.write(json.dumps(datos, ensure_ascii=False) + '\n')
+        # En el log solo una línea por instantánea en lugar de una por ISBN
+        logging.info(f"Métricas: {json.dumps(datos['contadores'], ensure_ascii=False)} {json.dumps(datos['medidores'])}")
+
+    # Función para parar el volcado con una última instantánea
+    def detener(self):
+        self._parar.set()
+        self._hilo.join()
+        self.volcar()
+        if self.servidor is not None:
+            self.servidor.shutdown()
+            self.servidor.server_close()
@@ -0,0 +1,235 @@
+import argparse
+import os
+import random
+import threading
+import time
+import zlib
+import xml.etree.ElementTree as ET
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# Servidor local que imita getRecordsX y getRecordListX de DILVE para pruebas y
+# benchmarks, sin credenciales ni llamadas a la API real. Devuelve fichas ONIX
+# 3.0 sintéticas (deterministas para cada ISBN) o sacadas de un corpus de fichas
+# reales, con la latencia y los errores que se le indiquen.
+
+NS_RECORDS = 'http://www.dilve.es/dilve/api/xsd/getRecordsXResponse'
+NS_LISTADO = 'http://www.dilve.es/dilve/api/xsd/getRecordListXResponse'
+NS_ONIX = 'http://ns.editeur.org/onix/3.0/reference'
+
+# Primer ISBN de los listados de getRecordListX
+ISBN_BASE = 9788400000000
+# Records que se escriben en cada trozo de la respuesta de getRecordListX
+RECORDS_POR_TROZO = 10000
+
+# Función para generar la ficha ONIX de un ISBN. relleno_texto multiplica la
+# longitud de la descripción (más XML que parsear) y filas_extra añade
+# Contributor y Subject (más filas que escribir)
+def producto_sintetico(isbn, relleno_texto=1, filas_extra=0):
+    azar = random.Random(isbn)
+    contributors = ''.join(
+        f'<Contributor><SequenceNumber>{i}</SequenceNumber><ContributorRole>A01</ContributorRole>'
+        f'<PersonName>Autor {azar.randint(1, 100000)}</PersonName>'
+        f'<PersonNameInverted>Apellido {azar.randint(1, 100000)}, Nombre</PersonNameInverted></Contributor>'
+        for i in range(1, azar.randint(1, 4) + filas_extra + 1))
+    subjects = ''.join(
+        f'<Subject><SubjectSchemeIdentifier>{esquema}</SubjectSchemeIdentifier><SubjectCode>{azar.choice("FABCDY")}{azar.randint(1, 9)}</SubjectCode>'
+        f'<SubjectHeadingText>Materia {azar.randint(1, 500)}</SubjectHeadingText></Subject>'
+        for esquema in (('12', '93', '20')[:azar.randint(1, 3)] + ('93',) * filas_extra))
+    prices = ''.join(
+        f'<Price><PriceType>{tipo}</PriceType><PriceAmount>{azar.randint(500, 5000) / 100:.2f}</PriceAmount>'
+        f'<Tax><TaxType>01</TaxType><TaxRatePercent>4</TaxRatePercent></Tax><CurrencyCode>EUR</CurrencyCode></Price>'
+        for tipo in ('01', '04'))
+    descripcion = ' '.join(f'palabra{azar.randint(1, 5000)}' for _ in range(azar.randint(20, 120) * relleno_texto))
+    return (
+        f'<Product><RecordReference>{isbn}</RecordReference><NotificationType>03</NotificationType>'
+        f'<ProductIdentifier><ProductIDType>03</ProductIDType><IDValue>{isbn}</IDValue></ProductIdentifier>'
+        f'<ProductIdentifier><ProductIDType>15</ProductIDType><IDValue>{isbn}</IDValue></ProductIdentifier>'
+        f'<DescriptiveDetail><ProductComposition>00</ProductComposition><ProductForm>BC</ProductForm>'
+        f'<ProductFormDetail>B105</ProductFormDetail>'
+        f'<Measure><MeasureType>01</MeasureType><Measurement>{azar.randint(150, 300)}</Measurement><MeasureUnitCode>mm</MeasureUnitCode></Measure>'
+        f'<Measure><MeasureType>02</MeasureType><Measurement>{azar.randint(100, 200)}</Measurement><MeasureUnitCode>mm</MeasureUnitCode></Measure>'
+        f'<TitleDetail><TitleType>01</TitleType><TitleElement><TitleElementLevel>01</TitleElementLevel>'
+        f'<TitleText>Libro {isbn}</TitleText><Subtitle>Subtítulo {azar.randint(1, 1000)}</Subtitle></TitleElement></TitleDetail>'
+        f'{contributors}'
+        f'<Language><LanguageRole>01</LanguageRole><LanguageCode>spa</LanguageCode></Language>'
+        f'<Extent><ExtentType>00</ExtentType><ExtentValue>{azar.randint(50, 900)}</ExtentValue><ExtentUnit>03</ExtentUnit></Extent>'
+        f'{subjects}'
+        f'<Audience><AudienceCodeType>01</AudienceCodeType><AudienceCodeValue>01</AudienceCodeValue></Audience>'
+        f'</DescriptiveDetail>'
+        f'<CollateralDetail><TextContent><TextType>03</TextType><ContentAudience>00</ContentAudience>'
+        f'<Text>{descripcion}</Text></TextContent></CollateralDetail>'
+        f'<PublishingDetail><Publisher><PublishingRole>01</PublishingRole><PublisherName>Editorial {azar.randint(1, 300)}</PublisherName></Publisher>'
+        f'<CityOfPublication>Madrid</CityOfPublication><PublishingStatus>04</PublishingStatus>'
+        f'<PublishingDate><PublishingDateRole>01</PublishingDateRole><Date>20{azar.randint(10, 24)}0{azar.randint(1, 9)}15</Date></PublishingDate>'
+        f'</PublishingDetail>'
+        f'<ProductSupply><SupplyDetail><Supplier><SupplierRole>01</SupplierRole><SupplierName>Distribuidora</SupplierName></Supplier>'
+        f'<ProductAvailability>20</ProductAvailability>{prices}</SupplyDetail></ProductSupply>'
+        f'</Product>'
+    )
+
+# Función para cargar un corpus de fichas ONIX 3.0 (archivos .xml de una carpeta,
+# con un Product o un ONIXMessage/getRecordsXResponse completo cada uno).
+# Devuelve una lista de (isbn, xml del Product)
+def cargar_corpus(carpeta):
+    corpus = []
+    for nombre in sorted(os.listdir(carpeta)):
+        if not nombre.lower().endswith('.xml'):
+            continue
+        root = ET.parse(os.path.join(carpeta, nombre)).getroot()
+        productos = [root] if root.tag == f'{{{NS_ONIX}}}Product' else root.iter(f'{{{NS_ONIX}}}Product')
+        for product_info in productos:
+            isbn = None
+            for identifier in product_info.iter(f'{{{NS_ONIX}}}ProductIdentifier'):
+                if identifier.findtext(f'{{{NS_ONIX}}}ProductIDType') in ('15', '03'):
+                    isbn = (identifier.findtext(f'{{{NS_ONIX}}}IDValue') or '').strip()
+                    break
+            if isbn:
+                corpus.append((isbn, ET.tostring(product_info, encoding='unicode')))
+    if not corpus:
+        raise ValueError(f"No hay fichas ONIX 3.0 con ISBN en {carpeta}")
+    return corpus
+
+# Función para la respuesta de getRecordsX con varios Product
+def respuesta_records(productos):
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<getRecordsXResponse xmlns="{NS_RECORDS}"><ONIXMessage xmlns="{NS_ONIX}" release="3.0">'
+        f'<Header><Sender><SenderName>DILVE</SenderName></Sender></Header>'
+        f'{"".join(productos)}</ONIXMessage></getRecordsXResponse>'
+    ).encode('utf-8')
+
+# Función para la respuesta de error de DILVE
+def respuesta_error(codigo, texto):
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<getRecordsXResponse xmlns="{NS_RECORDS}"><error><code>{codigo}</code><text>{texto}</text></error></getRecordsXResponse>'
+    ).encode('utf-8')
+
+# Función para generar por trozos la respuesta de getRecordListX con n ISBNs.
+# Con bajas > 0 (listados con fromDate) uno de cada `bajas` records va con status D
+def trozos_listado(n, bajas=0):
+    yield (f'<?xml version="1.0" encoding="UTF-8"?><getRecordListXResponse xmlns="{NS_LISTADO}">'
+           f'<totalRecords>{n}</totalRecords><records>').encode('utf-8')
+    for inicio in range(0, n, RECORDS_POR_TROZO):
+        yield ''.join(
+            f'<record><id>{ISBN_BASE + i}</id>'
+            f'{"<status>D</status>" if bajas and i % bajas == bajas - 1 else ""}'
+            f'<dateLastUpdated>2024-01-01</dateLastUpdated></record>'
+            for i in range(inicio, min(n, inicio + RECORDS_POR_TROZO))).encode('utf-8')
+    yield b'</records></getRecordListXResponse>'
+
+class ManejadorDILVE(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        servidor = self.server
+
+        if url.path.endswith('/getRecordsX.do'):
+            identifiers = [i for i in params.get('identifier', [''])[0].split(',') if i]
+            azar = random.random()
+            if servidor.latencia:
+                # Una de cada tantas respuestas tarda 10 veces más (cola de latencia)
+                time.sleep(servidor.latencia * (10 if azar < servidor.lentas else 1))
+            if random.random() < servidor.errores_http:
+                self.responder(503, b'Service Unavailable')
+            else:
+                productos = [servidor.producto(isbn) for isbn in identifiers if not servidor.falta(isbn)]
+                if productos:
+                    self.responder(200, respuesta_records(productos))
+                else:
+                    self.responder(200, respuesta_error('2', 'Registro no encontrado'))
+        elif url.path.endswith('/getRecordListX.do'):
+            bajas = servidor.bajas if 'fromDate' in params else 0
+            self.responder_trozos(200, trozos_listado(servidor.listado, bajas))
+        else:
+            self.responder(404, b'')
+
+        with servidor.bloqueo:
+            servidor.peticiones += 1
+
+    def responder(self, estado, cuerpo):
+        self.send_response(estado)
+        self.send_header('Content-Type', 'text/xml; charset=UTF-8')
+        self.send_header('Content-Length', str(len(cuerpo)))
+        self.end_headers()
+        self.wfile.write(cuerpo)
+
+    # Respuesta con Transfer-Encoding: chunked, para listados grandes sin tenerlos enteros en memoria
+    def responder_trozos(self, estado, trozos):
+        self.send_response(estado)
+        self.send_header('Content-Type', 'text/xml; charset=UTF-8')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for trozo in trozos:
+            self.wfile.write(f'{len(trozo):X}\r\n'.encode('ascii') + trozo + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+class ServidorDILVE(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    # Función para la ficha de un ISBN: la del corpus si está, si no una del corpus
+    # (siempre la misma para cada ISBN) con sus identificadores cambiados, o una sintética
+    def producto(self, isbn):
+        if self.corpus is None:
+            return producto_sintetico(isbn, self.relleno_texto, self.filas_extra)
+        xml = self.corpus_por_isbn.get(isbn)
+        if xml is None:
+            original, plantilla = self.corpus[zlib.crc32(isbn.encode()) % len(self.corpus)]
+            xml = plantilla.replace(original, isbn)
+        return xml
+
+    # Función para saber si un ISBN no está en DILVE (fijo para cada ISBN)
+    def falta(self, isbn):
+        return self.faltan and random.Random(f'falta{isbn}').random() < self.faltan
+
+# Función para arrancar el servidor en segundo plano; devuelve el servidor (server_port indica el puerto).
+# errores_http: probabilidad de responder 503 a una petición de getRecordsX
+# lentas: probabilidad de que una respuesta tarde 10 veces la latencia
+# faltan: proporción de ISBNs que no existen en DILVE
+# listado: ISBNs del listado de getRecordListX (con fromDate, uno de cada `bajas` va de baja)
+def iniciar(puerto=0, latencia_ms=0, corpus=None, relleno_texto=1, filas_extra=0,
+            errores_http=0, lentas=0, faltan=0, listado=1000, bajas=20):
+    servidor = ServidorDILVE(('127.0.0.1', puerto), ManejadorDILVE)
+    servidor.latencia = latencia_ms / 1000
+    servidor.corpus = cargar_corpus(corpus) if corpus else None
+    servidor.corpus_por_isbn = dict(servidor.corpus) if servidor.corpus else {}
+    servidor.relleno_texto = relleno_texto
+    servidor.filas_extra = filas_extra
+    servidor.errores_http = errores_http
+    servidor.lentas = lentas
+    servidor.faltan = faltan
+    servidor.listado = listado
+    servidor.bajas = bajas
+    servidor.peticiones = 0
+    servidor.bloqueo = threading.Lock()
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+    return servidor
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Servidor local que imita la API de DILVE.')
+    parser.add_argument('--puerto', type=int, default=8765)
+    parser.add_argument('--latencia-ms', type=float, default=0, help='latencia añadida a cada respuesta')
+    parser.add_argument('--corpus', help='carpeta con fichas ONIX 3.0 (.xml) que servir en lugar de las sintéticas')
+    parser.add_argument('--relleno-texto', type=int, default=1, help='multiplica la longitud de las descripciones sintéticas')
+    parser.add_argument('--filas-extra', type=int, default=0, help='Contributor y Subject adicionales en cada ficha sintética')
+    parser.add_argument('--errores-http', type=float, default=0, help='proporción de respuestas 503')
+    parser.add_argument('--lentas', type=float, default=0, help='proporción de respuestas 10 veces más lentas')
+    parser.add_argument('--faltan', type=float, default=0, help='proporción de ISBNs que no están en DILVE')
+    parser.add_argument('--listado', type=int, default=1000, help='ISBNs del listado de getRecordListX')
+    args = parser.parse_args()
+
+    servidor = iniciar(args.puerto, args.latencia_ms, args.corpus, args.relleno_texto, args.filas_extra,
+                       args.errores_http, args.lentas, args.faltan, args.listado)
+    print(f"MockDILVE escuchando en http://127.0.0.1:{servidor.server_port}/dilve/dilve (Ctrl+C para salir)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        servidor.shutdown()
@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+import xml.etree.ElementTree as ET
+from queue import Full
+import aiohttp
+import ClienteDILVE
+import MetricasDILVE
+import AplanadoONIX
+
+# Motor de descarga con asyncio: mantiene cientos de peticiones en vuelo con
+# un solo hilo y entrega los resultados en la misma cola que el motor de hilos,
+# así que el escritor (db_updater) es el mismo. Necesita aiohttp.
+
+# Máximo de peticiones en vuelo por defecto
+CONCURRENCIA = 200
+
+# Cubo de tokens global: como mucho `tasa` peticiones por segundo, con ráfagas de `capacidad`
+class CuboTokens:
+    def __init__(self, tasa, capacidad=None):
+        self.tasa = tasa
+        self.capacidad = capacidad or max(1.0, tasa)
+        self.tokens = self.capacidad
+        self.ultimo = time.monotonic()
+        self._bloqueo = asyncio.Lock()
+
+    async def adquirir(self):
+        async with self._bloqueo:
+            while True:
+                ahora = time.monotonic()
+                self.tokens = min(self.capacidad, self.tokens + (ahora - self.ultimo) * self.tasa)
+                self.ultimo = ahora
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.tasa)
+
+# Función para dejar un resultado en la cola acotada del escritor sin bloquear el bucle
+async def poner(queue, item):
+    while True:
+        try:
+            queue.put_nowait(item)
+            return
+        except Full:
+            await asyncio.sleep(0.01)
+
+# Función para descargar una respuesta de getRecordsX respetando el límite de peticiones
+# y el control de concurrencia, con los mismos reintentos que ClienteDILVE.pedir_records
+async def pedir(sesion, cubo, control, user, password, identifiers):
+    params = ClienteDILVE.params_records(user, password, identifiers)
+    clase = 'lote' if ClienteDILVE.SEPARADOR_IDENTIFICADORES in identifiers else 'isbn'
+    for intento in range(ClienteDILVE.INTENTOS):
+        if intento:
+            await asyncio.sleep(ClienteDILVE.espera_reintento(intento - 1))
+        while not control.intentar_entrar():
+            await asyncio.sleep(0.01)
+        if cubo is not None:
+            await cubo.adquirir()
+        inicio = time.monotonic()
+        fallo = True
+        causa = None
+        try:
+            async with sesion.get(ClienteDILVE.url('getRecordsX'), params=params) as response:
+                if ClienteDILVE.es_transitorio(response.status):
+                    error = ClienteDILVE.ErrorDILVE(f"Error HTTP {response.status} de DILVE")
+                    causa = f'http_{response.status}'
+                elif response.status >= 400:
+                    fallo = False
+                    raise ClienteDILVE.ErrorDILVE(f"Petición rechazada por DILVE (HTTP {response.status})", permanente=True)
+                else:
+                    content = await response.read()
+                    fallo = False
+                    return content
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = ClienteDILVE.ErrorDILVE(f"Error en la llamada a DILVE: {e!r}")
+            causa = 'timeout' if isinstance(e, asyncio.TimeoutError) else 'conexion'
+        finally:
+            latencia = time.monotonic() - inicio
+            control.salir(latencia, fallo, clase)
+            ClienteDILVE.anotar_peticion(latencia, fallo, causa)
+        logging.warning(f"{error}. Intento {intento + 1} de {ClienteDILVE.INTENTOS}.")
+    raise error
+
+# Función para aplanar una respuesta fuera del bucle: en el pool de procesos
+# de DAPI_SQLite_v8 si lo hay o, si no, en un hilo auxiliar
+async def aplanar(aplanador, aplanado, content, isbns):
+    return AplanadoONIX.resultado_medido(
+        await asyncio.get_running_loop().run_in_executor(aplanador, aplanado, content, isbns))
+
+# Función para procesar un ISBN (equivalente asíncrono de process_isbn)
+async def procesar_isbn(sesion, cubo, control, aplanador, aplanado, isbn, queue, user, password):
+    try:
+        content = await pedir(sesion, cubo, control, user, password, isbn)
+        try:
+            result = await aplanar(aplanador, aplanado, content, isbn)
+            if result is None:
+                error = ClienteDILVE.ErrorDILVE(f"Error en el contenido XML para ISBN {isbn}", permanente=True)
+            else:
+                await poner(queue, (isbn, result.get(isbn, ([], None)), None))
+                return
+        except ET.ParseError as e:
+            error = ClienteDILVE.ErrorDILVE(f"Error parseando el XML para ISBN {isbn}: {e}", permanente=True)
+    except ClienteDILVE.ErrorDILVE as e:
+        error = e
+
+    await poner(queue, (isbn, None, error))
+
+# Función para procesar un lote de ISBNs con una llamada (equivalente asíncrono de process_isbns)
+async def procesar_lote(sesion, cubo, control, aplanador, aplanado, isbns, queue, user, password):
+    if len(isbns) == 1:
+        return await procesar_isbn(sesion, cubo, control, aplanador, aplanado, isbns[0], queue, user, password)
+
+    result = None
+    try:
+        content = await pedir(sesion, cubo, control, user, password, ClienteDILVE.identificadores(isbns))
+        result = await aplanar(aplanador, aplanado, content, isbns)
+    except ET.ParseError as e:
+        logging.warning(f"Error parseando el XML del lote de {len(isbns)} ISBNS: {e}")
+    except ClienteDILVE.ErrorDILVE as e:
+        if not e.permanente:
+            logging.warning(f"Lote de {len(isbns)} ISBNS sin respuesta: {e}")
+            for isbn in isbns:
+                await poner(queue, (isbn, None, e))
+            return
+        logging.warning(f"Error en la llamada a DILVE para el lote de {len(isbns)} ISBNS: {e}")
+
+    encontrados, pendientes = ClienteDILVE.repartir_productos(isbns, result)
+    for isbn, isbn_result in encontrados.items():
+        await poner(queue, (isbn, isbn_result, None))
+    for isbn in pendientes:
+        await procesar_isbn(sesion, cubo, control, aplanador, aplanado, isbn, queue, user, password)
+
+# Función principal del motor: toma lotes de cola_isbns (la que llena productor_isbns)
+# hasta recibir la señal de fin y deja los resultados en queue
+# `aplanado` es la función de aplanado con sus opciones (por defecto AplanadoONIX.aplanar_medido)
+async def procesar(cola_isbns, queue, user, password, por_llamada, concurrencia=CONCURRENCIA, rps=None, aplanador=None,
+                   aplanado=AplanadoONIX.aplanar_medido):
+    cubo = CuboTokens(rps) if rps else None
+    # Concurrencia adaptativa (AIMD) entre 1 y `concurrencia`, empezando por la mitad
+    control = ClienteDILVE.ControlConcurrencia(max(1, concurrencia // 2), concurrencia)
+    MetricasDILVE.medidor('peticiones_en_vuelo', lambda: control.en_vuelo)
+    MetricasDILVE.medidor('concurrencia_limite', lambda: int(control.limite))
+    lotes = asyncio.Queue(maxsize=concurrencia)
+
+    # La cola de ISBNs es de hilos: se lee desde un hilo auxiliar para no bloquear el bucle
+    def siguiente_lote():
+        lote = []
+        while len(lote) < por_llamada:
+            isbn = cola_isbns.get()
+            if isbn is None:
+                return lote, True
+            lote.append(isbn)
+        return lote, False
+
+    async def repartidor():
+        terminado = False
+        while not terminado:
+            lote, terminado = await asyncio.to_thread(siguiente_lote)
+            if lote:
+                await lotes.put(lote)
+        for _ in range(concurrencia):
+            await lotes.put(None)
+
+    async def trabajador(sesion):
+        while True:
+            lote = await lotes.get()
+            if lote is None:
+                return
+            try:
+                await procesar_lote(sesion, cubo, control, aplanador, aplanado, lote, queue, user, password)
+            except Exception as e:
+                # Como en DAPI_SQLite_v8.trabajador_dilve: el lote queda pendiente
+                logging.error(f"Error procesando un lote de {len(lote)} ISBNS: {e!r}")
+                error = ClienteDILVE.ErrorDILVE(f"Error procesando el lote: {e!r}", permanente=False)
+                for isbn in lote:
+                    await poner(queue, (isbn, None, error))
+
+    timeout = aiohttp.ClientTimeout(sock_connect=ClienteDILVE.TIMEOUT_CONEXION, sock_read=ClienteDILVE.TIMEOUT_LECTURA)
+    conector = aiohttp.TCPConnector(limit=concurrencia, limit_per_host=concurrencia)
+    async with aiohttp.ClientSession(connector=conector, timeout=timeout, auto_decompress=True) as sesion:
+        await asyncio.gather(repartidor(), *(trabajador(sesion) for _ in range(concurrencia)))
+
+# Función para lanzar el motor desde un hilo normal
+def ejecutar(cola_isbns, queue, user, password, por_llamada, concurrencia=CONCURRENCIA, rps=None, aplanador=None,
+             aplanado=AplanadoONIX.aplanar_medido):
+    asyncio.run(procesar(cola_isbns, queue, user, password, por_llamada, concurrencia, rps, aplanador, aplanado))
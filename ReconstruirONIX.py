@@ -0,0 +1,114 @@
+import argparse
+import logging
+import sqlite3
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import xml.etree.ElementTree as ET
+import AplanadoONIX
+import EsquemaSQLite
+import BusquedaDILVE
+import DAPI_SQLite_v8
+
+# Reconstruye las tablas de datos de book_all_fields.db a partir de las fichas
+# ONIX archivadas en onix_crudo, sin llamar a DILVE (por ejemplo tras corregir
+# el aplanado o cambiar el esquema). Solo se tocan los ISBNs que tienen ficha
+# archivada y no se cambia su estado en isbns_libros. Si se interrumpe se puede
+# volver a lanzar: cada ejecución empieza borrando las filas de esos ISBNs.
+
+# Fichas que se envían juntas a cada proceso
+FICHAS_POR_TAREA = 200
+
+# Función para aplanar un grupo de fichas archivadas (se ejecuta en el pool)
+def aplanar_fichas(fichas, normalizar=False):
+    resultados = []
+    for isbn, compresion, blob in fichas:
+        try:
+            resultados.append((isbn, AplanadoONIX.aplanar_archivo(isbn, compresion, blob, normalizar), None))
+        except (ET.ParseError, RuntimeError) as e:
+            resultados.append((isbn, None, str(e)))
+    return resultados
+
+# Función para leer onix_crudo en grupos de FICHAS_POR_TAREA
+def leer_fichas(ruta):
+    conn = sqlite3.connect(ruta)
+    cursor = conn.execute('SELECT isbn, compresion, xml FROM onix_crudo ORDER BY rowid')
+    while True:
+        fichas = cursor.fetchmany(FICHAS_POR_TAREA)
+        if not fichas:
+            break
+        yield fichas
+    conn.close()
+
+# Función para reconstruir las tablas; devuelve (reconstruidos, errores)
+def reconstruir(ruta='book_all_fields.db', procesos=DAPI_SQLite_v8.PROCESOS, normalizado=False):
+    conn = DAPI_SQLite_v8.abrir_bd(ruta)
+    EsquemaSQLite.asegurar_onix_crudo(conn)
+    cursor = conn.cursor()
+    esquema = EsquemaSQLite.RegistroEsquema(conn)
+    esquema.migrar_indices(conn)
+
+    sin_archivo = cursor.execute('''
+        SELECT COUNT(*) FROM isbns_libros
+        WHERE procesado = 1 AND isbn NOT IN (SELECT isbn FROM onix_crudo)
+    ''').fetchone()[0]
+    if sin_archivo:
+        logging.warning(f"{sin_archivo} ISBNs procesados no tienen ficha archivada y se dejan como están.")
+
+    # Las *_normalizado solo se vuelven a llenar con normalizado; sin él se dejan como están
+    cursor.execute('BEGIN')
+    for table_name in esquema.tablas_de_datos():
+        if not normalizado and table_name.lower().endswith('_normalizado'):
+            continue
+        cursor.execute(f'DELETE FROM {table_name} WHERE isbn IN (SELECT isbn FROM onix_crudo)')
+    cursor.execute('COMMIT')
+
+    reconstruidos = 0
+    errores = 0
+
+    def guardar(resultados):
+        nonlocal reconstruidos, errores
+        cursor.execute('BEGIN')
+        for isbn, filas, error in resultados:
+            if error is not None:
+                logging.error(f"Error aplanando la ficha archivada del ISBN {isbn}: {error}")
+                errores += 1
+                continue
+            for table_name, columns, values in filas:
+                esquema.insertar(cursor, table_name, isbn, columns, values)
+            reconstruidos += 1
+        cursor.execute('COMMIT')
+
+    if procesos:
+        # Como mucho 2 grupos por proceso en vuelo, para no cargar todo el archivo en memoria
+        with ProcessPoolExecutor(max_workers=procesos) as pool:
+            en_vuelo = deque()
+            for fichas in leer_fichas(ruta):
+                en_vuelo.append(pool.submit(aplanar_fichas, fichas, normalizado))
+                if len(en_vuelo) >= procesos * 2:
+                    guardar(en_vuelo.popleft().result())
+            while en_vuelo:
+                guardar(en_vuelo.popleft().result())
+    else:
+        for fichas in leer_fichas(ruta):
+            guardar(aplanar_fichas(fichas, normalizado))
+
+    # El índice de búsqueda se vuelve a llenar de una vez desde las tablas reconstruidas
+    indexados = BusquedaDILVE.reconstruir(conn)
+    logging.info(f"Índice de búsqueda reconstruido con {indexados} ISBNs.")
+    conn.close()
+    return reconstruidos, errores
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Reconstruye las tablas de book_all_fields.db desde las fichas ONIX archivadas en onix_crudo.')
+    parser.add_argument('--db', default='book_all_fields.db', help='base de datos (por defecto book_all_fields.db)')
+    parser.add_argument('--procesos', type=int, default=DAPI_SQLite_v8.PROCESOS,
+                        help=f'procesos que aplanan las fichas; 0 para hacerlo en este proceso (por defecto {DAPI_SQLite_v8.PROCESOS})')
+    parser.add_argument('--normalizado', action='store_true', help='llenar también las tablas *_normalizado')
+    args = parser.parse_args()
+
+    DAPI_SQLite_v8.iniciar_logs()
+    inicio = time.perf_counter()
+    reconstruidos, errores = reconstruir(args.db, args.procesos, args.normalizado)
+    logging.info(f"Reconstrucción completada: {reconstruidos} ISBNs, {errores} errores.")
+    print(f"Reconstrucción completada: {reconstruidos} ISBNs, {errores} errores en {time.perf_counter() - inicio:.1f} s.")
@@ -0,0 +1,151 @@
+import argparse
+import logging
+import os
+import shutil
+import sqlite3
+from datetime import datetime, timezone
+import ClienteDILVE
+import EsquemaSQLite
+import DAPI_SQLite_v8
+import ListadoISBNsToSQLite
+
+# Sincronización incremental de book_all_fields.db con DILVE.
+# 1. Pide a getRecordListX los registros dados de alta, modificados o de baja
+#    desde la última sincronización (fromDate.txt).
+# 2. Da de alta los ISBNs nuevos, marca los existentes con modificado = 1 y
+#    procesado = NULL (db_updater los reescribe) y borra los dados de baja.
+# 3. Guarda la nueva marca de fecha y descarga solo los ISBNs pendientes.
+
+ARCHIVO_FROM_DATE = 'fromDate.txt'
+FORMATO_FECHA = '%Y-%m-%dT%H:%M:%SZ'
+CARPETA_LISTADOS = os.path.join('listado_isbns_procesados_sqlite', 'sincronizacion')
+
+# Función para leer la marca de la última sincronización
+def leer_marca():
+    if not os.path.exists(ARCHIVO_FROM_DATE):
+        return None
+    with open(ARCHIVO_FROM_DATE, encoding='utf-8') as archivo:
+        return archivo.read().strip() or None
+
+# Función para guardar la marca de forma atómica (archivo temporal + os.replace)
+def guardar_marca(marca):
+    temporal = ARCHIVO_FROM_DATE + '.tmp'
+    with open(temporal, 'w', encoding='utf-8') as archivo:
+        archivo.write(marca)
+        archivo.flush()
+        os.fsync(archivo.fileno())
+    os.replace(temporal, ARCHIVO_FROM_DATE)
+
+# Función para descargar a disco el listado de cambios
+def descargar_cambios(user, password, desde, hasta, filename):
+    response = ClienteDILVE.get_record_list_desde(user, password, desde, hasta, stream=True)
+    try:
+        if response.status_code != 200:
+            raise ClienteDILVE.ErrorDILVE(f"Error al obtener el listado de cambios: {response.status_code}")
+        with open(filename, 'wb') as archivo:
+            for trozo in response.iter_content(chunk_size=ListadoISBNsToSQLite.TAMANO_TROZO):
+                archivo.write(trozo)
+    finally:
+        response.close()
+
+# Función para aplicar el listado de cambios a isbns_libros.
+# Devuelve (nuevos, modificados, eliminados)
+def marcar_cambios(conn, filename):
+    cursor = conn.cursor()
+    fecha = datetime.now()
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS cambios_staging (isbn TEXT, eliminado INTEGER)')
+    cursor.execute('DELETE FROM cambios_staging')
+    registros = ListadoISBNsToSQLite.leer_registros(filename)
+    cursor.executemany('INSERT INTO cambios_staging (isbn, eliminado) VALUES (?, ?)',
+                       ((isbn, int(eliminado)) for isbn, eliminado in registros))
+
+    # Si un ISBN aparece dado de baja y de alta en el mismo listado manda la baja
+    cursor.execute('''
+        DELETE FROM cambios_staging
+        WHERE eliminado = 0 AND isbn IN (SELECT isbn FROM cambios_staging WHERE eliminado = 1)
+    ''')
+
+    # Modificados: ya estaban en isbns_libros y se vuelven a descargar
+    cursor.execute('''
+        UPDATE isbns_libros
+        SET modificado = 1, procesado = NULL, intentos = 0, reintentar_desde = NULL
+        WHERE procesado IS NOT NULL
+          AND isbn IN (SELECT isbn FROM cambios_staging WHERE eliminado = 0)
+    ''')
+    modificados = cursor.rowcount
+
+    # Nuevos
+    cursor.execute('''
+        INSERT OR IGNORE INTO isbns_libros (isbn, fecha_extraccion_dilve, es_editorial, fecha_importacion)
+        SELECT isbn, ?, NULL, ? FROM cambios_staging WHERE eliminado = 0 ORDER BY rowid
+    ''', (fecha.strftime('%Y%m%d'), fecha.strftime('%d%m%Y')))
+    nuevos = cursor.rowcount
+
+    # Bajas: se borran sus datos y se anotan en isbns_eliminados para poder propagarlas a FileMaker
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS isbns_eliminados (
+            isbn TEXT PRIMARY KEY,
+            fecha_eliminacion TEXT
+        )
+    ''')
+    esquema = EsquemaSQLite.RegistroEsquema(conn)
+    for table_name in esquema.tablas_de_datos() + (['onix_crudo'] if esquema.existe('onix_crudo') else []):
+        cursor.execute(f'''
+            DELETE FROM {table_name}
+            WHERE isbn IN (SELECT isbn FROM cambios_staging WHERE eliminado = 1)
+        ''')
+    if esquema.existe('busqueda'):
+        cursor.execute('''
+            DELETE FROM busqueda
+            WHERE rowid IN (SELECT id FROM isbns_libros WHERE isbn IN (SELECT isbn FROM cambios_staging WHERE eliminado = 1))
+        ''')
+    cursor.execute('''
+        INSERT OR REPLACE INTO isbns_eliminados (isbn, fecha_eliminacion)
+        SELECT DISTINCT isbn, ? FROM cambios_staging WHERE eliminado = 1
+    ''', (fecha.strftime('%Y-%m-%d %H:%M:%S'),))
+    cursor.execute('''
+        DELETE FROM isbns_libros
+        WHERE isbn IN (SELECT isbn FROM cambios_staging WHERE eliminado = 1)
+    ''')
+    eliminados = cursor.rowcount
+
+    cursor.execute('DELETE FROM cambios_staging')
+    conn.commit()
+    return nuevos, modificados, eliminados
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sincroniza book_all_fields.db con los cambios de DILVE desde la última ejecución.')
+    parser.add_argument('usuario', help='usuario de DILVE')
+    parser.add_argument('password', metavar='contraseña', help='contraseña de DILVE')
+    parser.add_argument('--desde', help=f'fecha inicial ({FORMATO_FECHA}); por defecto la guardada en {ARCHIVO_FROM_DATE}')
+    parser.add_argument('--hilos', type=int, default=DAPI_SQLite_v8.HILOS, help='máximo de hilos de descarga')
+    args = parser.parse_args()
+
+    desde = args.desde or leer_marca()
+    if not desde:
+        parser.error(f"No hay fecha de la última sincronización en {ARCHIVO_FROM_DATE}; indíquela con --desde.")
+
+    DAPI_SQLite_v8.iniciar_logs()
+    # La marca nueva se toma antes de pedir el listado para no perder cambios hechos mientras tanto
+    hasta = datetime.now(timezone.utc).strftime(FORMATO_FECHA)
+    logging.info(f"Sincronizando cambios de DILVE desde {desde} hasta {hasta}.")
+
+    os.makedirs(CARPETA_LISTADOS, exist_ok=True)
+    filename = f"cambios_{hasta.replace(':', '')}.xml"
+    descargar_cambios(args.usuario, args.password, desde, hasta, filename)
+
+    conn = sqlite3.connect('book_all_fields.db')
+    EsquemaSQLite.asegurar_isbns_libros(conn)
+    nuevos, modificados, eliminados = marcar_cambios(conn, filename)
+    conn.close()
+    shutil.move(filename, os.path.join(CARPETA_LISTADOS, filename))
+    logging.info(f"Cambios: {nuevos} nuevos, {modificados} modificados, {eliminados} eliminados.")
+
+    # Los cambios ya están en isbns_libros: la marca puede avanzar aunque la descarga se interrumpa,
+    # porque los ISBNs pendientes seguirán con procesado IS NULL
+    guardar_marca(hasta)
+
+    DAPI_SQLite_v8.process_isbn_batches(args.usuario, args.password, args.hilos, vacuum=False)
+
+    logging.info("Sincronización completada.")
+    print(f"Sincronización completada: {nuevos} nuevos, {modificados} modificados, {eliminados} eliminados.")